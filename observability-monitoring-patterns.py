@@ -15,16 +15,29 @@ Perfect for demonstrating deep understanding of observability concepts in interv
 """
 
 import asyncio
+import bisect
+import contextvars
+import gc
+import gzip
 import time
+import weakref
 import json
 import logging
+import math
+import mmap
+import os
+import re
 import threading
-from typing import Dict, List, Any, Optional, Callable, Union
+import zlib
+from typing import Dict, List, Any, Optional, Callable, Union, Iterable, Iterator, Tuple
 from dataclasses import dataclass, asdict
 from datetime import datetime, timedelta
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict
 from contextlib import contextmanager
 from functools import wraps
+from itertools import repeat, accumulate, groupby
+from array import array
+from operator import itemgetter
 import prometheus_client
 from prometheus_client import Counter, Histogram, Gauge, Summary, Info
 import aiohttp
@@ -32,377 +45,3585 @@ import psutil
 import requests
 from concurrent.futures import ThreadPoolExecutor
 import queue
+import random
+import struct
 import signal
 import sys
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# ============================================================================
+# SHARED METRIC FAMILIES
+# ============================================================================
+
+# prometheus_client refuses to register the same metric name twice, so every
+# instance of a component shares one labeled family per metric name.
+_metric_families: Dict[str, Any] = {}
+_metric_families_lock = threading.Lock()
+
+def shared_metric(metric_type: type, name: str, documentation: str,
+                  labelnames: Iterable[str] = (), **kwargs):
+    """Get the process-wide metric family for name, creating it on first use"""
+    labelnames = tuple(labelnames)
+    with _metric_families_lock:
+        metric = _metric_families.get(name)
+        if metric is None:
+            metric = metric_type(name, documentation, labelnames, **kwargs)
+            _metric_families[name] = metric
+        elif not isinstance(metric, metric_type) or tuple(metric._labelnames) != labelnames:
+            raise ValueError(f"Metric {name} already registered with a different type or labels")
+        return metric
+
 
 # ============================================================================
 # PATTERN 1: DISTRIBUTED TRACING SYSTEM
 # ============================================================================
 
-@dataclass
+# Offset from the monotonic clock to wall-clock time. Spans record cheap
+# monotonic nanosecond timestamps and are only converted to wall time on export.
+_WALL_CLOCK_OFFSET_NS = time.time_ns() - time.monotonic_ns()
+
+def _monotonic_ns_to_datetime(monotonic_ns: int) -> datetime:
+    """Convert a monotonic nanosecond timestamp to a wall-clock datetime"""
+    return datetime.fromtimestamp((monotonic_ns + _WALL_CLOCK_OFFSET_NS) / 1e9)
+
+# Per-thread random sources for trace/span ids; avoids uuid4's os.urandom
+# call and string formatting on every span. Reset in forked children so
+# worker processes do not generate identical id sequences.
+_id_source = threading.local()
+
+def _reset_id_source():
+    global _id_source
+    _id_source = threading.local()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_id_source)
+
+def _id_bits(bits: int) -> int:
+    """Random non-zero id of the given width from the current thread's source"""
+    getrandbits = getattr(_id_source, 'getrandbits', None)
+    if getrandbits is None:
+        getrandbits = _id_source.getrandbits = random.Random(os.urandom(16)).getrandbits
+    value = getrandbits(bits)
+    while not value:
+        value = getrandbits(bits)
+    return value
+
+def generate_trace_id() -> int:
+    """Generate a 128-bit trace id"""
+    return _id_bits(128)
+
+def generate_span_id() -> int:
+    """Generate a 64-bit span id"""
+    return _id_bits(64)
+
+def format_trace_id(trace_id: int) -> str:
+    return f'{trace_id:032x}'
+
+def format_span_id(span_id: int) -> str:
+    return f'{span_id:016x}'
+
+# W3C traceparent: version-traceid(32 hex)-parentid(16 hex)-flags(2 hex), lowercase only
+_TRACEPARENT = re.compile(r'([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})')
+
 class Span:
-    trace_id: str
-    span_id: str
-    parent_span_id: Optional[str]
-    operation_name: str
-    start_time: datetime
-    end_time: Optional[datetime]
-    tags: Dict[str, Any]
-    logs: List[Dict[str, Any]]
-    status: str = 'started'
+    """
+    Compact span record
+
+    Uses __slots__, integer trace/span ids and integer monotonic nanosecond
+    timestamps. Tags and logs are allocated on first use; ids and timestamps
+    are formatted only on export.
+    """
+
+    __slots__ = ('trace_id', 'span_id', 'parent_span_id', 'operation_name', 'service',
+                 'start_ns', 'end_ns', 'tags', 'logs', 'status', 'trace_state')
+
+    sampled = True
+
+    def __init__(self, trace_id: int, span_id: int, parent_span_id: Optional[int],
+                 operation_name: str, service: Optional[str] = None,
+                 start_ns: Optional[int] = None, end_ns: Optional[int] = None,
+                 tags: Optional[Dict[str, Any]] = None, logs: Optional[List[tuple]] = None,
+                 status: str = 'started', trace_state: Optional[str] = None):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_span_id = parent_span_id
+        self.operation_name = operation_name
+        self.service = service
+        self.start_ns = time.monotonic_ns() if start_ns is None else start_ns
+        self.end_ns = end_ns
+        self.tags = tags
+        self.logs = logs  # (monotonic_ns, event, fields) tuples
+        self.status = status
+        self.trace_state = trace_state  # W3C tracestate, passed through unchanged
+
+    def set_tag(self, key: str, value: Any):
+        """Set a tag, allocating the tag dict on first use"""
+        if self.tags is None:
+            self.tags = {}
+        self.tags[key] = value
+
+    def add_log(self, event: str, fields: Dict[str, Any]):
+        """Append a log event; the timestamp is formatted lazily on export"""
+        if self.logs is None:
+            self.logs = []
+        self.logs.append((time.monotonic_ns(), event, fields))
+
+    @property
+    def start_time(self) -> datetime:
+        return _monotonic_ns_to_datetime(self.start_ns)
+
+    @property
+    def end_time(self) -> Optional[datetime]:
+        return _monotonic_ns_to_datetime(self.end_ns) if self.end_ns is not None else None
+
+    @property
+    def duration(self) -> Optional[float]:
+        """Span duration in seconds, or None if the span is still active"""
+        if self.end_ns is None:
+            return None
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Export the span, formatting timestamps"""
+        tags = {'service': self.service} if self.service is not None else {}
+        if self.tags:
+            tags.update(self.tags)
+        end_time = self.end_time
+        return {
+            'trace_id': format_trace_id(self.trace_id),
+            'span_id': format_span_id(self.span_id),
+            'parent_span_id': (format_span_id(self.parent_span_id)
+                               if self.parent_span_id is not None else None),
+            'operation_name': self.operation_name,
+            'start_time': self.start_time.isoformat(),
+            'end_time': end_time.isoformat() if end_time else None,
+            'duration': self.duration,
+            'tags': tags,
+            'logs': [
+                {
+                    'timestamp': _monotonic_ns_to_datetime(ts).isoformat(),
+                    'event': event,
+                    'fields': fields
+                }
+                for ts, event, fields in self.logs or ()
+            ],
+            'status': self.status
+        }
+
+class NonRecordingSpan:
+    """Context-only span for unsampled traces; nothing is recorded or exported"""
+
+    __slots__ = ('trace_id', 'span_id', 'trace_state')
+
+    sampled = False
+
+    def __init__(self, trace_id: int, span_id: int, trace_state: Optional[str] = None):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.trace_state = trace_state
+
+    def set_tag(self, key: str, value: Any):
+        pass
+
+    def add_log(self, event: str, fields: Dict[str, Any]):
+        pass
+
+class SpanStore:
+    """
+    Bounded, trace-indexed store for completed spans
+
+    Features:
+    - O(spans in trace) lookups by trace_id
+    - Span-count cap with least-recently-updated trace eviction
+    - Age-based eviction of stale traces
+    - Eviction and occupancy counters
+    """
+
+    def __init__(self, max_spans: int = 100000, max_trace_age: Optional[float] = 3600.0):
+        self.max_spans = max_spans
+        self.max_trace_age = max_trace_age
+        # trace_id -> (last_update_monotonic, spans); ordered oldest update first
+        self._traces: 'OrderedDict[int, List[Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.span_count = 0
+        self.evicted_spans = 0
+        self.evicted_traces = 0
+
+    def add(self, span: Span):
+        """Add a completed span, evicting old traces if over capacity"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._traces.get(span.trace_id)
+            if entry is None:
+                entry = [now, []]
+                self._traces[span.trace_id] = entry
+            else:
+                entry[0] = now
+                self._traces.move_to_end(span.trace_id)
+            entry[1].append(span)
+            self.span_count += 1
+            self._evict(now)
+
+    def get_trace(self, trace_id: int) -> List[Span]:
+        """Get all stored spans for a trace"""
+        with self._lock:
+            entry = self._traces.get(trace_id)
+            return list(entry[1]) if entry else []
+
+    def iter_traces(self):
+        """Iterate over stored traces as lists of spans"""
+        with self._lock:
+            entries = [list(spans) for _, spans in self._traces.values()]
+        yield from entries
+
+    def _evict(self, now: float):
+        """Evict least recently updated traces past the age or span cap"""
+        traces = self._traces
+        while traces:
+            trace_id, (last_update, spans) = next(iter(traces.items()))
+            expired = (self.max_trace_age is not None and
+                       now - last_update > self.max_trace_age)
+            if not expired and self.span_count <= self.max_spans:
+                break
+            del traces[trace_id]
+            self.span_count -= len(spans)
+            self.evicted_spans += len(spans)
+            self.evicted_traces += 1
+
+    def __iter__(self):
+        with self._lock:
+            entries = list(self._traces.values())
+        for _, spans in entries:
+            yield from spans
+
+    def __len__(self) -> int:
+        return self.span_count
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get occupancy and eviction counters"""
+        with self._lock:
+            return {
+                'spans': self.span_count,
+                'traces': len(self._traces),
+                'max_spans': self.max_spans,
+                'utilization': self.span_count / self.max_spans if self.max_spans else 0.0,
+                'evicted_spans': self.evicted_spans,
+                'evicted_traces': self.evicted_traces
+            }
+
+class SpanSink:
+    """
+    Destination for exported span batches
+
+    Sinks receive spans formatted with Span.to_dict(), or the Span objects
+    themselves when accepts_spans is set.
+    """
+
+    accepts_spans = False
+
+    def write_batch(self, spans: List[Dict[str, Any]]):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class InMemorySpanSink(SpanSink):
+    """Collects exported spans in memory, mainly for tests"""
+
+    def __init__(self):
+        self.spans: List[Dict[str, Any]] = []
+        self.batches = 0
+        self._lock = threading.Lock()
+
+    def write_batch(self, spans: List[Dict[str, Any]]):
+        with self._lock:
+            self.spans.extend(spans)
+            self.batches += 1
+
+class NDJSONFileSink(SpanSink):
+    """Appends spans to a newline-delimited JSON file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def write_batch(self, spans: List[Dict[str, Any]]):
+        self._file.write(''.join(json.dumps(span, default=str) + '\n' for span in spans))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class HTTPCollectorSink(SpanSink):
+    """POSTs span batches as NDJSON to an HTTP collector"""
+
+    def __init__(self, url: str, timeout: float = 5.0):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def write_batch(self, spans: List[Dict[str, Any]]):
+        body = ''.join(json.dumps(span, default=str) + '\n' for span in spans)
+        response = self.session.post(
+            self.url,
+            data=body.encode('utf-8'),
+            headers={'Content-Type': 'application/x-ndjson'},
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+
+    def close(self):
+        self.session.close()
+
+class LocalSpanCollector:
+    """
+    Minimal local HTTP collector stand-in for HTTPCollectorSink
+
+    Accepts NDJSON POSTs on a background thread and keeps received spans in memory.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        collector = self
+        self.spans: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                spans = [json.loads(line) for line in body.decode('utf-8').splitlines() if line]
+                with collector._lock:
+                    collector.spans.extend(spans)
+                self.send_response(202)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.url = f"http://{host}:{self.server.server_address[1]}/v1/spans"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class _ArchiveSegment:
+    """Bookkeeping for one archive segment file"""
+
+    __slots__ = ('seq', 'path', 'size', 'min_end_ns', 'max_end_ns', 'index_times',
+                 'index_offsets', 'trace_ids', 'records', 'mmap', 'mapped_size')
+
+    def __init__(self, seq: int, path: str):
+        self.seq = seq
+        self.path = path
+        self.size = 0
+        self.min_end_ns = None
+        self.max_end_ns = None
+        # Sparse time index: end time and offset of every Nth record
+        self.index_times: List[int] = []
+        self.index_offsets: List[int] = []
+        self.trace_ids: set = set()
+        self.records = 0
+        self.mmap = None
+        self.mapped_size = 0
+
+class SpanArchive(SpanSink):
+    """
+    Append-only, segment-based on-disk span archive
+    
+    Features:
+    - Length-prefixed binary records in rolling segment files
+    - Memory-mapped reads of individual records
+    - Sparse per-segment time index and a trace_id index
+    - Retention by total size and age
+    - Index rebuilt from record headers on open
+    
+    Record layout: header (payload length, trace id hi/lo, span id, parent
+    span id, start/end unix ns) followed by a JSON payload with the
+    operation, service, status, tags and logs.
+    """
+    
+    accepts_spans = True
+    
+    RECORD_HEADER = struct.Struct('<IQQQQqq')
+    SEGMENT_SUFFIX = '.spans'
+    
+    def __init__(self, directory: str, segment_size: int = 64 * 1024 * 1024,
+                 max_bytes: int = 1024 * 1024 * 1024, max_age: Optional[float] = 24 * 3600,
+                 index_interval: int = 64):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.index_interval = index_interval
+        
+        self.segments: 'OrderedDict[int, _ArchiveSegment]' = OrderedDict()
+        self.trace_index: Dict[int, List[tuple]] = defaultdict(list)  # trace_id -> [(seq, offset)]
+        self._lock = threading.RLock()
+        self._active: Optional[_ArchiveSegment] = None
+        self._file = None
+        
+        os.makedirs(directory, exist_ok=True)
+        self._load_segments()
+    
+    def _load_segments(self):
+        """Rebuild indexes by scanning record headers of existing segments"""
+        names = sorted(n for n in os.listdir(self.directory) if n.endswith(self.SEGMENT_SUFFIX))
+        for name in names:
+            seq = int(name[:-len(self.SEGMENT_SUFFIX)])
+            segment = _ArchiveSegment(seq, os.path.join(self.directory, name))
+            self.segments[seq] = segment
+            
+            size = os.path.getsize(segment.path)
+            if size == 0:
+                continue
+            with open(segment.path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                offset = 0
+                header_size = self.RECORD_HEADER.size
+                while offset + header_size <= size:
+                    length, trace_hi, trace_lo, _, _, _, end_ns = self.RECORD_HEADER.unpack_from(data, offset)
+                    if offset + header_size + length > size:
+                        break  # Torn write at the tail
+                    self._index_record(segment, offset, (trace_hi << 64) | trace_lo, end_ns)
+                    offset += header_size + length
+                segment.size = offset
+            finally:
+                data.close()
+            
+            if offset < size:
+                # Drop a partially written trailing record
+                with open(segment.path, 'r+b') as f:
+                    f.truncate(offset)
+    
+    def _index_record(self, segment: _ArchiveSegment, offset: int, trace_id: int, end_ns: int):
+        if segment.records % self.index_interval == 0:
+            segment.index_times.append(end_ns)
+            segment.index_offsets.append(offset)
+        segment.records += 1
+        if segment.min_end_ns is None or end_ns < segment.min_end_ns:
+            segment.min_end_ns = end_ns
+        if segment.max_end_ns is None or end_ns > segment.max_end_ns:
+            segment.max_end_ns = end_ns
+        segment.trace_ids.add(trace_id)
+        self.trace_index[trace_id].append((segment.seq, offset))
+    
+    def _encode(self, span: Span) -> bytes:
+        payload = json.dumps({
+            'operation_name': span.operation_name,
+            'service': span.service,
+            'status': span.status,
+            'tags': span.tags,
+            'logs': [(ts + _WALL_CLOCK_OFFSET_NS, event, fields) for ts, event, fields in span.logs or ()],
+            'trace_state': span.trace_state
+        }, default=str).encode('utf-8')
+        return self.RECORD_HEADER.pack(
+            len(payload),
+            span.trace_id >> 64, span.trace_id & 0xFFFFFFFFFFFFFFFF,
+            span.span_id, span.parent_span_id or 0,
+            span.start_ns + _WALL_CLOCK_OFFSET_NS,
+            span.end_ns + _WALL_CLOCK_OFFSET_NS
+        ) + payload
+    
+    def _decode(self, data, offset: int) -> Span:
+        length, trace_hi, trace_lo, span_id, parent_id, start_ns, end_ns = \
+            self.RECORD_HEADER.unpack_from(data, offset)
+        start = offset + self.RECORD_HEADER.size
+        payload = json.loads(data[start:start + length])
+        return Span(
+            (trace_hi << 64) | trace_lo, span_id, parent_id or None,
+            payload['operation_name'], payload['service'],
+            start_ns=start_ns - _WALL_CLOCK_OFFSET_NS,
+            end_ns=end_ns - _WALL_CLOCK_OFFSET_NS,
+            tags=payload['tags'],
+            logs=[(ts - _WALL_CLOCK_OFFSET_NS, event, fields) for ts, event, fields in payload['logs']] or None,
+            status=payload['status'],
+            trace_state=payload.get('trace_state')
+        )
+    
+    def write_batch(self, spans: List[Span]):
+        """Append finished spans; called from the exporter thread"""
+        with self._lock:
+            for span in spans:
+                if self._active is None or self._active.size >= self.segment_size:
+                    self._roll_segment()
+                record = self._encode(span)
+                segment = self._active
+                self._file.write(record)
+                self._index_record(segment, segment.size, span.trace_id,
+                                   span.end_ns + _WALL_CLOCK_OFFSET_NS)
+                segment.size += len(record)
+            if self._file is not None:
+                self._file.flush()
+            self._apply_retention()
+    
+    def _roll_segment(self):
+        """Seal the active segment and start a new one"""
+        if self._file is not None:
+            self._file.close()
+        seq = (next(reversed(self.segments)) + 1) if self.segments else 1
+        segment = _ArchiveSegment(seq, os.path.join(self.directory, f'{seq:012d}{self.SEGMENT_SUFFIX}'))
+        self.segments[seq] = segment
+        self._active = segment
+        self._file = open(segment.path, 'ab')
+    
+    def _apply_retention(self):
+        """Delete the oldest sealed segments past the size or age limit"""
+        total = sum(s.size for s in self.segments.values())
+        cutoff = time.time_ns() - int(self.max_age * 1e9) if self.max_age is not None else None
+        
+        for seq in list(self.segments):
+            segment = self.segments[seq]
+            if segment is self._active:
+                break
+            expired = cutoff is not None and segment.max_end_ns is not None and segment.max_end_ns < cutoff
+            if total <= self.max_bytes and not expired:
+                break
+            total -= segment.size
+            self._delete_segment(segment)
+    
+    def _delete_segment(self, segment: _ArchiveSegment):
+        if segment.mmap is not None:
+            segment.mmap.close()
+        del self.segments[segment.seq]
+        for trace_id in segment.trace_ids:
+            entries = [e for e in self.trace_index.get(trace_id, ()) if e[0] != segment.seq]
+            if entries:
+                self.trace_index[trace_id] = entries
+            else:
+                self.trace_index.pop(trace_id, None)
+        try:
+            os.remove(segment.path)
+        except OSError as e:
+            logging.error(f"Span archive could not delete {segment.path}: {e}")
+    
+    def _mapped(self, segment: _ArchiveSegment):
+        """Memory map a segment, remapping if it has grown since the last read"""
+        if segment.mmap is None or segment.mapped_size < segment.size:
+            if segment.mmap is not None:
+                segment.mmap.close()
+            with open(segment.path, 'rb') as f:
+                segment.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            segment.mapped_size = segment.size
+        return segment.mmap
+    
+    def get_trace(self, trace_id: int) -> List[Span]:
+        """Read all archived spans of a trace"""
+        with self._lock:
+            spans = []
+            for seq, offset in self.trace_index.get(trace_id, ()):
+                segment = self.segments.get(seq)
+                if segment is not None:
+                    spans.append(self._decode(self._mapped(segment), offset))
+            return spans
+    
+    def scan_time_range(self, start: datetime, end: datetime) -> List[Span]:
+        """Read archived spans that finished within [start, end]"""
+        start_ns = int(start.timestamp() * 1e9)
+        end_ns = int(end.timestamp() * 1e9)
+        header_size = self.RECORD_HEADER.size
+        result = []
+        
+        with self._lock:
+            for segment in self.segments.values():
+                if (segment.max_end_ns is None or segment.max_end_ns < start_ns
+                        or segment.min_end_ns > end_ns):
+                    continue
+                data = self._mapped(segment)
+                
+                # Records are appended roughly in finish order; step back one
+                # sparse index entry to tolerate small reorderings
+                position = max(bisect.bisect_left(segment.index_times, start_ns) - 1, 0)
+                offset = segment.index_offsets[position]
+                while offset < segment.size:
+                    length, _, _, _, _, _, record_end = self.RECORD_HEADER.unpack_from(data, offset)
+                    if start_ns <= record_end <= end_ns:
+                        result.append(self._decode(data, offset))
+                    offset += header_size + length
+        return result
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get archive occupancy"""
+        with self._lock:
+            return {
+                'segments': len(self.segments),
+                'bytes': sum(s.size for s in self.segments.values()),
+                'records': sum(s.records for s in self.segments.values()),
+                'traces': len(self.trace_index)
+            }
+    
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                self._active = None
+            for segment in self.segments.values():
+                if segment.mmap is not None:
+                    segment.mmap.close()
+                    segment.mmap = None
+
+class BatchSpanExporter:
+    """
+    Background span exporter with batching and bounded buffering
+    
+    Features:
+    - Non-blocking hand-off from request threads
+    - Batching by size and time
+    - Drop-on-overflow accounting
+    - Pluggable sinks with error isolation
+    - Export formatting off the hot path
+    """
+    
+    def __init__(self, sinks: List[SpanSink], max_queue_size: int = 10000,
+                 batch_size: int = 512, flush_interval: float = 1.0):
+        self.sinks = list(sinks)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._shutdown = False
+        
+        self.stats = defaultdict(int)
+        
+        # Metrics
+        self.spans_exported = shared_metric(
+            Counter,
+            'spans_exported_total',
+            'Total spans written to exporter sinks'
+        )
+        self.spans_dropped = shared_metric(
+            Counter,
+            'spans_dropped_total',
+            'Total spans dropped because the export queue was full'
+        )
+        
+        self._worker = threading.Thread(target=self._run, name='span-exporter', daemon=True)
+        self._worker.start()
+    
+    def add_sink(self, sink: SpanSink):
+        """Add an export destination"""
+        self.sinks.append(sink)
+    
+    def export(self, span: Span) -> bool:
+        """Queue a finished span for export without blocking"""
+        if self._shutdown:
+            return False
+        try:
+            self._queue.put_nowait(span)
+            return True
+        except queue.Full:
+            self.stats['dropped'] += 1
+            self.spans_dropped.inc()
+            return False
+    
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Block until spans queued so far have been written"""
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+    
+    def shutdown(self, timeout: float = 5.0):
+        """Flush remaining spans, stop the worker and close sinks"""
+        if self._shutdown:
+            return
+        self.flush(timeout)
+        self._shutdown = True
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._worker.join(timeout)
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as e:
+                logging.error(f"Span sink close error: {e}")
+    
+    def _run(self):
+        """Worker loop: collect batches by size or interval and write them"""
+        batch: List[Span] = []
+        deadline = time.monotonic() + self.flush_interval
+        
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = False
+            
+            if isinstance(item, Span):
+                batch.append(item)
+                if len(batch) < self.batch_size:
+                    continue
+            
+            # Size reached, interval elapsed, flush requested or shutdown
+            if batch:
+                self._write_batch(batch)
+                batch = []
+            deadline = time.monotonic() + self.flush_interval
+            
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                return
+    
+    def _write_batch(self, batch: List[Span]):
+        """Format spans and write them to every sink"""
+        records = None
+        for sink in self.sinks:
+            try:
+                if sink.accepts_spans:
+                    sink.write_batch(batch)
+                    continue
+                if records is None:
+                    records = [span.to_dict() for span in batch]
+                sink.write_batch(records)
+            except Exception as e:
+                self.stats['sink_errors'] += 1
+                logging.error(f"Span sink {type(sink).__name__} error: {e}")
+        
+        self.stats['batches'] += 1
+        self.stats['exported'] += len(batch)
+        self.spans_exported.inc(len(batch))
+    
+    def get_stats(self) -> Dict[str, int]:
+        """Get export, drop and error counts"""
+        return {
+            'queued': self._queue.qsize(),
+            'exported': self.stats['exported'],
+            'dropped': self.stats['dropped'],
+            'batches': self.stats['batches'],
+            'sink_errors': self.stats['sink_errors']
+        }
+
+class DDSketch:
+    """
+    Mergeable streaming quantile sketch with relative-error guarantees
+    
+    Features:
+    - Log-spaced buckets: any quantile is within relative_accuracy of the true value
+    - Bounded memory via max_bins (lowest buckets are collapsed first)
+    - Exact count, sum, min and max
+    - Lossless merging of sketches with the same accuracy, e.g. across processes
+    """
+    
+    # Values at or below this are counted in the zero bucket
+    MIN_INDEXABLE_VALUE = 1e-9
+    
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError(f"relative_accuracy must be in (0, 1): {relative_accuracy}")
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._multiplier = 1 / math.log(self.gamma)
+        
+        self.bins: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._lock = threading.Lock()
+    
+    def add(self, value: float, weight: int = 1):
+        """Add an observation"""
+        with self._lock:
+            if value > self.MIN_INDEXABLE_VALUE:
+                index = math.ceil(math.log(value) * self._multiplier)
+                bins = self.bins
+                bins[index] = bins.get(index, 0) + weight
+                if len(bins) > self.max_bins:
+                    self._collapse()
+            else:
+                self.zero_count += weight
+            self.count += weight
+            self.sum += value * weight
+            if value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+    
+    def _collapse(self):
+        """Fold the lowest buckets together until within max_bins"""
+        indexes = sorted(self.bins)
+        excess = len(indexes) - self.max_bins
+        if excess <= 0:
+            return
+        target = indexes[excess]
+        self.bins[target] += sum(self.bins.pop(i) for i in indexes[:excess])
+    
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate the q-quantile (0 <= q <= 1)"""
+        with self._lock:
+            if self.count == 0:
+                return None
+            rank = q * (self.count - 1)
+            seen = self.zero_count
+            if rank < seen:
+                return max(self.min, 0.0)
+            for index in sorted(self.bins):
+                seen += self.bins[index]
+                if seen > rank:
+                    value = 2 * self.gamma ** index / (self.gamma + 1)
+                    return min(max(value, self.min), self.max)
+            return self.max
+    
+    def quantiles(self, qs: Iterable[float] = (0.5, 0.9, 0.99, 0.999)) -> Dict[str, Optional[float]]:
+        """Estimate several quantiles, keyed like 'p50', 'p99', 'p999'"""
+        return {'p' + f'{q * 100:g}'.replace('.', ''): self.quantile(q) for q in qs}
+    
+    def merge(self, other: 'DDSketch'):
+        """Merge another sketch with the same relative accuracy into this one"""
+        if abs(other.gamma - self.gamma) > 1e-12:
+            raise ValueError("Cannot merge sketches with different relative accuracy")
+        with self._lock:
+            for index, count in other.bins.items():
+                self.bins[index] = self.bins.get(index, 0) + count
+            if len(self.bins) > self.max_bins:
+                self._collapse()
+            self.zero_count += other.zero_count
+            self.count += other.count
+            self.sum += other.sum
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialize for shipping to another process"""
+        with self._lock:
+            return {
+                'relative_accuracy': self.relative_accuracy,
+                'max_bins': self.max_bins,
+                'bins': {str(i): c for i, c in self.bins.items()},
+                'zero_count': self.zero_count,
+                'count': self.count,
+                'sum': self.sum,
+                'min': self.min if self.count else None,
+                'max': self.max if self.count else None
+            }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'DDSketch':
+        sketch = cls(data['relative_accuracy'], data.get('max_bins', 2048))
+        sketch.bins = {int(i): c for i, c in data['bins'].items()}
+        sketch.zero_count = data['zero_count']
+        sketch.count = data['count']
+        sketch.sum = data['sum']
+        if data['count']:
+            sketch.min = data['min']
+            sketch.max = data['max']
+        return sketch
+
+class TraceAnalyzer:
+    """
+    Latency breakdown for completed traces
+    
+    Features:
+    - Linear-time parent/child tree construction
+    - Self time vs child time per span (overlapping children counted once)
+    - Critical path extraction
+    - Per-operation aggregation across many traces
+    """
+    
+    @staticmethod
+    def build_tree(spans: List[Span]) -> Dict[str, Any]:
+        """Index spans by id and group children by parent"""
+        span_map = {s.span_id: s for s in spans if s.end_ns is not None}
+        children: Dict[int, List[Span]] = defaultdict(list)
+        roots = []
+        for span in span_map.values():
+            if span.parent_span_id in span_map:
+                children[span.parent_span_id].append(span)
+            else:
+                # Trace root, or a span whose parent is remote or was evicted
+                roots.append(span)
+        return {'span_map': span_map, 'children': children, 'roots': roots}
+    
+    @staticmethod
+    def _self_time_ns(span: Span, children: List[Span]) -> int:
+        """Span duration minus the union of its children's intervals"""
+        covered = 0
+        cursor = span.start_ns
+        for child in sorted(children, key=lambda c: c.start_ns):
+            start = max(child.start_ns, cursor)
+            end = min(child.end_ns, span.end_ns)
+            if end > start:
+                covered += end - start
+                cursor = end
+        return (span.end_ns - span.start_ns) - covered
+    
+    @staticmethod
+    def _critical_path(root: Span, children: Dict[int, List[Span]]) -> List[tuple]:
+        """
+        Walk backwards from the root's end, descending into the last child to
+        finish before the cursor. Returns (span, critical_ns) pairs whose times
+        sum to the root duration.
+        """
+        path = []
+        stack = [(root, root.start_ns, root.end_ns)]
+        while stack:
+            span, lo, hi = stack.pop()
+            cursor = hi
+            critical = 0
+            for child in sorted(children.get(span.span_id, ()), key=lambda c: c.end_ns, reverse=True):
+                if child.start_ns >= cursor:
+                    continue
+                child_end = min(child.end_ns, cursor)
+                child_start = max(child.start_ns, lo)
+                if child_end <= child_start:
+                    continue
+                critical += cursor - child_end
+                stack.append((child, child_start, child_end))
+                cursor = child_start
+            critical += cursor - lo
+            path.append((span, critical))
+        path.sort(key=lambda entry: entry[0].start_ns)
+        return path
+    
+    def analyze(self, spans: List[Span]) -> Dict[str, Any]:
+        """Critical path and self/child time breakdown for one trace"""
+        tree = self.build_tree(spans)
+        children = tree['children']
+        
+        breakdown = []
+        for span in tree['span_map'].values():
+            duration = span.end_ns - span.start_ns
+            self_ns = self._self_time_ns(span, children.get(span.span_id, ()))
+            breakdown.append({
+                'span_id': format_span_id(span.span_id),
+                'operation_name': span.operation_name,
+                'duration': duration / 1e9,
+                'self_time': self_ns / 1e9,
+                'child_time': (duration - self_ns) / 1e9
+            })
+        
+        critical_path = []
+        for root in tree['roots']:
+            for span, critical_ns in self._critical_path(root, children):
+                critical_path.append({
+                    'span_id': format_span_id(span.span_id),
+                    'operation_name': span.operation_name,
+                    'critical_time': critical_ns / 1e9
+                })
+        
+        return {'spans': breakdown, 'critical_path': critical_path}
+    
+    def aggregate(self, traces: Iterable[List[Span]]) -> Dict[str, Dict[str, float]]:
+        """Aggregate self, child and critical-path time by operation_name"""
+        totals: Dict[str, Dict[str, float]] = defaultdict(lambda: {
+            'count': 0, 'total_time': 0.0, 'self_time': 0.0,
+            'child_time': 0.0, 'critical_time': 0.0
+        })
+        trace_count = 0
+        
+        for spans in traces:
+            tree = self.build_tree(spans)
+            children = tree['children']
+            trace_count += 1
+            
+            for span in tree['span_map'].values():
+                duration = span.end_ns - span.start_ns
+                self_ns = self._self_time_ns(span, children.get(span.span_id, ()))
+                op = totals[span.operation_name]
+                op['count'] += 1
+                op['total_time'] += duration / 1e9
+                op['self_time'] += self_ns / 1e9
+                op['child_time'] += (duration - self_ns) / 1e9
+            
+            for root in tree['roots']:
+                for span, critical_ns in self._critical_path(root, children):
+                    totals[span.operation_name]['critical_time'] += critical_ns / 1e9
+        
+        # Share of total self time, i.e. where the latency actually goes
+        total_self = sum(op['self_time'] for op in totals.values()) or 1.0
+        result = {}
+        for name, op in sorted(totals.items(), key=lambda item: item[1]['self_time'], reverse=True):
+            op['avg_self_time'] = op['self_time'] / op['count']
+            op['self_time_share'] = op['self_time'] / total_self
+            op['critical_time_per_trace'] = op['critical_time'] / trace_count
+            result[name] = op
+        return result
+
+class _SpanScope:
+    """Sync and async context manager that makes a span current for its duration"""
+
+    __slots__ = ('tracer', 'operation_name', 'tags', 'parent_context', 'span', '_token')
+
+    def __init__(self, tracer: 'DistributedTracer', operation_name: str,
+                 tags: Optional[Dict[str, Any]], parent_context: Optional[Dict] = None):
+        self.tracer = tracer
+        self.operation_name = operation_name
+        self.tags = tags
+        self.parent_context = parent_context
+
+    def __enter__(self) -> Union[Span, NonRecordingSpan]:
+        tracer = self.tracer
+        parent = tracer._current_span.get()
+        if self.parent_context:
+            # Remote parent, e.g. from extract_context()
+            context = self.parent_context
+            span = tracer._start_span(self.operation_name, context.get('trace_id'),
+                                      context.get('span_id'), context.get('sampled'),
+                                      context.get('tracestate'), local_root=True)
+        elif parent is None:
+            span = tracer._start_span(self.operation_name, None, None, None, None,
+                                      local_root=True)
+        else:
+            span = tracer._start_span(self.operation_name, parent.trace_id, parent.span_id,
+                                      parent.sampled, parent.trace_state, local_root=False)
+        if self.tags and span.sampled:
+            for key, value in self.tags.items():
+                span.set_tag(key, value)
+        self.span = span
+        self._token = tracer._current_span.set(span)
+        return span
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.tracer._current_span.reset(self._token)
+        if self.span.sampled:
+            self.tracer._finish(self.span, 'error' if exc is not None else 'success', exc)
+        return False
+
+    async def __aenter__(self) -> Union[Span, NonRecordingSpan]:
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        return self.__exit__(exc_type, exc, tb)
+
+class DistributedTracer:
+    """
+    Advanced distributed tracing system with context propagation
+    
+    Features:
+    - Trace context propagation (W3C traceparent/tracestate)
+    - Span lifecycle management
+    - Performance metrics collection
+    - Error tracking and correlation
+    - Sampling strategies
+    - Bounded, trace-indexed span storage
+    - Background batched export of retained spans
+    - contextvars-based current span, safe across threads and asyncio tasks
+    - Critical-path and per-operation latency breakdown
+    - Per-operation DDSketch latency quantiles (p50/p90/p99/p999), mergeable across processes
+    - Optional on-disk span archive for historical trace lookups
+    
+    Usage:
+        with tracer.span('db_query', table='users') as span:
+            ...
+        async with tracer.span('fetch_profile'):
+            ...
+        @tracer.trace()
+        async def handler(request): ...
+    
+    Scoped spans derive their parent from the current span and are finished
+    by the scope itself, without going through the span_id-keyed active_spans.
+    
+    Sampling:
+    - 'head': each new trace is kept with probability sampling_rate; unsampled
+      traces only propagate context through a NonRecordingSpan
+    - 'tail': head-sampled traces are buffered until their local root span
+      finishes, then kept only if slow, errored, or picked by tail_baseline_rate
+    """
+    
+    def __init__(self, service_name: str, sampling_rate: float = 1.0,
+                 max_spans: int = 100000, max_trace_age: Optional[float] = 3600.0,
+                 sampling_mode: str = 'head', tail_latency_threshold: float = 1.0,
+                 tail_baseline_rate: float = 0.0, max_pending_traces: int = 10000,
+                 exporter: Optional[BatchSpanExporter] = None,
+                 sketch_relative_accuracy: float = 0.01, sketch_max_bins: int = 2048,
+                 archive: Optional[SpanArchive] = None):
+        if sampling_mode not in ('head', 'tail'):
+            raise ValueError(f"Unsupported sampling mode: {sampling_mode}")
+        
+        self.service_name = service_name
+        self.sampling_rate = sampling_rate
+        self.sampling_mode = sampling_mode
+        self.tail_latency_threshold = tail_latency_threshold
+        self.tail_baseline_rate = tail_baseline_rate
+        self.max_pending_traces = max_pending_traces
+        self.active_spans: Dict[int, Span] = {}
+        self.span_store = SpanStore(max_spans=max_spans, max_trace_age=max_trace_age)
+        self.exporter = exporter
+        self.archive = archive
+        if archive is not None:
+            # Archive writes always go through the background exporter
+            if self.exporter is None:
+                self.exporter = BatchSpanExporter([archive])
+            else:
+                self.exporter.add_sink(archive)
+        self.analyzer = TraceAnalyzer()
+        self.sketch_relative_accuracy = sketch_relative_accuracy
+        self.sketch_max_bins = sketch_max_bins
+        self.latency_sketches: Dict[tuple, DDSketch] = {}
+        self._current_span: contextvars.ContextVar = contextvars.ContextVar(
+            f'current_span_{service_name}', default=None
+        )
+        
+        # Tail sampling state: trace_id -> (local root span_id, finished spans)
+        self._pending_traces: 'OrderedDict[int, tuple]' = OrderedDict()
+        self._tail_decisions: 'OrderedDict[int, bool]' = OrderedDict()
+        self._tail_lock = threading.Lock()
+        self.sampling_stats = defaultdict(int)
+        
+        # Metrics
+        self.traces_total = shared_metric(
+            Counter,
+            'traces_total',
+            'Total number of traces',
+            ['service', 'status']
+        )
+        self.span_duration = shared_metric(
+            Histogram,
+            'span_duration_seconds',
+            'Span duration in seconds',
+            ['service', 'operation']
+        )
+        self.active_spans_gauge = shared_metric(
+            Gauge,
+            'active_spans',
+            'Number of active spans',
+            ['service']
+        )
+        self._active_spans_gauge = self.active_spans_gauge.labels(service=self.service_name)
+        self._duration_metrics: Dict[str, Any] = {}
+        self._traces_metrics: Dict[str, Any] = {}
+        self._decision_metrics: Dict[str, Any] = {}
+        self.sampling_decisions = shared_metric(
+            Counter,
+            'trace_sampling_decisions_total',
+            'Trace sampling decisions',
+            ['service', 'decision']
+        )
+
+    @property
+    def completed_spans(self) -> List[Span]:
+        """Completed spans currently retained by the span store"""
+        return list(self.span_store)
+
+    def start_trace(self, operation_name: str, trace_id: int = None, 
+                   parent_context: Dict = None) -> int:
+        """Start a new trace or span and make it the current span"""
+        span_id = generate_span_id()
+        parent_span_id = None
+        sampled = None
+        trace_state = None
+        
+        # Handle parent context propagation
+        if parent_context:
+            parent_span_id = parent_context.get('span_id')
+            trace_id = parent_context.get('trace_id', trace_id)
+            sampled = parent_context.get('sampled')
+            trace_state = parent_context.get('tracestate')
+        
+        span = self._start_span(operation_name, trace_id, parent_span_id, sampled,
+                                trace_state, parent_span_id not in self.active_spans,
+                                span_id)
+        if span.sampled:
+            self.active_spans[span_id] = span
+        self._current_span.set(span)
+        
+        return span_id
+    
+    def span(self, operation_name: str, parent_context: Dict = None, **tags) -> _SpanScope:
+        """Context manager (sync or async) for a child of the current span"""
+        return _SpanScope(self, operation_name, tags, parent_context)
+    
+    def trace(self, operation_name: str = None, **tags):
+        """Decorator that runs the function inside a span"""
+        def decorator(func):
+            name = operation_name or func.__name__
+            
+            if asyncio.iscoroutinefunction(func):
+                @wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with _SpanScope(self, name, tags):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+            else:
+                @wraps(func)
+                def sync_wrapper(*args, **kwargs):
+                    with _SpanScope(self, name, tags):
+                        return func(*args, **kwargs)
+                return sync_wrapper
+        return decorator
+    
+    def get_current_span(self) -> Optional[Union[Span, NonRecordingSpan]]:
+        """Get the span current in this thread or asyncio task"""
+        return self._current_span.get()
+    
+    def _start_span(self, operation_name: str, trace_id: Optional[int],
+                    parent_span_id: Optional[int], sampled: Optional[bool],
+                    trace_state: Optional[str], local_root: bool,
+                    span_id: Optional[int] = None) -> Union[Span, NonRecordingSpan]:
+        """Create a span, applying head sampling for new traces"""
+        if span_id is None:
+            span_id = generate_span_id()
+        if trace_id is None:
+            trace_id = generate_trace_id()
+        
+        # Head sampling: decided once per trace and inherited by child spans
+        if sampled is None:
+            sampled = self._head_sample()
+        if not sampled:
+            return NonRecordingSpan(trace_id, span_id, trace_state)
+        
+        if self.sampling_mode == 'tail' and local_root:
+            self._buffer_trace(trace_id, span_id)
+        
+        self._active_spans_gauge.inc()
+        return Span(trace_id, span_id, parent_span_id, operation_name, self.service_name,
+                    trace_state=trace_state)
+    
+    def finish_span(self, span_id: int, status: str = 'success', 
+                   error: Exception = None) -> Optional[Span]:
+        """Finish a span and move to completed spans"""
+        span = self.active_spans.pop(span_id, None)
+        if span is None:
+            return None
+        return self._finish(span, status, error)
+    
+    def _finish(self, span: Span, status: str, error: Optional[BaseException]) -> Span:
+        """Record a finished span's metrics and hand it to storage"""
+        span.end_ns = time.monotonic_ns()
+        span.status = status
+        
+        if error:
+            span.set_tag('error', True)
+            span.set_tag('error.message', str(error))
+            span.set_tag('error.type', type(error).__name__)
+            self._add_log(span, 'error', {'error': str(error)})
+        
+        # Calculate duration
+        duration = (span.end_ns - span.start_ns) / 1e9
+        
+        # Update metrics through cached label children
+        duration_metric = self._duration_metrics.get(span.operation_name)
+        if duration_metric is None:
+            duration_metric = self._duration_metrics[span.operation_name] = self.span_duration.labels(
+                service=self.service_name,
+                operation=span.operation_name
+            )
+        duration_metric.observe(duration)
+        
+        sketch = self.latency_sketches.get((self.service_name, span.operation_name))
+        if sketch is None:
+            sketch = self.latency_sketches.setdefault(
+                (self.service_name, span.operation_name),
+                DDSketch(self.sketch_relative_accuracy, self.sketch_max_bins)
+            )
+        sketch.add(duration)
+        
+        traces_metric = self._traces_metrics.get(status)
+        if traces_metric is None:
+            traces_metric = self._traces_metrics[status] = self.traces_total.labels(
+                service=self.service_name,
+                status=status
+            )
+        traces_metric.inc()
+        
+        # Move to completed spans
+        self._record_completed(span)
+        self._active_spans_gauge.dec()
+        
+        return span
+    
+    def _head_sample(self) -> bool:
+        """Make the head sampling decision for a new trace"""
+        sampled = self.sampling_rate >= 1.0 or random.random() < self.sampling_rate
+        decision = 'head_sampled' if sampled else 'head_dropped'
+        self._count_sampling_decision(decision)
+        return sampled
+    
+    def _count_sampling_decision(self, decision: str):
+        self.sampling_stats[decision] += 1
+        decision_metric = self._decision_metrics.get(decision)
+        if decision_metric is None:
+            decision_metric = self._decision_metrics[decision] = self.sampling_decisions.labels(
+                service=self.service_name, decision=decision
+            )
+        decision_metric.inc()
+    
+    def _buffer_trace(self, trace_id: int, root_span_id: int):
+        """Start buffering a trace until its local root span finishes"""
+        with self._tail_lock:
+            if trace_id in self._pending_traces:
+                return
+            self._pending_traces[trace_id] = (root_span_id, [])
+            
+            # Drop the oldest pending traces if roots never finish
+            while len(self._pending_traces) > self.max_pending_traces:
+                self._pending_traces.popitem(last=False)
+                self.sampling_stats['tail_evicted'] += 1
+    
+    def _retain(self, span: Span):
+        """Store a kept span and queue it for export"""
+        self.span_store.add(span)
+        if self.exporter is not None:
+            self.exporter.export(span)
+    
+    def _record_completed(self, span: Span):
+        """Hand a finished span to the span store, applying tail sampling"""
+        if self.sampling_mode != 'tail':
+            self._retain(span)
+            return
+        
+        with self._tail_lock:
+            pending = self._pending_traces.get(span.trace_id)
+            if pending is None:
+                # Late span of an already decided trace
+                if self._tail_decisions.get(span.trace_id, True):
+                    self._retain(span)
+                return
+            
+            root_span_id, spans = pending
+            spans.append(span)
+            if span.span_id != root_span_id:
+                return
+            
+            del self._pending_traces[span.trace_id]
+            keep = self._tail_keep(span, spans)
+            self._tail_decisions[span.trace_id] = keep
+            while len(self._tail_decisions) > self.max_pending_traces:
+                self._tail_decisions.popitem(last=False)
+        
+        self._count_sampling_decision('tail_kept' if keep else 'tail_dropped')
+        if keep:
+            for trace_span in spans:
+                self._retain(trace_span)
+    
+    def _tail_keep(self, root: Span, spans: List[Span]) -> bool:
+        """Keep slow or errored traces plus a baseline percentage"""
+        if root.duration >= self.tail_latency_threshold:
+            return True
+        for trace_span in spans:
+            if trace_span.status != 'success' or (trace_span.tags and trace_span.tags.get('error')):
+                return True
+        return random.random() < self.tail_baseline_rate
+    
+    def get_sampling_stats(self) -> Dict[str, int]:
+        """Get sampling decision counts"""
+        return dict(self.sampling_stats)
+    
+    def add_tag(self, span_id: int, key: str, value: Any):
+        """Add tag to span"""
+        if span_id in self.active_spans:
+            self.active_spans[span_id].set_tag(key, value)
+    
+    def add_log(self, span_id: int, event: str, fields: Dict[str, Any] = None):
+        """Add log entry to span"""
+        if span_id in self.active_spans:
+            self._add_log(self.active_spans[span_id], event, fields or {})
+    
+    def _add_log(self, span: Span, event: str, fields: Dict[str, Any]):
+        """Internal method to add log to span"""
+        span.add_log(event, fields)
+    
+    def get_trace_context(self) -> Dict[str, Any]:
+        """Get current trace context for propagation"""
+        span = self._current_span.get()
+        if span is not None:
+            context = {
+                'trace_id': span.trace_id,
+                'span_id': span.span_id,
+                'sampled': span.sampled
+            }
+            if span.trace_state:
+                context['tracestate'] = span.trace_state
+            return context
+        return {}
+    
+    def inject_headers(self, headers: Dict[str, str] = None) -> Dict[str, str]:
+        """Inject trace context into HTTP headers as W3C traceparent/tracestate"""
+        if headers is None:
+            headers = {}
+        
+        span = self._current_span.get()
+        if span is not None:
+            flags = '01' if span.sampled else '00'
+            headers['traceparent'] = f'00-{span.trace_id:032x}-{span.span_id:016x}-{flags}'
+            if span.trace_state:
+                headers['tracestate'] = span.trace_state
+        
+        return headers
+    
+    def extract_context(self, headers: Dict[str, str]) -> Dict[str, Any]:
+        """Extract trace context from HTTP headers"""
+        traceparent = headers.get('traceparent') or headers.get('Traceparent')
+        if traceparent:
+            context = self._parse_traceparent(traceparent)
+            if context:
+                trace_state = headers.get('tracestate') or headers.get('Tracestate')
+                if trace_state:
+                    context['tracestate'] = trace_state
+            return context
+        
+        # Legacy X-Trace-ID/X-Span-ID headers from services not yet on traceparent
+        trace_id = headers.get('X-Trace-ID')
+        span_id = headers.get('X-Span-ID')
+        if not trace_id:
+            return {}
+        try:
+            return {
+                'trace_id': int(trace_id.replace('-', ''), 16),
+                'span_id': int(span_id.replace('-', ''), 16) & 0xFFFFFFFFFFFFFFFF if span_id else None
+            }
+        except ValueError:
+            return {}
+    
+    @staticmethod
+    def _parse_traceparent(traceparent: str) -> Dict[str, Any]:
+        """Parse a W3C traceparent header; returns {} if it is invalid"""
+        match = _TRACEPARENT.match(traceparent)
+        if match is None:
+            return {}
+        version, trace_hex, span_hex, flags_hex = match.groups()
+        # Later versions may append fields after another '-'; version 00 may not
+        if version == 'ff' or (len(traceparent) != 55 and (version == '00' or traceparent[55] != '-')):
+            return {}
+        trace_id = int(trace_hex, 16)
+        span_id = int(span_hex, 16)
+        flags = int(flags_hex, 16)
+        if not trace_id or not span_id:
+            return {}
+        return {'trace_id': trace_id, 'span_id': span_id, 'sampled': bool(flags & 0x01)}
+    
+    def get_trace_summary(self, trace_id: Union[int, str]) -> Dict[str, Any]:
+        """Get summary of a complete trace"""
+        if isinstance(trace_id, str):
+            try:
+                trace_id = int(trace_id, 16)
+            except ValueError:
+                return {'error': 'Trace not found'}
+        
+        trace_spans = self.span_store.get_trace(trace_id)
+        source = 'memory'
+        if not trace_spans and self.archive is not None:
+            trace_spans = self.archive.get_trace(trace_id)
+            source = 'archive'
+        
+        if not trace_spans:
+            return {'error': 'Trace not found'}
+        
+        # Calculate trace metrics
+        start_ns = min(s.start_ns for s in trace_spans)
+        end_ns = max((s.end_ns for s in trace_spans if s.end_ns is not None), default=None)
+        duration = (end_ns - start_ns) / 1e9 if end_ns is not None else None
+        start_time = _monotonic_ns_to_datetime(start_ns)
+        end_time = _monotonic_ns_to_datetime(end_ns) if end_ns is not None else None
+        
+        # Build span hierarchy
+        root_spans = [s for s in trace_spans if s.parent_span_id is None]
+        analysis = self.analyzer.analyze(trace_spans)
+        
+        return {
+            'trace_id': format_trace_id(trace_id),
+            'service': self.service_name,
+            'start_time': start_time.isoformat(),
+            'end_time': end_time.isoformat() if end_time else None,
+            'duration': duration,
+            'span_count': len(trace_spans),
+            'source': source,
+            'root_spans': [s.to_dict() for s in root_spans],
+            'critical_path': analysis['critical_path'],
+            'span_breakdown': analysis['spans'],
+            'status': 'success' if all(s.status == 'success' for s in trace_spans) else 'error'
+        }
+    
+    def get_latency_quantiles(self, quantiles: Iterable[float] = (0.5, 0.9, 0.99, 0.999)
+                              ) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """Latency quantiles in seconds per service and operation"""
+        result: Dict[str, Dict[str, Dict[str, Any]]] = defaultdict(dict)
+        for (service, operation), sketch in list(self.latency_sketches.items()):
+            stats = sketch.quantiles(quantiles)
+            stats['count'] = sketch.count
+            stats['max'] = sketch.max
+            result[service][operation] = stats
+        return dict(result)
+    
+    def export_latency_sketches(self) -> List[Dict[str, Any]]:
+        """Serialize latency sketches so another process can merge them"""
+        return [
+            {'service': service, 'operation': operation, 'sketch': sketch.to_dict()}
+            for (service, operation), sketch in list(self.latency_sketches.items())
+        ]
+    
+    def merge_latency_sketches(self, exported: List[Dict[str, Any]]):
+        """Merge sketches exported by other processes or tracers"""
+        for entry in exported:
+            key = (entry['service'], entry['operation'])
+            incoming = DDSketch.from_dict(entry['sketch'])
+            sketch = self.latency_sketches.setdefault(
+                key, DDSketch(incoming.relative_accuracy, self.sketch_max_bins)
+            )
+            sketch.merge(incoming)
+    
+    def get_latency_breakdown(self, trace_ids: Optional[List[Union[int, str]]] = None) -> Dict[str, Dict[str, float]]:
+        """Aggregate where latency goes by operation across stored traces"""
+        if trace_ids is None:
+            traces = self.span_store.iter_traces()
+        else:
+            traces = (self.span_store.get_trace(int(t, 16) if isinstance(t, str) else t)
+                      for t in trace_ids)
+        return self.analyzer.aggregate(trace for trace in traces if trace)
+
+
+# ============================================================================
+# PATTERN 2: CIRCUIT BREAKER WITH INTELLIGENT RECOVERY
+# ============================================================================
+
+class CircuitBreakerState:
+    CLOSED = "closed"      # Normal operation
+    OPEN = "open"          # Circuit is open, failing fast
+    HALF_OPEN = "half_open"  # Testing if service is back
+
+class CircuitBreakerOpenError(Exception):
+    """Raised when a call is rejected without reaching the protected function"""
+
+_OUTCOME_FAILURE = 1
+_OUTCOME_SLOW = 2
+
+class _CountWindow:
+    """Ring buffer of the last N call outcomes with running totals"""
+
+    __slots__ = ('size', 'outcomes', 'position', 'calls', 'failures', 'slow')
+
+    def __init__(self, size: int):
+        self.size = size
+        self.outcomes = bytearray(size)
+        self.reset()
+
+    def reset(self):
+        self.outcomes[:] = bytes(self.size)
+        self.position = 0
+        self.calls = 0
+        self.failures = 0
+        self.slow = 0
+
+    def record(self, outcome: int):
+        if self.calls == self.size:
+            evicted = self.outcomes[self.position]
+            self.failures -= evicted & _OUTCOME_FAILURE
+            self.slow -= (evicted & _OUTCOME_SLOW) >> 1
+        else:
+            self.calls += 1
+        self.outcomes[self.position] = outcome
+        self.failures += outcome & _OUTCOME_FAILURE
+        self.slow += (outcome & _OUTCOME_SLOW) >> 1
+        self.position = (self.position + 1) % self.size
+
+    def totals(self) -> tuple:
+        return self.calls, self.failures, self.slow
+
+class _TimeWindow:
+    """Per-second buckets over the last N seconds with running totals"""
+
+    __slots__ = ('size', 'bucket_calls', 'bucket_failures', 'bucket_slow',
+                 'current_second', 'calls', 'failures', 'slow')
+
+    def __init__(self, size: int):
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        self.bucket_calls = [0] * self.size
+        self.bucket_failures = [0] * self.size
+        self.bucket_slow = [0] * self.size
+        self.current_second = int(time.monotonic())
+        self.calls = 0
+        self.failures = 0
+        self.slow = 0
+
+    def _advance(self):
+        """Expire buckets for the seconds elapsed since the last call"""
+        now = int(time.monotonic())
+        elapsed = now - self.current_second
+        if elapsed <= 0:
+            return
+        for second in range(self.current_second + 1, self.current_second + 1 + min(elapsed, self.size)):
+            i = second % self.size
+            self.calls -= self.bucket_calls[i]
+            self.failures -= self.bucket_failures[i]
+            self.slow -= self.bucket_slow[i]
+            self.bucket_calls[i] = self.bucket_failures[i] = self.bucket_slow[i] = 0
+        self.current_second = now
+
+    def record(self, outcome: int):
+        self._advance()
+        i = self.current_second % self.size
+        failed = outcome & _OUTCOME_FAILURE
+        slow = (outcome & _OUTCOME_SLOW) >> 1
+        self.bucket_calls[i] += 1
+        self.bucket_failures[i] += failed
+        self.bucket_slow[i] += slow
+        self.calls += 1
+        self.failures += failed
+        self.slow += slow
+
+    def totals(self) -> tuple:
+        self._advance()
+        return self.calls, self.failures, self.slow
+
+class ConcurrencyLimitExceeded(Exception):
+    """Raised when a call is shed by an AdaptiveConcurrencyLimiter"""
+
+# Errors that signal an overloaded dependency; any other error is an ordinary latency sample
+OVERLOAD_EXCEPTIONS = (TimeoutError, asyncio.TimeoutError, requests.exceptions.Timeout,
+                       ConcurrencyLimitExceeded)
+
+class _LimiterWaiter:
+    __slots__ = ('event', 'loop', 'future', 'granted')
+
+    def __init__(self, event=None, loop=None, future=None):
+        self.event = event
+        self.loop = loop
+        self.future = future
+        self.granted = False
+
+def _resolve_waiter_future(future: 'asyncio.Future'):
+    if not future.done():
+        future.set_result(True)
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Adaptive in-flight limit (bulkhead) for one dependency
+    
+    Features:
+    - Limit derived from observed latency (AIMD or gradient)
+    - Sync and async entry points sharing one limit
+    - Bounded FIFO wait queue with per-call deadlines
+    - Limit, in-flight and rejection metrics
+    
+    Only exceptions matching drop_exceptions (timeouts and overload errors
+    by default) count as drops; other errors are fed in as normal latency
+    samples, so fast application errors do not shrink the limit.
+    
+    Algorithms:
+    - 'aimd': +1 when the limit is being used and latency is under
+      latency_threshold; multiply by backoff_ratio on slow or dropped calls
+    - 'gradient': scale the limit by long-term RTT / short-term RTT, so the
+      limit shrinks as soon as queueing inflates latency, plus sqrt(limit)
+      headroom to keep probing for more capacity
+    """
+    
+    def __init__(self, name: str, initial_limit: int = 20, min_limit: int = 1,
+                 max_limit: int = 1000, algorithm: str = 'gradient',
+                 latency_threshold: float = 1.0, backoff_ratio: float = 0.9,
+                 smoothing: float = 0.2, max_queue: int = 100,
+                 default_timeout: Optional[float] = 1.0,
+                 drop_exceptions: Union[type, Tuple[type, ...]] = OVERLOAD_EXCEPTIONS):
+        if algorithm not in ('aimd', 'gradient'):
+            raise ValueError(f"Unsupported limiter algorithm: {algorithm}")
+        self.name = name
+        self.algorithm = algorithm
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_threshold = latency_threshold
+        self.backoff_ratio = backoff_ratio
+        self.smoothing = smoothing
+        self.max_queue = max_queue
+        self.default_timeout = default_timeout
+        self.drop_exceptions = drop_exceptions
+        
+        self.limit = float(initial_limit)
+        self.in_flight = 0
+        self._short_rtt: Optional[float] = None
+        self._long_rtt: Optional[float] = None
+        self._waiters: deque = deque()
+        self._lock = threading.Lock()
+        self.stats = defaultdict(int)
+        
+        # Metrics
+        self.limit_gauge = shared_metric(
+            Gauge,
+            'concurrency_limit',
+            'Current adaptive concurrency limit',
+            ['name']
+        )
+        self.in_flight_gauge = shared_metric(
+            Gauge,
+            'concurrency_in_flight',
+            'Calls currently holding a concurrency permit',
+            ['name']
+        )
+        self.rejections = shared_metric(
+            Counter,
+            'concurrency_limiter_rejections_total',
+            'Calls shed by the concurrency limiter',
+            ['name', 'reason']
+        )
+        self._limit_gauge = self.limit_gauge.labels(name=name)
+        self._in_flight_gauge = self.in_flight_gauge.labels(name=name)
+        self._limit_gauge.set(int(self.limit))
+    
+    def _try_acquire(self) -> Optional[_LimiterWaiter]:
+        """Take a permit if one is free (returns None) or enqueue a waiter; caller holds the lock"""
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return None
+        if len(self._waiters) >= self.max_queue:
+            raise ConcurrencyLimitExceeded(f"Concurrency limiter {self.name} queue is full")
+        waiter = _LimiterWaiter()
+        self._waiters.append(waiter)
+        return waiter
+    
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Block until a permit is available or the deadline passes"""
+        timeout = self.default_timeout if timeout is None else timeout
+        with self._lock:
+            try:
+                waiter = self._try_acquire()
+            except ConcurrencyLimitExceeded:
+                self._reject('queue_full')
+                return False
+            if waiter is None:
+                self._in_flight_gauge.inc()
+                return True
+            waiter.event = threading.Event()
+        
+        waiter.event.wait(timeout)
+        return self._finish_wait(waiter)
+    
+    async def acquire_async(self, timeout: Optional[float] = None) -> bool:
+        """Await a permit without blocking the event loop"""
+        timeout = self.default_timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            try:
+                waiter = self._try_acquire()
+            except ConcurrencyLimitExceeded:
+                self._reject('queue_full')
+                return False
+            if waiter is None:
+                self._in_flight_gauge.inc()
+                return True
+            waiter.loop = loop
+            waiter.future = loop.create_future()
+        
+        try:
+            await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if not self._finish_wait(waiter, 'cancelled'):
+                raise
+            self.release(0.0, dropped=True)
+            raise
+        return self._finish_wait(waiter)
+    
+    def _finish_wait(self, waiter: _LimiterWaiter, reason: str = 'timeout') -> bool:
+        """Resolve a finished wait: granted, or timed out and dequeued"""
+        with self._lock:
+            if waiter.granted:
+                return True
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+            self._reject(reason)
+            return False
+    
+    def _reject(self, reason: str):
+        self.stats[reason] += 1
+        self.rejections.labels(name=self.name, reason=reason).inc()
+    
+    def release(self, latency: float, dropped: bool = False):
+        """Return a permit and feed the call's latency into the limit"""
+        with self._lock:
+            in_flight = self.in_flight
+            self.in_flight -= 1
+            self._update_limit(latency, dropped, in_flight)
+            
+            # Hand permits directly to queued callers, oldest first
+            while self._waiters and self.in_flight < int(self.limit):
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+                self.in_flight += 1
+                if waiter.future is not None:
+                    waiter.loop.call_soon_threadsafe(_resolve_waiter_future, waiter.future)
+                else:
+                    waiter.event.set()
+            granted_delta = self.in_flight - in_flight
+        self._in_flight_gauge.inc(granted_delta)
+    
+    def _update_limit(self, latency: float, dropped: bool, in_flight: int):
+        """Adjust the limit from one sample; caller holds the lock"""
+        previous = int(self.limit)
+        
+        if self.algorithm == 'aimd':
+            if dropped or latency > self.latency_threshold:
+                self.limit = self.limit * self.backoff_ratio
+            elif in_flight * 2 >= self.limit:
+                self.limit += 1
+        elif not dropped:
+            # Short-term and long-term latency averages
+            if self._short_rtt is None:
+                self._short_rtt = self._long_rtt = latency
+            else:
+                self._short_rtt += self.smoothing * (latency - self._short_rtt)
+                self._long_rtt += (self.smoothing / 10) * (latency - self._long_rtt)
+            if self._short_rtt > 0:
+                gradient = max(0.5, min(1.0, self._long_rtt / self._short_rtt))
+                target = self.limit * gradient
+                # Probe upward only when the limit is actually in use (not app-limited)
+                if in_flight * 2 >= self.limit:
+                    target += math.sqrt(self.limit)
+                self.limit = (1 - self.smoothing) * self.limit + self.smoothing * target
+            # Let the long-term baseline recover after sustained congestion
+            if self._long_rtt > 2 * self._short_rtt:
+                self._long_rtt *= 0.95
+        else:
+            self.limit = self.limit * self.backoff_ratio
+        
+        self.limit = max(self.min_limit, min(self.max_limit, self.limit))
+        if int(self.limit) != previous:
+            self._limit_gauge.set(int(self.limit))
+    
+    @contextmanager
+    def limit_scope(self, timeout: Optional[float] = None):
+        """Hold a permit for the duration of the block"""
+        if not self.acquire(timeout):
+            raise ConcurrencyLimitExceeded(f"Concurrency limit {int(self.limit)} reached for {self.name}")
+        start = time.perf_counter()
+        dropped = False
+        try:
+            yield
+        except Exception as e:
+            dropped = isinstance(e, self.drop_exceptions)
+            raise
+        finally:
+            self.release(time.perf_counter() - start, dropped)
+    
+    def call(self, func: Callable, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+        """Run func holding a permit"""
+        with self.limit_scope(timeout):
+            return func(*args, **kwargs)
+    
+    async def call_async(self, func: Callable, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+        """Await func holding a permit"""
+        if not await self.acquire_async(timeout):
+            raise ConcurrencyLimitExceeded(f"Concurrency limit {int(self.limit)} reached for {self.name}")
+        start = time.perf_counter()
+        dropped = False
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            dropped = isinstance(e, self.drop_exceptions)
+            raise
+        finally:
+            self.release(time.perf_counter() - start, dropped)
+    
+    def remove_metrics(self):
+        """Drop this limiter's labeled series"""
+        for metric, labels in [(self.limit_gauge, (self.name,)),
+                               (self.in_flight_gauge, (self.name,))] + \
+                [(self.rejections, (self.name, reason)) for reason in ('queue_full', 'timeout', 'cancelled')]:
+            try:
+                metric.remove(*labels)
+            except KeyError:
+                pass
+    
+    def get_state(self) -> Dict[str, Any]:
+        """Get limiter state"""
+        with self._lock:
+            return {
+                'name': self.name,
+                'algorithm': self.algorithm,
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'queued': len(self._waiters),
+                'rejected_queue_full': self.stats['queue_full'],
+                'rejected_timeout': self.stats['timeout']
+            }
+
+class IntelligentCircuitBreaker:
+    """
+    Advanced circuit breaker with intelligent recovery strategies
+    
+    Features:
+    - Adaptive failure thresholds
+    - Exponential backoff with jitter
+    - Health check integration
+    - Metrics collection
+    - Multiple recovery strategies
+    - Thread-safe state transitions
+    - Sliding-window failure-rate and slow-call-rate tripping
+    - Sync and async calls, usable as a decorator
+    - Limited concurrent probes in HALF_OPEN; excess callers fail fast
+    - Optional adaptive concurrency limiter applied to admitted calls
+    
+    With window_type=None the breaker trips on its decaying failure count.
+    With window_type='count' (last window_size calls) or 'time' (last
+    window_size seconds) it trips once at least minimum_calls are in the
+    window and the failure rate or slow-call rate reaches its threshold.
+    """
+    
+    def __init__(self, name: str, failure_threshold: int = 5, 
+                 recovery_timeout: int = 60, expected_exception: type = Exception,
+                 window_type: Optional[str] = None, window_size: int = 100,
+                 failure_rate_threshold: float = 0.5, slow_call_threshold: Optional[float] = None,
+                 slow_call_rate_threshold: float = 1.0, minimum_calls: int = 20,
+                 half_open_max_calls: int = 3,
+                 concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.expected_exception = expected_exception
+        
+        self.failure_count = 0
+        self.success_count = 0
+        self.last_failure_time = None
+        self.last_success_time = None
+        self.state = None
+        
+        # Adaptive thresholds
+        self.adaptive_threshold = failure_threshold
+        self.consecutive_successes = 0
+        
+        # Sliding window
+        if window_type == 'count':
+            self.window = _CountWindow(window_size)
+        elif window_type == 'time':
+            self.window = _TimeWindow(window_size)
+        elif window_type is None:
+            self.window = None
+        else:
+            raise ValueError(f"Unsupported window type: {window_type}")
+        self.window_type = window_type
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_threshold = slow_call_threshold
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.minimum_calls = minimum_calls
+        
+        # Probes allowed through concurrently while HALF_OPEN
+        self.half_open_max_calls = half_open_max_calls
+        self._half_open_in_flight = 0
+        
+        # Bulkhead for calls the breaker admits; shed calls are not failures
+        self.concurrency_limiter = concurrency_limiter
+        
+        # Guards state, counters and the window; never held while calling func
+        self._lock = threading.Lock()
+        
+        # Metrics
+        self.circuit_breaker_state = shared_metric(
+            Gauge,
+            'circuit_breaker_state',
+            'Circuit breaker state (0=closed, 1=open, 2=half_open)',
+            ['name']
+        )
+        self.circuit_breaker_failures = shared_metric(
+            Counter,
+            'circuit_breaker_failures_total',
+            'Total circuit breaker failures',
+            ['name']
+        )
+        self.circuit_breaker_requests = shared_metric(
+            Counter,
+            'circuit_breaker_requests_total',
+            'Total circuit breaker requests',
+            ['name', 'result']
+        )
+        self._state_gauge = self.circuit_breaker_state.labels(name=self.name)
+        self._failures_counter = self.circuit_breaker_failures.labels(name=self.name)
+        self._request_counters: Dict[str, Any] = {}
+        self._set_state(CircuitBreakerState.CLOSED)
+    
+    def __call__(self, func):
+        """Decorator implementation"""
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                return await self.call_async(func, *args, **kwargs)
+            return async_wrapper
+        else:
+            @wraps(func)
+            def sync_wrapper(*args, **kwargs):
+                return self.call(func, *args, **kwargs)
+            return sync_wrapper
+    
+    def call(self, func: Callable, *args, **kwargs) -> Any:
+        """Execute function with circuit breaker protection"""
+        probe = self._acquire_permission()
+        limiter = self.concurrency_limiter
+        if limiter is not None and not limiter.acquire():
+            self._shed(probe)
+        
+        start = time.perf_counter() if self.slow_call_threshold is not None or limiter else 0.0
+        failed = False
+        try:
+            result = func(*args, **kwargs)
+        except self.expected_exception as e:
+            failed = True
+            self._on_failure()
+            self._count_request('failure')
+            raise e
+        finally:
+            if probe:
+                self._release_probe()
+            if limiter is not None:
+                limiter.release(time.perf_counter() - start, failed)
+        
+        self._record_success(start)
+        return result
+    
+    async def call_async(self, func: Callable, *args, **kwargs) -> Any:
+        """Await a coroutine function with circuit breaker protection"""
+        probe = self._acquire_permission()
+        limiter = self.concurrency_limiter
+        if limiter is not None:
+            try:
+                admitted = await limiter.acquire_async()
+            except BaseException:
+                if probe:
+                    self._release_probe()
+                raise
+            if not admitted:
+                self._shed(probe)
+        
+        start = time.perf_counter() if self.slow_call_threshold is not None or limiter else 0.0
+        failed = False
+        try:
+            result = await func(*args, **kwargs)
+        except self.expected_exception as e:
+            failed = True
+            self._on_failure()
+            self._count_request('failure')
+            raise e
+        finally:
+            if probe:
+                self._release_probe()
+            if limiter is not None:
+                limiter.release(time.perf_counter() - start, failed)
+        
+        self._record_success(start)
+        return result
+    
+    def _acquire_permission(self) -> bool:
+        """
+        Admit or reject a call. Returns True if the call is a HALF_OPEN probe
+        that must be released; raises CircuitBreakerOpenError if rejected.
+        """
+        # Lock-free fast path for the common case
+        if self.state == CircuitBreakerState.CLOSED:
+            return False
+        
+        with self._lock:
+            if self.state == CircuitBreakerState.OPEN and self._should_attempt_reset():
+                self._set_state(CircuitBreakerState.HALF_OPEN)
+                self.consecutive_successes = 0
+                self._half_open_in_flight = 0
+            
+            if self.state == CircuitBreakerState.CLOSED:
+                return False
+            if (self.state == CircuitBreakerState.HALF_OPEN and
+                    self._half_open_in_flight < self.half_open_max_calls):
+                self._half_open_in_flight += 1
+                return True
+            result = 'circuit_open' if self.state == CircuitBreakerState.OPEN else 'half_open_rejected'
+        
+        self._count_request(result)
+        raise CircuitBreakerOpenError(
+            f"Circuit breaker {self.name} is OPEN" if result == 'circuit_open'
+            else f"Circuit breaker {self.name} is HALF_OPEN with "
+                 f"{self.half_open_max_calls} probes in flight"
+        )
+    
+    def _release_probe(self):
+        with self._lock:
+            self._half_open_in_flight = max(0, self._half_open_in_flight - 1)
+    
+    def _shed(self, probe: bool):
+        """Reject a call the concurrency limiter could not admit"""
+        if probe:
+            self._release_probe()
+        self._count_request('shed')
+        raise ConcurrencyLimitExceeded(
+            f"Concurrency limit {int(self.concurrency_limiter.limit)} reached for {self.name}"
+        )
+    
+    def _record_success(self, start: float):
+        slow = (self.slow_call_threshold is not None and
+                time.perf_counter() - start >= self.slow_call_threshold)
+        self._on_success(slow)
+        self._count_request('success')
+    
+    def _count_request(self, result: str):
+        counter = self._request_counters.get(result)
+        if counter is None:
+            counter = self._request_counters[result] = self.circuit_breaker_requests.labels(
+                name=self.name, result=result
+            )
+        counter.inc()
+    
+    def _should_attempt_reset(self) -> bool:
+        """Check if enough time has passed to attempt reset"""
+        if self.last_failure_time is None:
+            return True
+        
+        # Exponential backoff with jitter
+        base_timeout = self.recovery_timeout
+        exponential_factor = min(2 ** (self.failure_count // self.failure_threshold), 16)
+        jitter = time.time() % 10  # Add up to 10 seconds of jitter
+        
+        timeout = base_timeout * exponential_factor + jitter
+        return (time.time() - self.last_failure_time) >= timeout
+    
+    def _on_success(self, slow: bool = False):
+        """Handle successful call"""
+        with self._lock:
+            self.success_count += 1
+            self.last_success_time = time.time()
+            self.consecutive_successes += 1
+            if self.window is not None:
+                self.window.record(_OUTCOME_SLOW if slow else 0)
+            
+            if self.state == CircuitBreakerState.HALF_OPEN:
+                # Need multiple successes to close circuit
+                if self.consecutive_successes >= 3:
+                    self._set_state(CircuitBreakerState.CLOSED)
+                    self.failure_count = 0
+                    self.consecutive_successes = 0
+                    if self.window is not None:
+                        self.window.reset()
+            elif self.state == CircuitBreakerState.CLOSED:
+                if self.window is not None:
+                    # Slow successes can trip the breaker too
+                    if slow:
+                        self._evaluate_window()
+                elif self.failure_count > 0:
+                    # Reset failure count on success
+                    self.failure_count = max(0, self.failure_count - 1)
+    
+    def _on_failure(self):
+        """Handle failed call"""
+        with self._lock:
+            self.failure_count += 1
+            self.last_failure_time = time.time()
+            self.consecutive_successes = 0
+            
+            if self.window is not None:
+                self.window.record(_OUTCOME_FAILURE)
+                if self.state == CircuitBreakerState.HALF_OPEN:
+                    self._trip()
+                elif self.state == CircuitBreakerState.CLOSED:
+                    self._evaluate_window()
+                return
+            
+            # Adaptive threshold adjustment
+            if self.failure_count > self.adaptive_threshold:
+                self.adaptive_threshold = min(
+                    self.adaptive_threshold * 1.2, 
+                    self.failure_threshold * 2
+                )
+            
+            if self.failure_count >= self.adaptive_threshold:
+                self._trip()
+    
+    def _evaluate_window(self):
+        """Trip on failure rate or slow-call rate once minimum_calls is reached"""
+        calls, failures, slow = self.window.totals()
+        if calls < self.minimum_calls:
+            return
+        if (failures / calls >= self.failure_rate_threshold or
+                (self.slow_call_threshold is not None and
+                 slow / calls >= self.slow_call_rate_threshold)):
+            self._trip()
+    
+    def _trip(self):
+        """Open the circuit; caller holds the lock"""
+        self._set_state(CircuitBreakerState.OPEN)
+        self._failures_counter.inc()
+    
+    def _set_state(self, state: str):
+        """Transition state; the state gauge only changes on transitions"""
+        if state != self.state:
+            self.state = state
+            self._update_metrics()
+    
+    def _update_metrics(self):
+        """Update Prometheus metrics"""
+        state_value = {
+            CircuitBreakerState.CLOSED: 0,
+            CircuitBreakerState.OPEN: 1,
+            CircuitBreakerState.HALF_OPEN: 2
+        }[self.state]
+        
+        self._state_gauge.set(state_value)
+    
+    def remove_metrics(self):
+        """Drop this breaker's labeled series, e.g. when a registry evicts it"""
+        for metric, labels in [(self.circuit_breaker_state, (self.name,)),
+                               (self.circuit_breaker_failures, (self.name,))] + \
+                [(self.circuit_breaker_requests, (self.name, result)) for result in self._request_counters]:
+            try:
+                metric.remove(*labels)
+            except KeyError:
+                pass
+        if self.concurrency_limiter is not None:
+            self.concurrency_limiter.remove_metrics()
+    
+    def get_state(self) -> Dict[str, Any]:
+        """Get current circuit breaker state"""
+        with self._lock:
+            state = {
+                'name': self.name,
+                'state': self.state,
+                'failure_count': self.failure_count,
+                'success_count': self.success_count,
+                'adaptive_threshold': self.adaptive_threshold,
+                'last_failure_time': (datetime.fromtimestamp(self.last_failure_time).isoformat()
+                                      if self.last_failure_time else None),
+                'last_success_time': (datetime.fromtimestamp(self.last_success_time).isoformat()
+                                      if self.last_success_time else None)
+            }
+            if self.window is not None:
+                calls, failures, slow = self.window.totals()
+                state['window'] = {
+                    'type': self.window_type,
+                    'calls': calls,
+                    'failure_rate': failures / calls if calls else 0.0,
+                    'slow_call_rate': slow / calls if calls else 0.0
+                }
+        if self.concurrency_limiter is not None:
+            state['concurrency'] = self.concurrency_limiter.get_state()
+        return state
+
+
+class CircuitBreakerRegistry:
+    """
+    Per-target circuit breakers created on demand
+    
+    Features:
+    - One breaker per downstream host or endpoint, created on first use
+    - Shared breaker configuration
+    - Idle eviction of CLOSED breakers and an LRU size cap; tripped (OPEN or
+      HALF_OPEN) breakers are never evicted, so the cap is exceeded (with a
+      warning) only when every other breaker is tripped
+    - Metric series of evicted breakers are removed, keeping cardinality bounded
+    - Optional per-target adaptive concurrency limiter (limiter_kwargs)
+    
+    All breakers report through the shared circuit_breaker_* families, labeled by target.
+    """
+    
+    def __init__(self, max_breakers: int = 10000, idle_timeout: float = 600.0,
+                 sweep_interval: float = 60.0, limiter_kwargs: Optional[Dict[str, Any]] = None,
+                 **breaker_kwargs):
+        self.max_breakers = max_breakers
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self.breaker_kwargs = breaker_kwargs
+        self.limiter_kwargs = limiter_kwargs
+        
+        # target -> [breaker, last_used_monotonic]; ordered least recently used first
+        self._breakers: 'OrderedDict[str, List[Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+        self.evicted = 0
+        self._over_capacity_warned = False
+    
+    def get(self, target: str) -> IntelligentCircuitBreaker:
+        """Get the breaker for a target, creating it if needed"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._breakers.get(target)
+            if entry is None:
+                entry = [self._create_breaker(target), now]
+                self._breakers[target] = entry
+                evicted = self._evict_over_capacity(target)
+            else:
+                entry[1] = now
+                self._breakers.move_to_end(target)
+                evicted = []
+            if now >= self._next_sweep:
+                evicted.extend(self._evict_idle(now))
+                self._next_sweep = now + self.sweep_interval
+            breaker = entry[0]
+        
+        for old in evicted:
+            old.remove_metrics()
+        return breaker
+    
+    def _create_breaker(self, target: str) -> IntelligentCircuitBreaker:
+        limiter = (AdaptiveConcurrencyLimiter(target, **self.limiter_kwargs)
+                   if self.limiter_kwargs is not None else None)
+        return IntelligentCircuitBreaker(target, concurrency_limiter=limiter, **self.breaker_kwargs)
+    
+    def call(self, target: str, func: Callable, *args, **kwargs) -> Any:
+        """Call func through the target's breaker"""
+        return self.get(target).call(func, *args, **kwargs)
+    
+    async def call_async(self, target: str, func: Callable, *args, **kwargs) -> Any:
+        """Await func through the target's breaker"""
+        return await self.get(target).call_async(func, *args, **kwargs)
+    
+    def _evict_over_capacity(self, newest: str) -> List[IntelligentCircuitBreaker]:
+        """Evict least recently used CLOSED breakers; tripped ones keep protecting"""
+        excess = len(self._breakers) - self.max_breakers
+        if excess <= 0:
+            self._over_capacity_warned = False
+            return []
+        
+        victims = []
+        for target, (breaker, _) in self._breakers.items():
+            if len(victims) == excess:
+                break
+            if breaker.state == CircuitBreakerState.CLOSED and target != newest:
+                victims.append(target)
+        evicted = [self._breakers.pop(target)[0] for target in victims]
+        self.evicted += len(evicted)
+        
+        if len(victims) < excess and not self._over_capacity_warned:
+            logging.warning(f"Circuit breaker registry over capacity ({len(self._breakers)} > "
+                            f"{self.max_breakers}): remaining breakers are tripped")
+            self._over_capacity_warned = True
+        return evicted
+    
+    def _evict_idle(self, now: float) -> List[IntelligentCircuitBreaker]:
+        """Evict CLOSED breakers unused for idle_timeout; open ones keep protecting"""
+        evicted = []
+        for target, (breaker, last_used) in list(self._breakers.items()):
+            if now - last_used < self.idle_timeout:
+                break
+            if breaker.state == CircuitBreakerState.CLOSED:
+                del self._breakers[target]
+                evicted.append(breaker)
+        self.evicted += len(evicted)
+        return evicted
+    
+    def remove(self, target: str) -> bool:
+        """Explicitly drop a target's breaker"""
+        with self._lock:
+            entry = self._breakers.pop(target, None)
+        if entry is None:
+            return False
+        entry[0].remove_metrics()
+        return True
+    
+    def __len__(self) -> int:
+        return len(self._breakers)
+    
+    def get_states(self) -> Dict[str, Dict[str, Any]]:
+        """Get the state of every live breaker"""
+        with self._lock:
+            breakers = [entry[0] for entry in self._breakers.values()]
+        return {breaker.name: breaker.get_state() for breaker in breakers}
+
+class RetryBudget:
+    """
+    Token bucket capping retries to a fraction of request volume
+    
+    Every request deposits token_ratio tokens (up to max_tokens) and every
+    retry or hedge withdraws one, so at most ~token_ratio extra load is sent
+    during an outage. min_per_second tokens are refilled over time so low
+    traffic can still retry.
+    """
+    
+    def __init__(self, token_ratio: float = 0.1, max_tokens: float = 100.0,
+                 min_per_second: float = 1.0):
+        self.token_ratio = token_ratio
+        self.max_tokens = max_tokens
+        self.min_per_second = min_per_second
+        self.tokens = max_tokens
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def deposit(self):
+        """Credit one original request"""
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.token_ratio)
+    
+    def try_withdraw(self) -> bool:
+        """Take a token for a retry or hedge; False when the budget is spent"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.max_tokens,
+                              self.tokens + (now - self._last_refill) * self.min_per_second)
+            self._last_refill = now
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return True
+            return False
+
+class ResiliencePolicy:
+    """
+    Retries and hedging layered on a circuit breaker
+    
+    Features:
+    - Retries with decorrelated jitter (sleep = U(base_delay, 3 * previous), capped)
+    - Shared RetryBudget so retries cannot amplify load during outages
+    - Hedged requests for idempotent async calls: a second attempt starts once
+      the first exceeds the observed hedge_quantile latency; the loser is cancelled
+    - Attempt latency tracked in a DDSketch
+    - Calls rejected by the breaker or the concurrency limiter are not retried
+    """
+    
+    def __init__(self, breaker: IntelligentCircuitBreaker, max_attempts: int = 3,
+                 base_delay: float = 0.05, max_delay: float = 2.0,
+                 retry_budget: Optional[RetryBudget] = None,
+                 retry_on: tuple = (Exception,), hedge_quantile: float = 0.95,
+                 hedge_min_samples: int = 20, hedge_min_delay: float = 0.001):
+        self.breaker = breaker
+        self.name = breaker.name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_budget = retry_budget if retry_budget is not None else RetryBudget()
+        self.retry_on = retry_on
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.latency_sketch = DDSketch()
+        self.stats = defaultdict(int)
+        
+        # Metrics
+        self.attempts = shared_metric(
+            Counter,
+            'resilience_attempts_total',
+            'Calls attempted by resilience policies',
+            ['name', 'kind']
+        )
+        self.budget_exhausted = shared_metric(
+            Counter,
+            'resilience_retry_budget_exhausted_total',
+            'Retries or hedges skipped because the retry budget was spent',
+            ['name']
+        )
+        self._attempt_counters = {
+            kind: self.attempts.labels(name=self.name, kind=kind)
+            for kind in ('first', 'retry', 'hedge')
+        }
+        self._budget_exhausted = self.budget_exhausted.labels(name=self.name)
+    
+    def _count_attempt(self, kind: str):
+        self.stats[kind] += 1
+        self._attempt_counters[kind].inc()
+    
+    def _should_retry(self, error: Exception, attempt: int) -> bool:
+        """Retry retryable errors while attempts and budget remain"""
+        if isinstance(error, (CircuitBreakerOpenError, ConcurrencyLimitExceeded)):
+            return False
+        if not isinstance(error, self.retry_on) or attempt >= self.max_attempts:
+            return False
+        if not self.retry_budget.try_withdraw():
+            self.stats['budget_exhausted'] += 1
+            self._budget_exhausted.inc()
+            return False
+        return True
+    
+    def _next_delay(self, previous: float) -> float:
+        """Decorrelated jitter backoff"""
+        return min(self.max_delay, random.uniform(self.base_delay, previous * 3))
+    
+    def hedge_delay(self) -> Optional[float]:
+        """Latency after which a hedge is sent, or None until enough samples exist"""
+        if self.latency_sketch.count < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min_delay, self.latency_sketch.quantile(self.hedge_quantile))
+    
+    def call(self, func: Callable, *args, **kwargs) -> Any:
+        """Call func through the breaker, retrying with backoff"""
+        self.retry_budget.deposit()
+        self._count_attempt('first')
+        attempt = 1
+        delay = self.base_delay
+        while True:
+            start = time.perf_counter()
+            try:
+                result = self.breaker.call(func, *args, **kwargs)
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+                delay = self._next_delay(delay)
+                time.sleep(delay)
+                attempt += 1
+                self._count_attempt('retry')
+                continue
+            self.latency_sketch.add(time.perf_counter() - start)
+            return result
+    
+    async def call_async(self, func: Callable, *args, idempotent: bool = False, **kwargs) -> Any:
+        """
+        Await func through the breaker, retrying with backoff. Idempotent
+        calls are also hedged once the observed latency quantile is known.
+        """
+        self.retry_budget.deposit()
+        self._count_attempt('first')
+        attempt = 1
+        delay = self.base_delay
+        while True:
+            try:
+                if idempotent:
+                    return await self._hedged_attempt(func, args, kwargs)
+                return await self._timed_attempt(func, args, kwargs)
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+                delay = self._next_delay(delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+                self._count_attempt('retry')
+    
+    async def _timed_attempt(self, func: Callable, args: tuple, kwargs: dict) -> Any:
+        start = time.perf_counter()
+        result = await self.breaker.call_async(func, *args, **kwargs)
+        self.latency_sketch.add(time.perf_counter() - start)
+        return result
+    
+    async def _hedged_attempt(self, func: Callable, args: tuple, kwargs: dict) -> Any:
+        """Run one attempt, racing a hedge against it if it runs past the hedge delay"""
+        primary = asyncio.ensure_future(self._timed_attempt(func, args, kwargs))
+        hedge_after = self.hedge_delay()
+        if hedge_after is None:
+            return await primary
+        
+        hedge = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=hedge_after)
+            if done:
+                return primary.result()
+            if not self.retry_budget.try_withdraw():
+                self.stats['budget_exhausted'] += 1
+                self._budget_exhausted.inc()
+                return await primary
+            
+            self._count_attempt('hedge')
+            hedge = asyncio.ensure_future(self._timed_attempt(func, args, kwargs))
+            pending = {primary, hedge}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.stats['hedge_wins'] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # Cancel whichever attempt lost (or both, if we were cancelled)
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get attempt counts and the current hedge delay"""
+        return {
+            'name': self.name,
+            'first_attempts': self.stats['first'],
+            'retries': self.stats['retry'],
+            'hedges': self.stats['hedge'],
+            'hedge_wins': self.stats['hedge_wins'],
+            'budget_exhausted': self.stats['budget_exhausted'],
+            'retry_tokens': self.retry_budget.tokens,
+            'hedge_delay': self.hedge_delay()
+        }
+
+class FakeService:
+    """
+    Local stand-in for a downstream dependency
+    
+    latency is a callable returning seconds per call (e.g.
+    lambda: random.lognormvariate(math.log(0.01), 0.5)); failure_rate is the
+    probability a call raises ConnectionError. Counts calls, in-flight peak
+    and cancellations so retry and hedge behaviour can be asserted.
+    """
+    
+    def __init__(self, latency: Callable[[], float] = lambda: 0.01, failure_rate: float = 0.0,
+                 seed: Optional[int] = None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self.calls = 0
+        self.failures = 0
+        self.cancelled = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._lock = threading.Lock()
+    
+    def _begin(self) -> tuple:
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return self.latency(), self._random.random() < self.failure_rate
+    
+    def _end(self, failed: bool):
+        with self._lock:
+            self.in_flight -= 1
+            self.failures += failed
+        if failed:
+            raise ConnectionError("FakeService injected failure")
+    
+    def call(self, value: Any = None) -> Any:
+        """Blocking request"""
+        latency, failed = self._begin()
+        try:
+            time.sleep(latency)
+        finally:
+            self._end(failed)
+        return value
+    
+    async def call_async(self, value: Any = None) -> Any:
+        """Async request; cancellation is counted"""
+        latency, failed = self._begin()
+        try:
+            await asyncio.sleep(latency)
+        except asyncio.CancelledError:
+            with self._lock:
+                self.in_flight -= 1
+                self.cancelled += 1
+            raise
+        self._end(failed)
+        return value
+
+
+# ============================================================================
+# PATTERN 3: ASYNCHRONOUS METRICS COLLECTOR
+# ============================================================================
+
+@dataclass
+class MetricData:
+    name: str
+    value: float
+    timestamp: datetime
+    labels: Dict[str, str]
+    metric_type: str  # counter, gauge, histogram, summary
+
+DEFAULT_HISTOGRAM_BUCKETS = tuple(b for b in Histogram.DEFAULT_BUCKETS if b != math.inf)
+
+def exponential_buckets(start: float, factor: float, count: int) -> List[float]:
+    """count bucket upper bounds starting at start, each factor times the previous"""
+    if start <= 0 or factor <= 1 or count < 1:
+        raise ValueError("exponential_buckets needs start > 0, factor > 1 and count >= 1")
+    return [start * factor ** i for i in range(count)]
+
+def _format_le(bound: float) -> str:
+    return '+Inf' if bound == math.inf else repr(float(bound))
+
+class _HistogramAggregate:
+    """Shared count/sum/min/max, cumulative buckets and quantile estimation"""
+    
+    __slots__ = ('count', 'sum', 'min', 'max', 'sketch')
+    
+    def __init__(self, sketch: Optional[DDSketch] = None):
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sketch = sketch
+    
+    def _observe_summary(self, value: float):
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if self.sketch is not None:
+            self.sketch.add(value)
+    
+    def bucket_ranges(self) -> List[tuple]:
+        """Non-cumulative (lower, upper, count) buckets in ascending order"""
+        raise NotImplementedError
+    
+    def to_state(self) -> Dict[str, Any]:
+        """JSON-serializable state, for persistence"""
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'sketch': self.sketch.to_dict() if self.sketch is not None else None}
+    
+    def load_state(self, state: Dict[str, Any]):
+        """Restore state produced by to_state"""
+        self.count = state['count']
+        self.sum = state['sum']
+        self.min = state['min']
+        self.max = state['max']
+        if self.sketch is not None and state['sketch'] is not None:
+            self.sketch = DDSketch.from_dict(state['sketch'])
+    
+    def cumulative_buckets(self) -> Dict[str, int]:
+        """Prometheus-style le -> cumulative count, ending with +Inf"""
+        result = {}
+        cumulative = 0
+        for _, upper, count in self.bucket_ranges():
+            cumulative += count
+            result[_format_le(upper)] = cumulative
+        result['+Inf'] = self.count
+        return result
+    
+    def quantile(self, q: float) -> Optional[float]:
+        """Quantile from the sketch if present, else interpolated within buckets"""
+        if self.count == 0:
+            return None
+        if self.sketch is not None:
+            return self.sketch.quantile(q)
+        rank = q * self.count
+        cumulative = 0
+        for lower, upper, count in self.bucket_ranges():
+            if count and cumulative + count >= rank:
+                lower = max(lower, self.min)
+                upper = min(upper, self.max)
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.max
 
-class DistributedTracer:
+class BucketHistogram(_HistogramAggregate):
+    """Histogram over fixed upper bounds; memory is constant per series"""
+    
+    __slots__ = ('bounds', 'counts')
+    
+    def __init__(self, bounds: tuple, sketch: Optional[DDSketch] = None):
+        super().__init__(sketch)
+        self.bounds = bounds
+        # Last slot counts observations above the highest bound (+Inf)
+        self.counts = [0] * (len(bounds) + 1)
+    
+    def observe(self, value: float):
+        """Record one observation"""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self._observe_summary(value)
+    
+    def merge_counts(self, bucket_counts: List[int], count: int, total: float,
+                     minimum: float, maximum: float):
+        """Merge observations already reduced to bucket counts (columnar path)"""
+        counts = self.counts
+        for i, bucket_count in enumerate(bucket_counts):
+            counts[i] += bucket_count
+        self.count += count
+        self.sum += total
+        self.min = min(self.min, minimum)
+        self.max = max(self.max, maximum)
+    
+    def to_state(self) -> Dict[str, Any]:
+        state = super().to_state()
+        state['bounds'] = self.bounds
+        state['counts'] = self.counts
+        return state
+    
+    def load_state(self, state: Dict[str, Any]):
+        if tuple(state['bounds']) != self.bounds:
+            raise ValueError("Histogram bucket bounds differ from the saved state")
+        super().load_state(state)
+        self.counts = list(state['counts'])
+    
+    def bucket_ranges(self) -> List[tuple]:
+        ranges = []
+        lower = -math.inf
+        for upper, count in zip(self.bounds, self.counts):
+            ranges.append((lower, upper, count))
+            lower = upper
+        ranges.append((lower, math.inf, self.counts[-1]))
+        return ranges
+
+class NativeHistogram(_HistogramAggregate):
     """
-    Advanced distributed tracing system with context propagation
+    Sparse exponential histogram in the style of Prometheus native histograms
+    
+    Bucket i covers (base**(i-1), base**i] with base = 2**(2**-schema). When
+    more than max_buckets are populated the schema is lowered, merging
+    neighbouring buckets pairwise, so memory stays bounded while relative
+    resolution degrades gracefully. Intended for non-negative observations
+    such as latencies and sizes; values at or below zero_threshold
+    (including negatives) are counted in the zero bucket.
+    """
+    
+    __slots__ = ('schema', 'max_buckets', 'zero_threshold', 'zero_count', 'buckets')
+    
+    MIN_SCHEMA = -4
+    
+    def __init__(self, schema: int = 3, max_buckets: int = 160, zero_threshold: float = 1e-9,
+                 sketch: Optional[DDSketch] = None):
+        if not self.MIN_SCHEMA <= schema <= 8:
+            raise ValueError(f"Native histogram schema must be in [{self.MIN_SCHEMA}, 8]: {schema}")
+        super().__init__(sketch)
+        self.schema = schema
+        self.max_buckets = max_buckets
+        self.zero_threshold = zero_threshold
+        self.zero_count = 0
+        self.buckets: Dict[int, int] = {}
+    
+    def observe(self, value: float):
+        """Record one observation"""
+        if value <= self.zero_threshold:
+            self.zero_count += 1
+        else:
+            scaled = math.log2(value) * 2.0 ** self.schema
+            index = math.ceil(scaled)
+            if index - scaled < 1e-9 or scaled - index + 1 < 1e-9:
+                # log2 rounding can put a value on a bucket boundary one bucket off
+                if value > self.upper_bound(index):
+                    index += 1
+                elif value <= self.upper_bound(index - 1):
+                    index -= 1
+            buckets = self.buckets
+            buckets[index] = buckets.get(index, 0) + 1
+            if len(buckets) > self.max_buckets and self.schema > self.MIN_SCHEMA:
+                self._reduce_resolution()
+        self._observe_summary(value)
+    
+    def _reduce_resolution(self):
+        """Halve resolution until the bucket count fits"""
+        while len(self.buckets) > self.max_buckets and self.schema > self.MIN_SCHEMA:
+            merged: Dict[int, int] = {}
+            for index, count in self.buckets.items():
+                parent = -((-index) // 2)
+                merged[parent] = merged.get(parent, 0) + count
+            self.buckets = merged
+            self.schema -= 1
+    
+    def to_state(self) -> Dict[str, Any]:
+        state = super().to_state()
+        state['schema'] = self.schema
+        state['zero_count'] = self.zero_count
+        state['buckets'] = list(self.buckets.items())
+        return state
+    
+    def load_state(self, state: Dict[str, Any]):
+        if 'buckets' not in state:
+            raise ValueError("Saved histogram state is not a native histogram")
+        super().load_state(state)
+        self.schema = state['schema']
+        self.zero_count = state['zero_count']
+        self.buckets = {index: count for index, count in state['buckets']}
+        self._reduce_resolution()
+    
+    def upper_bound(self, index: int) -> float:
+        return 2.0 ** (index * 2.0 ** -self.schema)
+    
+    def bucket_ranges(self) -> List[tuple]:
+        ranges = [(-math.inf, self.zero_threshold, self.zero_count)]
+        for index in sorted(self.buckets):
+            ranges.append((self.upper_bound(index - 1), self.upper_bound(index), self.buckets[index]))
+        return ranges
+
+class SharedSeriesWriter:
+    """
+    Single-writer, mmap-backed series table for one worker process
     
     Features:
-    - Trace context propagation
-    - Span lifecycle management
-    - Performance metrics collection
-    - Error tracking and correlation
-    - Sampling strategies
+    - One file per process (metrics_<pid>.db) in a shared directory
+    - Entries are (key, float) pairs; a key names a series field such as
+      a counter value or one histogram bucket, and is appended once
+    - Updates are in-place 8-byte writes, no locks or IPC
+    - A generation counter (odd while a batch is being written) lets
+      readers take consistent snapshots
+    
+    Layout: header (generation, used bytes) then entries of key length,
+    UTF-8 key padded to 8 bytes, and a float64 value.
     """
     
-    def __init__(self, service_name: str, sampling_rate: float = 1.0):
-        self.service_name = service_name
-        self.sampling_rate = sampling_rate
-        self.active_spans: Dict[str, Span] = {}
-        self.completed_spans: List[Span] = []
-        self.trace_context = threading.local()
-        
-        # Metrics
-        self.traces_total = Counter(
-            'traces_total',
-            'Total number of traces',
-            ['service', 'status']
-        )
-        self.span_duration = Histogram(
-            'span_duration_seconds',
-            'Span duration in seconds',
-            ['service', 'operation']
-        )
-        self.active_spans_gauge = Gauge(
-            'active_spans',
-            'Number of active spans',
-            ['service']
-        )
+    HEADER = struct.Struct('<QQ')
+    KEY_LENGTH = struct.Struct('<I')
+    VALUE = struct.Struct('<d')
+    FILE_PREFIX = 'metrics_'
+    FILE_SUFFIX = '.db'
     
-    def start_trace(self, operation_name: str, trace_id: str = None, 
-                   parent_context: Dict = None) -> str:
-        """Start a new trace or span"""
-        import uuid
-        
-        if trace_id is None:
-            trace_id = str(uuid.uuid4())
-        
-        span_id = str(uuid.uuid4())
-        parent_span_id = None
-        
-        # Handle parent context propagation
-        if parent_context:
-            parent_span_id = parent_context.get('span_id')
-            trace_id = parent_context.get('trace_id', trace_id)
-        
-        span = Span(
-            trace_id=trace_id,
-            span_id=span_id,
-            parent_span_id=parent_span_id,
-            operation_name=operation_name,
-            start_time=datetime.now(),
-            end_time=None,
-            tags={'service': self.service_name},
-            logs=[]
-        )
+    def __init__(self, directory: str, initial_size: int = 1024 * 1024):
+        self.pid = os.getpid()
+        self.path = os.path.join(directory, f'{self.FILE_PREFIX}{self.pid}{self.FILE_SUFFIX}')
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, 'w+b')
+        self._size = max(initial_size, 4096)
+        self._file.truncate(self._size)
+        self._map = mmap.mmap(self._file.fileno(), self._size)
+        self._generation = 0
+        self._used = self.HEADER.size
+        self._offsets: Dict[str, int] = {}
+        self.HEADER.pack_into(self._map, 0, self._generation, self._used)
+    
+    def begin(self):
+        """Mark the table as being updated (odd generation)"""
+        self._generation += 1
+        self.HEADER.pack_into(self._map, 0, self._generation, self._used)
+    
+    def commit(self):
+        """Publish updates and new entries (even generation)"""
+        self._generation += 1
+        self.HEADER.pack_into(self._map, 0, self._generation, self._used)
+    
+    def write(self, key: str, value: float):
+        """Set a field's value, appending the entry on first write"""
+        offset = self._offsets.get(key)
+        if offset is None:
+            offset = self._append(key)
+        self.VALUE.pack_into(self._map, offset, value)
+    
+    def _append(self, key: str) -> int:
+        encoded = key.encode('utf-8')
+        padded = (self.KEY_LENGTH.size + len(encoded) + 7) & ~7
+        needed = self._used + padded + self.VALUE.size
+        if needed > self._size:
+            self._grow(needed)
+        self.KEY_LENGTH.pack_into(self._map, self._used, len(encoded))
+        start = self._used + self.KEY_LENGTH.size
+        self._map[start:start + len(encoded)] = encoded
+        value_offset = self._used + padded
+        self._used = value_offset + self.VALUE.size
+        self._offsets[key] = value_offset
+        return value_offset
+    
+    def _grow(self, needed: int):
+        while self._size < needed:
+            self._size *= 2
+        self._map.close()
+        self._file.truncate(self._size)
+        self._map = mmap.mmap(self._file.fileno(), self._size)
+    
+    def close(self):
+        self._map.close()
+        self._file.close()
+    
+    @classmethod
+    def read_file(cls, path: str, retries: int = 10) -> Dict[str, float]:
+        """Read a consistent snapshot of one worker's table"""
+        with open(path, 'rb') as f:
+            for attempt in range(retries):
+                f.seek(0)
+                data = f.read()
+                if len(data) < cls.HEADER.size:
+                    return {}
+                generation, used = cls.HEADER.unpack_from(data, 0)
+                f.seek(0)
+                if generation % 2 == 0 and cls.HEADER.unpack(f.read(cls.HEADER.size))[0] == generation:
+                    break
+                time.sleep(0.001 * (attempt + 1))
+            else:
+                logging.warning(f"Metrics file {path} kept changing; using last read")
         
-        self.active_spans[span_id] = span
-        self.trace_context.span = span
+        values = {}
+        offset = cls.HEADER.size
+        used = min(used, len(data))
+        while offset + cls.KEY_LENGTH.size <= used:
+            (length,) = cls.KEY_LENGTH.unpack_from(data, offset)
+            start = offset + cls.KEY_LENGTH.size
+            padded = (cls.KEY_LENGTH.size + length + 7) & ~7
+            value_offset = offset + padded
+            if value_offset + cls.VALUE.size > used:
+                break
+            key = data[start:start + length].decode('utf-8')
+            values[key] = cls.VALUE.unpack_from(data, value_offset)[0]
+            offset = value_offset + cls.VALUE.size
+        return values
+
+_NO_LABELS = frozenset()
+
+# Metric type codes packed into the low bits of columnar series keys
+_TYPE_CODES = {'counter': 0, 'gauge': 1, 'histogram': 2}
+_TYPE_NAMES = tuple(_TYPE_CODES)
+_UNKNOWN_TYPE = 3
+_SAMPLE_NAME, _SAMPLE_VALUE, _SAMPLE_LABELS, _SAMPLE_TYPE, _SAMPLE_TIMESTAMP = (
+    itemgetter(0), itemgetter(1), itemgetter(2), itemgetter(3), itemgetter(4)
+)
+
+class MetricsWAL:
+    """
+    Write-ahead log and compact snapshots of aggregated collector state
+    
+    Features:
+    - One append-only record per flush holding every series the flush
+      touched; values are absolute, so replaying a record twice is harmless
+    - Group commit: records are buffered and written with one write (and
+      optional fsync) per commit_interval, not per flush or sample
+    - Periodic snapshots of all series; superseded snapshots and logs are removed
+    - CRC-checked records; a torn or corrupt tail is ignored on replay
+    
+    Files are numbered by generation: snapshot-<gen>.bin is the full state
+    at the moment wal-<gen>.log was started. Recovery loads the newest
+    readable snapshot and replays every log of that generation or later.
+    Series ids are only meaningful within one file, so each file defines
+    the series it references before using them.
+    
+    Record layout: header (payload length, crc32) then a payload of series
+    definitions, packed scalar columns (series id, type, value, count, last
+    update) and JSON histogram states. Definitions are one block: packed
+    (id, name index, label key length) columns, a JSON list of distinct
+    names, and every label key joined into one JSON array, so a single
+    json.loads yields all label dicts and the keys are sliced, not re-encoded.
+    """
+    
+    RECORD_HEADER = struct.Struct('<II')
+    # definitions, names bytes, label keys bytes, scalar rows, histogram bytes
+    PAYLOAD_HEADER = struct.Struct('<IIIII')
+    WAL_PREFIX = 'wal-'
+    WAL_SUFFIX = '.log'
+    SNAPSHOT_PREFIX = 'snapshot-'
+    SNAPSHOT_SUFFIX = '.bin'
+    
+    def __init__(self, directory: str, commit_interval: float = 1.0,
+                 snapshot_interval: float = 300.0, max_wal_bytes: int = 64 * 1024 * 1024,
+                 fsync: bool = True):
+        self.directory = directory
+        self.commit_interval = commit_interval
+        self.snapshot_interval = snapshot_interval
+        self.max_wal_bytes = max_wal_bytes
+        self.fsync = fsync
         
-        # Update metrics
-        self.active_spans_gauge.labels(service=self.service_name).set(len(self.active_spans))
+        # Series ids defined in the log that buffered records will be written to
+        self.defined: set = set()
+        self.wal_bytes = 0
+        self.last_commit = time.time()
+        self.last_snapshot = time.time()
+        self._pending: List[bytes] = []
+        self._file = None
         
-        return span_id
+        os.makedirs(directory, exist_ok=True)
+        self.generation = max(self._generations(self.WAL_PREFIX, self.WAL_SUFFIX) +
+                              self._generations(self.SNAPSHOT_PREFIX, self.SNAPSHOT_SUFFIX), default=-1)
     
-    def finish_span(self, span_id: str, status: str = 'success', 
-                   error: Exception = None) -> Optional[Span]:
-        """Finish a span and move to completed spans"""
-        if span_id not in self.active_spans:
-            return None
-        
-        span = self.active_spans[span_id]
-        span.end_time = datetime.now()
-        span.status = status
+    def _generations(self, prefix: str, suffix: str) -> List[int]:
+        return sorted(int(name[len(prefix):-len(suffix)]) for name in os.listdir(self.directory)
+                      if name.startswith(prefix) and name.endswith(suffix))
+    
+    def _path(self, prefix: str, generation: int, suffix: str) -> str:
+        return os.path.join(self.directory, f'{prefix}{generation:08d}{suffix}')
+    
+    def _read_records(self, path: str) -> List[bytes]:
+        with open(path, 'rb') as f:
+            data = f.read()
+        records = []
+        offset = 0
+        header_size = self.RECORD_HEADER.size
+        while offset + header_size <= len(data):
+            length, crc = self.RECORD_HEADER.unpack_from(data, offset)
+            payload = data[offset + header_size:offset + header_size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                logging.warning(f"Metrics WAL {path}: ignoring torn or corrupt data at offset {offset}")
+                break
+            records.append(payload)
+            offset += header_size + length
+        return records
+    
+    def replay(self) -> Iterator[List[bytes]]:
+        """Record payloads per file, newest snapshot first, then later logs in order"""
+        start = None
+        for generation in reversed(self._generations(self.SNAPSHOT_PREFIX, self.SNAPSHOT_SUFFIX)):
+            records = self._read_records(self._path(self.SNAPSHOT_PREFIX, generation, self.SNAPSHOT_SUFFIX))
+            if records:
+                start = generation
+                yield records
+                break
         
-        if error:
-            span.tags['error'] = True
-            span.tags['error.message'] = str(error)
-            span.tags['error.type'] = type(error).__name__
-            self._add_log(span, 'error', {'error': str(error)})
+        for generation in self._generations(self.WAL_PREFIX, self.WAL_SUFFIX):
+            if start is None or generation >= start:
+                path = self._path(self.WAL_PREFIX, generation, self.WAL_SUFFIX)
+                self.wal_bytes += os.path.getsize(path)
+                yield self._read_records(path)
+    
+    @classmethod
+    def encode(cls, series: 'SeriesTable', aggregated: Dict[int, Dict], series_ids: Iterable[int],
+               defined: set) -> bytes:
+        """Payload for the given series, defining any not yet in defined"""
+        defined_ids = array('I')
+        name_index = array('I')
+        key_lengths = array('I')
+        name_codes: Dict[str, int] = {}
+        label_keys = []
+        ids = array('I')
+        types = array('B')
+        values = array('d')
+        counts = array('q')
+        stamps = array('d')
+        histograms = []
         
-        # Calculate duration
-        duration = (span.end_time - span.start_time).total_seconds()
+        for series_id in series_ids:
+            data = aggregated.get(series_id)
+            if data is None:
+                continue
+            if series_id not in defined:
+                defined.add(series_id)
+                name = series.names[series_id]
+                code = name_codes.get(name)
+                if code is None:
+                    code = name_codes[name] = len(name_codes)
+                label_key = series.label_keys[series_id]
+                defined_ids.append(series_id)
+                name_index.append(code)
+                key_lengths.append(len(label_key))
+                label_keys.append(label_key)
+            histogram = data.get('histogram')
+            if histogram is not None:
+                histograms.append((series_id, data['last_update'], histogram.to_state()))
+            else:
+                ids.append(series_id)
+                types.append(_TYPE_CODES[data['type']])
+                values.append(data['value'])
+                counts.append(data['count'])
+                stamps.append(data['last_update'])
         
-        # Update metrics
-        self.span_duration.labels(
-            service=self.service_name,
-            operation=span.operation_name
-        ).observe(duration)
+        # Label keys are ASCII JSON (ensure_ascii), so lengths are byte lengths
+        names_blob = json.dumps(list(name_codes)).encode('utf-8') if name_codes else b''
+        keys_blob = ('[' + ','.join(label_keys) + ']').encode('ascii') if label_keys else b''
+        histograms_blob = json.dumps(histograms).encode('utf-8') if histograms else b''
+        header = cls.PAYLOAD_HEADER.pack(len(defined_ids), len(names_blob), len(keys_blob),
+                                         len(ids), len(histograms_blob))
+        return b''.join((header, defined_ids.tobytes(), name_index.tobytes(), key_lengths.tobytes(),
+                         names_blob, keys_blob, ids.tobytes(), types.tobytes(), values.tobytes(),
+                         counts.tobytes(), stamps.tobytes(), histograms_blob))
+    
+    @classmethod
+    def decode(cls, payload: bytes) -> Tuple[tuple, tuple, list]:
+        """
+        ((ids, names, labels, label keys), scalar columns, histogram states)
+        from an encoded payload
+        """
+        defined, names_size, keys_size, rows, histograms_size = cls.PAYLOAD_HEADER.unpack_from(payload)
+        offset = cls.PAYLOAD_HEADER.size
         
-        self.traces_total.labels(
-            service=self.service_name,
-            status=status
-        ).inc()
+        def read_column(typecode: str, count: int) -> array:
+            nonlocal offset
+            column = array(typecode)
+            end = offset + count * column.itemsize
+            column.frombytes(payload[offset:end])
+            offset = end
+            return column
         
-        # Move to completed spans
-        self.completed_spans.append(span)
-        del self.active_spans[span_id]
+        defined_ids, name_index, key_lengths = (read_column('I', defined) for _ in range(3))
+        names, labels, label_keys = [], [], []
+        if defined:
+            name_table = json.loads(payload[offset:offset + names_size])
+            offset += names_size
+            text = payload[offset:offset + keys_size].decode('ascii')
+            offset += keys_size
+            names = list(map(name_table.__getitem__, name_index))
+            labels = json.loads(text)
+            starts = list(accumulate((length + 1 for length in key_lengths), initial=1))
+            label_keys = list(map(text.__getitem__, map(slice, starts, map(int.__add__, starts, key_lengths))))
         
-        # Update active spans gauge
-        self.active_spans_gauge.labels(service=self.service_name).set(len(self.active_spans))
+        columns = tuple(read_column(typecode, rows) for typecode in 'IBdqd')
         
-        return span
+        histograms = json.loads(payload[offset:offset + histograms_size]) if histograms_size else []
+        return (defined_ids, names, labels, label_keys), columns, histograms
     
-    def add_tag(self, span_id: str, key: str, value: Any):
-        """Add tag to span"""
-        if span_id in self.active_spans:
-            self.active_spans[span_id].tags[key] = value
+    def _open(self, generation: int):
+        if self._file is not None:
+            self._file.close()
+        self.generation = generation
+        self._file = open(self._path(self.WAL_PREFIX, generation, self.WAL_SUFFIX), 'ab')
     
-    def add_log(self, span_id: str, event: str, fields: Dict[str, Any] = None):
-        """Add log entry to span"""
-        if span_id in self.active_spans:
-            self._add_log(self.active_spans[span_id], event, fields or {})
+    def append(self, payload: bytes):
+        """Buffer a record until the next commit"""
+        self._pending.append(self.RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+        self._pending.append(payload)
     
-    def _add_log(self, span: Span, event: str, fields: Dict[str, Any]):
-        """Internal method to add log to span"""
-        log_entry = {
-            'timestamp': datetime.now().isoformat(),
-            'event': event,
-            'fields': fields
-        }
-        span.logs.append(log_entry)
+    def commit(self):
+        """Write buffered records in one write and make them durable"""
+        self.last_commit = time.time()
+        if not self._pending:
+            return
+        if self._file is None:
+            self._open(self.generation + 1)
+        data = b''.join(self._pending)
+        self._pending.clear()
+        self._file.write(data)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.wal_bytes += len(data)
     
-    def get_trace_context(self) -> Dict[str, str]:
-        """Get current trace context for propagation"""
-        if hasattr(self.trace_context, 'span'):
-            span = self.trace_context.span
-            return {
-                'trace_id': span.trace_id,
-                'span_id': span.span_id
-            }
-        return {}
+    def commit_due(self, now: float) -> bool:
+        return now - self.last_commit >= self.commit_interval
     
-    def inject_headers(self, headers: Dict[str, str] = None) -> Dict[str, str]:
-        """Inject trace context into HTTP headers"""
-        if headers is None:
-            headers = {}
-        
-        context = self.get_trace_context()
-        if context:
-            headers['X-Trace-ID'] = context['trace_id']
-            headers['X-Span-ID'] = context['span_id']
-        
-        return headers
+    def snapshot_due(self, now: float) -> bool:
+        return now - self.last_snapshot >= self.snapshot_interval or self.wal_bytes >= self.max_wal_bytes
     
-    def extract_context(self, headers: Dict[str, str]) -> Dict[str, str]:
-        """Extract trace context from HTTP headers"""
-        return {
-            'trace_id': headers.get('X-Trace-ID'),
-            'span_id': headers.get('X-Span-ID')
-        }
+    def rotate(self):
+        """Commit and start a new log generation; its snapshot must follow"""
+        self.commit()
+        # Records encoded from here on go to the new log, which defines its series again
+        self.defined = set()
+        self._open(self.generation + 1)
     
-    def get_trace_summary(self, trace_id: str) -> Dict[str, Any]:
-        """Get summary of a complete trace"""
-        trace_spans = [s for s in self.completed_spans if s.trace_id == trace_id]
-        
-        if not trace_spans:
-            return {'error': 'Trace not found'}
-        
-        # Calculate trace metrics
-        start_time = min(s.start_time for s in trace_spans)
-        end_time = max(s.end_time for s in trace_spans if s.end_time)
-        duration = (end_time - start_time).total_seconds() if end_time else None
-        
-        # Build span hierarchy
-        span_map = {s.span_id: s for s in trace_spans}
-        root_spans = [s for s in trace_spans if s.parent_span_id is None]
+    def write_snapshot(self, payload: bytes):
+        """Atomically write the snapshot for the current generation and drop older files"""
+        path = self._path(self.SNAPSHOT_PREFIX, self.generation, self.SNAPSHOT_SUFFIX)
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(self.RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+            f.write(payload)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(temporary, path)
         
-        return {
-            'trace_id': trace_id,
-            'service': self.service_name,
-            'start_time': start_time.isoformat(),
-            'end_time': end_time.isoformat() if end_time else None,
-            'duration': duration,
-            'span_count': len(trace_spans),
-            'root_spans': [asdict(s) for s in root_spans],
-            'status': 'success' if all(s.status == 'success' for s in trace_spans) else 'error'
-        }
-
-
-# ============================================================================
-# PATTERN 2: CIRCUIT BREAKER WITH INTELLIGENT RECOVERY
-# ============================================================================
+        for prefix, suffix in ((self.WAL_PREFIX, self.WAL_SUFFIX), (self.SNAPSHOT_PREFIX, self.SNAPSHOT_SUFFIX)):
+            for generation in self._generations(prefix, suffix):
+                if generation < self.generation:
+                    os.remove(self._path(prefix, generation, suffix))
+        self.wal_bytes = 0
+        self.last_snapshot = time.time()
+    
+    def close(self):
+        """Commit pending records and close the log"""
+        self.commit()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        # A later commit opens a new log, so later records must define their series
+        self.defined = set()
 
-class CircuitBreakerState:
-    CLOSED = "closed"      # Normal operation
-    OPEN = "open"          # Circuit is open, failing fast
-    HALF_OPEN = "half_open"  # Testing if service is back
+class _ColumnBuffers:
+    """Preallocated series_id/value/timestamp columns reused across batches"""
+    
+    __slots__ = ('capacity', 'keys', 'values', 'timestamps')
+    
+    def __init__(self, capacity: int):
+        self.capacity = 0
+        self.reserve(capacity)
+    
+    def reserve(self, size: int):
+        """Grow (doubling) so at least size samples fit"""
+        if size <= self.capacity:
+            return
+        self.capacity = max(size, 2 * self.capacity)
+        self.keys = np.empty(self.capacity, dtype=np.int64)
+        self.values = np.empty(self.capacity, dtype=np.float64)
+        self.timestamps = np.empty(self.capacity, dtype=np.float64)
 
-class IntelligentCircuitBreaker:
+class SeriesTable:
     """
-    Advanced circuit breaker with intelligent recovery strategies
+    Interns (metric name, label set) pairs into dense integer series ids
     
     Features:
-    - Adaptive failure thresholds
-    - Exponential backoff with jitter
-    - Health check integration
-    - Metrics collection
-    - Multiple recovery strategies
+    - One frozenset per sample on the hot path, no serialization
+    - Ids are assigned once per unique series and never reused
+    - Series metadata (name, labels, canonical label key) kept in id-indexed lists
+    - Optional global and per-metric series limits: past a metric's limit the
+      labels with the most distinct values are folded to OVERFLOW_VALUE, so
+      low-cardinality labels survive; new metric names beyond the global
+      limit are rejected and the caller records them under overflow_series()
+    - Rejected metric names are counted in a bounded heavy-hitter table so
+      top_offenders() can name them
+    
+    Overflow series are created past the limits (at most
+    OVERFLOW_SERIES_PER_METRIC per metric plus one per label schema, and one
+    shared series per metric type), so len() may exceed max_series by the
+    number of such series.
     """
     
-    def __init__(self, name: str, failure_threshold: int = 5, 
-                 recovery_timeout: int = 60, expected_exception: type = Exception):
-        self.name = name
-        self.failure_threshold = failure_threshold
-        self.recovery_timeout = recovery_timeout
-        self.expected_exception = expected_exception
-        
-        self.failure_count = 0
-        self.success_count = 0
-        self.last_failure_time = None
-        self.last_success_time = None
-        self.state = CircuitBreakerState.CLOSED
+    OVERFLOW_VALUE = '__overflow__'
+    OVERFLOW_METRIC = 'metrics_overflow'
+    OVERFLOW_SERIES_PER_METRIC = 10
+    TRACKED_REJECTED_NAMES = 64
+    
+    def __init__(self, max_series: Optional[int] = None, max_series_per_metric: Optional[int] = None,
+                 on_reject: Optional[Callable[[str, str], None]] = None):
+        self._ids: Dict[str, Dict[frozenset, int]] = {}
+        self.names: List[str] = []
+        self.labels: List[Dict[str, str]] = []
+        self.label_keys: List[str] = []
+        self.max_series = max_series
+        self.max_series_per_metric = max_series_per_metric
+        self.on_reject = on_reject
+        # Samples redirected per known metric, and samples for new metric names
+        # rejected (total, plus approximate per-name counts for the worst offenders)
+        self.rejected: Dict[str, int] = {}
+        self.rejected_new_metrics = 0
+        self.rejected_names: Dict[str, int] = {}
+        # Per overflowing metric: distinct values per label when the limit was hit
+        self._cardinality: Dict[str, Dict[str, int]] = {}
+        self._overflow_series: Dict[str, int] = {}
+    
+    def intern(self, name: str, labels: Optional[Dict[str, str]], samples: int = 1) -> Optional[int]:
+        """
+        Get the series id for name and labels, assigning one if new (None if
+        rejected). samples is how many samples a rejection accounts for.
+        """
+        by_labels = self._ids.get(name)
+        key = frozenset(labels.items()) if labels else _NO_LABELS
+        if by_labels is not None:
+            series_id = by_labels.get(key)
+            if series_id is not None:
+                return series_id
+        return self._admit(name, labels or {}, key, by_labels, samples=samples)
+    
+    def intern_canonical(self, name: str, labels: Dict[str, str], label_key: str) -> Optional[int]:
+        """intern() for sorted labels with their label key already serialized (e.g. by the WAL)"""
+        by_labels = self._ids.get(name)
+        key = frozenset(labels.items()) if labels else _NO_LABELS
+        if by_labels is not None:
+            series_id = by_labels.get(key)
+            if series_id is not None:
+                return series_id
+        return self._admit(name, labels, key, by_labels, label_key)
+    
+    def intern_many(self, names: List[str], labels: List[Dict[str, str]],
+                    label_keys: List[str]) -> List[Optional[int]]:
+        """
+        Bulk intern_canonical. An empty table whose limits admit every
+        series is filled in one pass, without per-series lookups.
+        """
+        if self.names or (self.max_series is not None and len(names) > self.max_series):
+            return list(map(self.intern_canonical, names, labels, label_keys))
         
-        # Adaptive thresholds
-        self.adaptive_threshold = failure_threshold
-        self.consecutive_successes = 0
+        keys = list(map(frozenset, map(dict.items, labels)))
+        series_ids = range(len(names))
+        index: Dict[str, Dict[frozenset, int]] = {}
+        # Group positions by name so each metric's index is built by one dict() call
+        for name, positions in groupby(sorted(series_ids, key=names.__getitem__), key=names.__getitem__):
+            positions = list(positions)
+            index[name] = dict(zip(map(keys.__getitem__, positions), positions))
+        if (sum(map(len, index.values())) != len(names) or (self.max_series_per_metric is not None and
+                max(map(len, index.values())) > self.max_series_per_metric)):
+            # Duplicates or a metric over its limit: take the checked path
+            return list(map(self.intern_canonical, names, labels, label_keys))
         
-        # Metrics
-        self.circuit_breaker_state = Gauge(
-            'circuit_breaker_state',
-            'Circuit breaker state (0=closed, 1=open, 2=half_open)',
-            ['name']
-        )
-        self.circuit_breaker_failures = Counter(
-            'circuit_breaker_failures_total',
-            'Total circuit breaker failures',
-            ['name']
-        )
-        self.circuit_breaker_requests = Counter(
-            'circuit_breaker_requests_total',
-            'Total circuit breaker requests',
-            ['name', 'result']
-        )
+        self._ids = index
+        self.names.extend(names)
+        self.labels.extend(labels)
+        self.label_keys.extend(label_keys)
+        return list(series_ids)
     
-    def call(self, func: Callable, *args, **kwargs) -> Any:
-        """Execute function with circuit breaker protection"""
-        self._update_metrics()
-        
-        if self.state == CircuitBreakerState.OPEN:
-            if self._should_attempt_reset():
-                self.state = CircuitBreakerState.HALF_OPEN
-                self.consecutive_successes = 0
-            else:
-                self.circuit_breaker_requests.labels(
-                    name=self.name, result='circuit_open'
-                ).inc()
-                raise Exception(f"Circuit breaker {self.name} is OPEN")
+    def _admit(self, name: str, labels: Dict[str, str], key: frozenset, by_labels: Optional[Dict[frozenset, int]],
+               label_key: Optional[str] = None, samples: int = 1) -> Optional[int]:
+        if self.max_series is not None and len(self.names) >= self.max_series:
+            limit = 'global'
+        elif (by_labels is not None and self.max_series_per_metric is not None
+              and len(by_labels) >= self.max_series_per_metric):
+            limit = 'metric'
+        else:
+            if by_labels is None:
+                by_labels = self._ids[name] = {}
+            series_id = by_labels[key] = self._add(name, labels, label_key)
+            return series_id
         
-        try:
-            result = func(*args, **kwargs)
-            self._on_success()
-            self.circuit_breaker_requests.labels(
-                name=self.name, result='success'
-            ).inc()
-            return result
-            
-        except self.expected_exception as e:
-            self._on_failure()
-            self.circuit_breaker_requests.labels(
-                name=self.name, result='failure'
-            ).inc()
-            raise e
+        # Rejected keys are not cached, so exploding labels cost no memory
+        if self.on_reject is not None:
+            self.on_reject(name, limit, samples)
+        if by_labels is None:
+            if self.rejected_new_metrics == 0:
+                logging.warning(f"Series limit ({limit}) reached; new metric names such as {name} "
+                                f"go to the {self.OVERFLOW_METRIC}_<type> series")
+            self.rejected_new_metrics += samples
+            self._count_rejected_name(name, samples)
+            return None
+        rejected = self.rejected.get(name, 0)
+        if rejected == 0:
+            logging.warning(f"Series limit ({limit}) reached for {name}; "
+                            f"high-cardinality label values go to {self.OVERFLOW_VALUE}")
+        self.rejected[name] = rejected + samples
+        return self._overflow(name, labels, by_labels)
     
-    def _should_attempt_reset(self) -> bool:
-        """Check if enough time has passed to attempt reset"""
-        if self.last_failure_time is None:
-            return True
+    def _overflow(self, name: str, labels: Dict[str, str], by_labels: Dict[frozenset, int]) -> int:
+        """Fold label values, highest cardinality first, until an overflow series fits"""
+        cardinality = self._cardinality.get(name)
+        if cardinality is None:
+            # Series are no longer admitted for this metric, so the counts stay exact
+            values: Dict[str, set] = defaultdict(set)
+            for key in by_labels:
+                for label, value in key:
+                    if value != self.OVERFLOW_VALUE:
+                        values[label].add(value)
+            cardinality = self._cardinality[name] = {label: len(distinct) for label, distinct in values.items()}
         
-        # Exponential backoff with jitter
-        base_timeout = self.recovery_timeout
-        exponential_factor = min(2 ** (self.failure_count // self.failure_threshold), 16)
-        jitter = time.time() % 10  # Add up to 10 seconds of jitter
+        overflow_labels = dict(labels)
+        overflow_key = _NO_LABELS
+        # Labels the metric never had count as unbounded and fold first
+        order = sorted(labels, key=lambda label: cardinality.get(label, math.inf), reverse=True)
+        for label in order:
+            overflow_labels[label] = self.OVERFLOW_VALUE
+            overflow_key = frozenset(overflow_labels.items())
+            series_id = by_labels.get(overflow_key)
+            if series_id is not None:
+                return series_id
+            if self._overflow_series.get(name, 0) < self.OVERFLOW_SERIES_PER_METRIC:
+                break
+            # Out of overflow budget: keep folding; the all-overflow series is always created
         
-        timeout = base_timeout * exponential_factor + jitter
-        return (time.time() - self.last_failure_time) >= timeout
+        self._overflow_series[name] = self._overflow_series.get(name, 0) + 1
+        series_id = by_labels[overflow_key] = self._add(name, overflow_labels)
+        return series_id
     
-    def _on_success(self):
-        """Handle successful call"""
-        self.success_count += 1
-        self.last_success_time = time.time()
-        self.consecutive_successes += 1
-        
-        if self.state == CircuitBreakerState.HALF_OPEN:
-            # Need multiple successes to close circuit
-            if self.consecutive_successes >= 3:
-                self.state = CircuitBreakerState.CLOSED
-                self.failure_count = 0
-                self.consecutive_successes = 0
-        elif self.state == CircuitBreakerState.CLOSED:
-            # Reset failure count on success
-            if self.failure_count > 0:
-                self.failure_count = max(0, self.failure_count - 1)
+    def _count_rejected_name(self, name: str, samples: int):
+        """Space-saving heavy hitters: a new name replaces the least counted one and inherits its count"""
+        counts = self.rejected_names
+        if name in counts:
+            counts[name] += samples
+        elif len(counts) < self.TRACKED_REJECTED_NAMES:
+            counts[name] = samples
+        else:
+            victim = min(counts, key=counts.__getitem__)
+            counts[name] = counts.pop(victim) + samples
     
-    def _on_failure(self):
-        """Handle failed call"""
-        self.failure_count += 1
-        self.last_failure_time = time.time()
-        self.consecutive_successes = 0
-        
-        # Adaptive threshold adjustment
-        if self.failure_count > self.adaptive_threshold:
-            self.adaptive_threshold = min(
-                self.adaptive_threshold * 1.2, 
-                self.failure_threshold * 2
-            )
-        
-        if self.failure_count >= self.adaptive_threshold:
-            self.state = CircuitBreakerState.OPEN
-            self.circuit_breaker_failures.labels(name=self.name).inc()
+    def overflow_series(self, metric_type: str) -> int:
+        """Series id shared by all samples of metric_type whose metric name was rejected"""
+        name = f"{self.OVERFLOW_METRIC}_{metric_type}"
+        by_labels = self._ids.get(name)
+        if by_labels is None:
+            by_labels = self._ids[name] = {}
+        series_id = by_labels.get(_NO_LABELS)
+        if series_id is None:
+            series_id = by_labels[_NO_LABELS] = self._add(name, {})
+        return series_id
     
-    def _update_metrics(self):
-        """Update Prometheus metrics"""
-        state_value = {
-            CircuitBreakerState.CLOSED: 0,
-            CircuitBreakerState.OPEN: 1,
-            CircuitBreakerState.HALF_OPEN: 2
-        }[self.state]
-        
-        self.circuit_breaker_state.labels(name=self.name).set(state_value)
+    def top_offenders(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        Metrics and labels that hit a series limit, most rejected samples first.
+        Rejected metric names appear with label None; their counts are upper bounds.
+        """
+        offenders = []
+        for name, rejected in self.rejected.items():
+            values: Dict[str, set] = defaultdict(set)
+            for key in self._ids[name]:
+                for label, value in key:
+                    values[label].add(value)
+            for label, distinct in values.items():
+                distinct.discard(self.OVERFLOW_VALUE)
+                offenders.append({
+                    'metric': name,
+                    'label': label,
+                    'distinct_values': len(distinct),
+                    'rejected_samples': rejected
+                })
+        for name, rejected in self.rejected_names.items():
+            offenders.append({
+                'metric': name,
+                'label': None,
+                'distinct_values': 0,
+                'rejected_samples': rejected
+            })
+        offenders.sort(key=itemgetter('rejected_samples', 'distinct_values'), reverse=True)
+        return offenders[:limit]
     
-    def get_state(self) -> Dict[str, Any]:
-        """Get current circuit breaker state"""
-        return {
-            'name': self.name,
-            'state': self.state,
-            'failure_count': self.failure_count,
-            'success_count': self.success_count,
-            'adaptive_threshold': self.adaptive_threshold,
-            'last_failure_time': self.last_failure_time.isoformat() if self.last_failure_time else None,
-            'last_success_time': self.last_success_time.isoformat() if self.last_success_time else None
-        }
+    def get(self, name: str, labels: Optional[Dict[str, str]] = None) -> Optional[int]:
+        """Look up a series id without creating one"""
+        key = frozenset(labels.items()) if labels else _NO_LABELS
+        return self._ids.get(name, {}).get(key)
+    
+    def _add(self, name: str, labels: Dict[str, str], label_key: Optional[str] = None) -> int:
+        series_id = len(self.names)
+        if label_key is None:
+            labels = dict(sorted(labels.items()))
+            # Serialized once per series, for export keys
+            label_key = json.dumps(labels)
+        self.names.append(name)
+        self.labels.append(labels)
+        self.label_keys.append(label_key)
+        return series_id
+    
+    def __len__(self) -> int:
+        return len(self.names)
 
+# (resolution seconds, slots): 1s for 5 minutes, 10s for 1 hour, 1m for 1 day.
+# Rings are preallocated at 48 bytes per slot, so these 2100 slots cost ~100 KB
+# per series (~10 GB at 100k series); pass smaller tiers for wide label sets.
+DEFAULT_ROLLUP_TIERS = ((1.0, 300), (10.0, 360), (60.0, 1440))
 
-# ============================================================================
-# PATTERN 3: ASYNCHRONOUS METRICS COLLECTOR
-# ============================================================================
+class RollupRing:
+    """
+    Fixed-size ring of per-interval aggregates at one resolution
+    
+    Slot i holds interval epoch e (e = timestamp // resolution, i = e % slots)
+    with its sum, count, min, max and last value. Storage is preallocated
+    array('d') columns, ~48 bytes per slot; a slot is reset lazily when a
+    newer interval maps onto it.
+    """
+    
+    __slots__ = ('resolution', 'slots', 'epochs', 'sums', 'counts', 'mins', 'maxs', 'lasts')
+    
+    def __init__(self, resolution: float, slots: int):
+        self.resolution = resolution
+        self.slots = slots
+        self.epochs = array('q', [-1]) * slots
+        self.sums = array('d', [0.0]) * slots
+        self.counts = array('d', [0.0]) * slots
+        self.mins = array('d', [math.inf]) * slots
+        self.maxs = array('d', [-math.inf]) * slots
+        self.lasts = array('d', [math.nan]) * slots
+    
+    @property
+    def span(self) -> float:
+        """Seconds of history the ring retains"""
+        return self.resolution * self.slots
+    
+    def add(self, timestamp: float, total: float, count: float, last: float,
+            minimum: Optional[float] = None, maximum: Optional[float] = None):
+        """Fold one flush's contribution into the interval containing timestamp"""
+        epoch = int(timestamp // self.resolution)
+        i = epoch % self.slots
+        current = self.epochs[i]
+        if current != epoch:
+            if current > epoch:
+                return  # Older than the ring's horizon
+            self.epochs[i] = epoch
+            self.sums[i] = 0.0
+            self.counts[i] = 0.0
+            self.mins[i] = math.inf
+            self.maxs[i] = -math.inf
+        self.sums[i] += total
+        self.counts[i] += count
+        self.lasts[i] = last
+        if minimum is not None and minimum < self.mins[i]:
+            self.mins[i] = minimum
+        if maximum is not None and maximum > self.maxs[i]:
+            self.maxs[i] = maximum
+    
+    def query(self, start: float, end: float) -> List[Dict[str, Any]]:
+        """Populated intervals overlapping [start, end], oldest first"""
+        first = int(start // self.resolution)
+        last = int(end // self.resolution)
+        first = max(first, last - self.slots + 1)
+        points = []
+        for epoch in range(first, last + 1):
+            i = epoch % self.slots
+            if self.epochs[i] != epoch:
+                continue
+            points.append({
+                'start': epoch * self.resolution,
+                'sum': self.sums[i],
+                'count': self.counts[i],
+                'min': self.mins[i] if self.mins[i] != math.inf else None,
+                'max': self.maxs[i] if self.maxs[i] != -math.inf else None,
+                'last': self.lasts[i]
+            })
+        return points
+
+class SeriesRollups:
+    """Rollup rings of one series plus the cumulative state seen at the last flush"""
+    
+    __slots__ = ('rings', 'previous_total', 'previous_count')
+    
+    def __init__(self, tiers: Iterable[tuple]):
+        self.rings = [RollupRing(resolution, slots) for resolution, slots in tiers]
+        self.previous_total = 0.0
+        self.previous_count = 0
+    
+    def add(self, timestamp: float, total: float, count: float, last: float,
+            minimum: Optional[float] = None, maximum: Optional[float] = None):
+        for ring in self.rings:
+            ring.add(timestamp, total, count, last, minimum, maximum)
+    
+    def ring_for(self, start: float, now: float, resolution: Optional[float] = None) -> RollupRing:
+        """The requested resolution, else the finest ring whose history reaches start"""
+        if resolution is not None:
+            for ring in self.rings:
+                if ring.resolution == resolution:
+                    return ring
+            raise ValueError(f"No rollup tier with resolution {resolution}")
+        for ring in self.rings:
+            if now - start <= ring.span:
+                return ring
+        return self.rings[-1]
 
-@dataclass
-class MetricData:
-    name: str
-    value: float
-    timestamp: datetime
-    labels: Dict[str, str]
-    metric_type: str  # counter, gauge, histogram, summary
+# Multiprocess collectors; a forked worker must not publish its parent's samples
+_MULTIPROCESS_COLLECTORS: 'weakref.WeakSet[AsyncMetricsCollector]' = weakref.WeakSet()
+
+def _reset_multiprocess_collectors():
+    for collector in list(_MULTIPROCESS_COLLECTORS):
+        collector._reset_after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_multiprocess_collectors)
 
 class AsyncMetricsCollector:
     """
@@ -414,30 +3635,171 @@ class AsyncMetricsCollector:
     - Metric aggregation
     - Backpressure handling
     - Multiple output formats
+    - Non-blocking and bulk ingest with an explicit overflow policy
+    - Constant-memory histograms (fixed or native exponential buckets,
+      optional DDSketch quantiles)
+    - Vectorized (NumPy) batch aggregation with a pure-Python fallback
+    - Multiprocess mode: each worker publishes its series to an mmap file
+      in multiprocess_dir, merged by MultiprocessMetricsView; a forked
+      worker starts from empty aggregates rather than its parent's
+    - Opt-in rollup rings per series at several resolutions for
+      windowed rates and range queries (preallocated, 48 bytes per slot
+      per series; see DEFAULT_ROLLUP_TIERS)
+    - Incremental Prometheus / OpenMetrics exposition that re-renders
+      only series changed since the last scrape
+    - Global and per-metric series limits: high-cardinality label values
+      fold to __overflow__, rejected metric names share one overflow series
+      per type, and a report names the labels and metrics driving cardinality
+    - Optional write-ahead log and snapshots in wal_dir, replayed on
+      construction so counters survive restarts
+    - A series keeps the type of its first sample; samples of another type
+      are rejected and counted in metrics_type_conflicts_total
+    - Samples of unsupported types are rejected before interning, so they
+      never take series budget
+    
+    Samples are queued as (name, value, labels, metric_type, timestamp)
+    tuples in chunks rather than one queue item per sample. At most
+    max_pending samples are buffered; beyond that the overflow policy applies:
+    - 'drop_oldest': evict the oldest queued chunk(s) to make room
+    - 'drop_newest': reject the incoming samples
+    - 'sample': above sample_watermark, admit samples with a probability
+      that falls to zero as the buffer fills, spreading loss evenly
+    - 'block': record_metric waits for space (sync paths drop newest)
     """
     
-    def __init__(self, batch_size: int = 1000, flush_interval: float = 5.0):
+    OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'sample', 'block')
+    
+    def __init__(self, batch_size: int = 1000, flush_interval: float = 5.0,
+                 max_pending: int = 10000, overflow: str = 'drop_oldest',
+                 chunk_size: int = 256, sample_watermark: float = 0.8,
+                 histogram_buckets: Union[str, Iterable[float]] = DEFAULT_HISTOGRAM_BUCKETS,
+                 histogram_schema: int = 3, histogram_max_buckets: int = 160,
+                 histogram_sketch: bool = False, columnar: Optional[bool] = None,
+                 columnar_min_batch: int = 256, multiprocess_dir: Optional[str] = None,
+                 rollups: Union[bool, Iterable[tuple], None] = None,
+                 max_series: Optional[int] = None, max_series_per_metric: Optional[int] = None,
+                 wal_dir: Optional[str] = None, wal_commit_interval: float = 1.0,
+                 wal_fsync: bool = True, snapshot_interval: float = 300.0):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unsupported overflow policy: {overflow}")
+        if isinstance(histogram_buckets, str):
+            if histogram_buckets != 'native':
+                raise ValueError(f"Unsupported histogram buckets: {histogram_buckets}")
+            self._histogram_bounds = None
+        else:
+            self._histogram_bounds = tuple(sorted(float(b) for b in histogram_buckets if b != math.inf))
+        self.histogram_schema = histogram_schema
+        self.histogram_max_buckets = histogram_max_buckets
+        self.histogram_sketch = histogram_sketch
+        
+        # Columnar aggregation defaults on when NumPy is importable
+        if columnar and np is None:
+            raise ValueError("Columnar aggregation requires numpy")
+        self.columnar = np is not None if columnar is None else columnar
+        self.columnar_min_batch = columnar_min_batch
+        self._columns = _ColumnBuffers(batch_size) if self.columnar else None
+        
+        # Multiprocess publishing; the writer is (re)opened lazily per process
+        self.multiprocess_dir = multiprocess_dir
+        self._shared: Optional[SharedSeriesWriter] = None
+        self._shared_keys: Dict[tuple, str] = {}
+        self._shared_buckets: Dict[int, set] = {}
+        self._dirty: set = set()
+        
+        # Time-windowed rollups; tiers are (resolution seconds, slots), finest first
+        if rollups is True:
+            rollups = DEFAULT_ROLLUP_TIERS
+        self.rollup_tiers = tuple(sorted((float(r), int(n)) for r, n in rollups)) if rollups else None
+        self.rollups: Dict[int, SeriesRollups] = {}
+        # (count, total) of recovered series, applied when their rollups are created
+        self._rollup_baselines: Dict[int, tuple] = {}
         self.batch_size = batch_size
         self.flush_interval = flush_interval
-        self.metrics_queue = asyncio.Queue(maxsize=10000)
-        self.metrics_buffer: List[MetricData] = []
-        self.aggregated_metrics: Dict[str, Dict] = defaultdict(dict)
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.chunk_size = chunk_size
+        self.sample_watermark = sample_watermark
+        # Below this many buffered samples no overflow check is needed
+        self._admit_threshold = int(max_pending * sample_watermark) if overflow == 'sample' else max_pending
+        
+        # Chunks of sample tuples; capacity is enforced in samples via self.pending
+        self.metrics_queue: asyncio.Queue = asyncio.Queue()
+        self._staging: List[tuple] = []
+        self.pending = 0
+        self.dropped = 0
+        # Samples rejected because their series already has another type
+        self.type_conflicts = 0
+        self._conflicting_names: set = set()
+        # Samples rejected because their type is not counter, gauge or histogram
+        self.unsupported_types = 0
+        self._unsupported_seen: set = set()
+        self._space_available: Optional[asyncio.Event] = None
+        self.series = SeriesTable(max_series, max_series_per_metric, self._series_rejected)
+        self.aggregated_metrics: Dict[int, Dict] = {}
+        # HELP text per metric name, and cached renderers keyed by openmetrics flag
+        self.descriptions: Dict[str, str] = {}
+        self._renderers: Dict[bool, 'ExpositionRenderer'] = {}
         self.running = False
         self.collector_task = None
         
         # Performance metrics
-        self.collection_duration = Histogram(
+        self.collection_duration = shared_metric(
+            Histogram,
             'metrics_collection_duration_seconds',
             'Time to collect metrics batch'
         )
-        self.metrics_processed = Counter(
+        self.metrics_processed = shared_metric(
+            Counter,
             'metrics_processed_total',
             'Total metrics processed'
         )
-        self.queue_size = Gauge(
+        self.queue_size = shared_metric(
+            Gauge,
             'metrics_queue_size',
             'Current metrics queue size'
         )
+        self.metrics_dropped = shared_metric(
+            Counter,
+            'metrics_dropped_total',
+            'Samples dropped by the ingest overflow policy',
+            ['policy']
+        )
+        self.backpressure = shared_metric(
+            Gauge,
+            'metrics_ingest_backpressure_ratio',
+            'Fraction of the ingest buffer in use (1.0 = overflow policy active)'
+        )
+        self.series_rejected = shared_metric(
+            Counter,
+            'metrics_series_rejected_total',
+            'Samples whose label set exceeded a series limit',
+            ['limit']
+        )
+        self.series_active = shared_metric(
+            Gauge,
+            'metrics_series_active',
+            'Series currently tracked by the collector'
+        )
+        self.metrics_type_conflicts = shared_metric(
+            Counter,
+            'metrics_type_conflicts_total',
+            'Samples rejected because their series was first recorded with another type',
+            ['type']
+        )
+        self.metrics_unsupported_types = shared_metric(
+            Counter,
+            'metrics_unsupported_type_total',
+            'Samples rejected because their type is not counter, gauge or histogram'
+        )
+        self._dropped_counter = self.metrics_dropped.labels(policy=overflow)
+        
+        # Durable state: replay the snapshot and logs before accepting samples
+        self.wal = None
+        if wal_dir is not None:
+            self.wal = MetricsWAL(wal_dir, wal_commit_interval, snapshot_interval, fsync=wal_fsync)
+            self._recover()
+        if multiprocess_dir is not None:
+            _MULTIPROCESS_COLLECTORS.add(self)
     
     async def start(self):
         """Start the metrics collector"""
@@ -451,152 +3813,650 @@ class AsyncMetricsCollector:
         """Stop the metrics collector"""
         self.running = False
         if self.collector_task:
+            # Wake the collector if it is waiting for the first chunk
+            self.metrics_queue.put_nowait(None)
             await self.collector_task
+            self.collector_task = None
+        
+        # Aggregate whatever was still buffered
+        batch = []
+        while not self.metrics_queue.empty():
+            batch.extend(self.metrics_queue.get_nowait() or ())
+        batch.extend(self._take_staging())
+        if batch:
+            self._release(len(batch))
+            await self._process_batch(batch)
+        if self.wal is not None:
+            self.wal.commit()
     
     async def record_metric(self, name: str, value: float, 
                           labels: Dict[str, str] = None, 
                           metric_type: str = 'gauge'):
         """Record a metric asynchronously"""
-        metric = MetricData(
-            name=name,
-            value=value,
-            timestamp=datetime.now(),
-            labels=labels or {},
-            metric_type=metric_type
-        )
+        if self.overflow == 'block':
+            while self.pending >= self.max_pending:
+                if self._space_available is None:
+                    self._space_available = asyncio.Event()
+                self._space_available.clear()
+                await self._space_available.wait()
+        self.record_nowait(name, value, labels, metric_type)
+    
+    def record_nowait(self, name: str, value: float, labels: Dict[str, str] = None,
+                      metric_type: str = 'gauge') -> bool:
+        """
+        Record a metric without awaiting; returns False if the sample was dropped.
+        Must be called on the event loop thread: the queue and pending count are
+        not locked. From other threads use loop.call_soon_threadsafe.
+        """
+        if self.pending >= self._admit_threshold and not self._admit_one():
+            return False
         
-        try:
-            await self.metrics_queue.put(metric)
-        except asyncio.QueueFull:
-            # Handle backpressure by dropping oldest metrics
-            try:
-                await self.metrics_queue.get()
-                await self.metrics_queue.put(metric)
-            except asyncio.QueueEmpty:
-                pass
+        staging = self._staging
+        staging.append((name, value, labels, metric_type, time.time()))
+        self.pending += 1
+        if len(staging) >= self.chunk_size:
+            self._flush_staging()
+        return True
+    
+    def record_many(self, samples: Iterable[Union[tuple, MetricData]], metric_type: str = 'gauge') -> int:
+        """
+        Bulk ingest. Samples are MetricData or (name, value[, labels[, metric_type]])
+        tuples; one timestamp is taken for the whole call. Returns samples accepted.
+        Like record_nowait, must be called on the event loop thread.
+        """
+        now = time.time()
+        chunk = []
+        append = chunk.append
+        for sample in samples:
+            if type(sample) is tuple:
+                size = len(sample)
+                if size == 3:
+                    append((*sample, metric_type, now))
+                elif size == 2:
+                    append((*sample, None, metric_type, now))
+                else:
+                    append((*sample[:4], now))
+            else:
+                append((sample.name, sample.value, sample.labels, sample.metric_type,
+                        sample.timestamp.timestamp()))
+        
+        chunk = self._admit_many(chunk)
+        if chunk:
+            self._flush_staging()
+            self.metrics_queue.put_nowait(chunk)
+            self.pending += len(chunk)
+        return len(chunk)
+    
+    def _admit_one(self) -> bool:
+        """Apply the overflow policy to one sample when the buffer is (nearly) full"""
+        if self.overflow == 'sample':
+            if self.pending < self.max_pending and random.random() < self._sample_probability():
+                return True
+        elif self.pending < self.max_pending:
+            return True
+        elif self.overflow == 'drop_oldest':
+            self._evict_oldest(1)
+            return True
+        self._drop(1)
+        return False
+    
+    def _admit_many(self, chunk: List[tuple]) -> List[tuple]:
+        """Apply the overflow policy to a bulk chunk; returns the samples to enqueue"""
+        free = self.max_pending - self.pending
+        if self.overflow == 'drop_oldest':
+            if len(chunk) > self.max_pending:
+                self._drop(len(chunk) - self.max_pending)
+                chunk = chunk[-self.max_pending:]
+            if len(chunk) > free:
+                self._evict_oldest(len(chunk) - free)
+            return chunk
+        
+        if self.overflow == 'sample' and self.pending + len(chunk) > self.max_pending * self.sample_watermark:
+            probability = self._sample_probability()
+            admitted = [sample for sample in chunk if random.random() < probability]
+        else:
+            admitted = chunk
+        if len(admitted) > free:
+            admitted = admitted[:max(0, free)]
+        if len(admitted) < len(chunk):
+            self._drop(len(chunk) - len(admitted))
+        return admitted
+    
+    def _sample_probability(self) -> float:
+        fill = self.pending / self.max_pending
+        if fill < self.sample_watermark:
+            return 1.0
+        return max(0.0, (1.0 - fill) / (1.0 - self.sample_watermark))
+    
+    def _evict_oldest(self, count: int):
+        """Drop at least count of the oldest buffered samples, whole chunks at a time"""
+        evicted = 0
+        while evicted < count and not self.metrics_queue.empty():
+            chunk = self.metrics_queue.get_nowait()
+            if chunk is None:
+                # Keep stop()'s wake-up for the collector
+                self.metrics_queue.put_nowait(None)
+                break
+            evicted += len(chunk)
+        if evicted < count and self._staging:
+            trimmed = min(count - evicted, len(self._staging))
+            del self._staging[:trimmed]
+            evicted += trimmed
+        self.pending -= evicted
+        self._drop(evicted)
+    
+    def _drop(self, count: int):
+        self.dropped += count
+        self._dropped_counter.inc(count)
+    
+    def _flush_staging(self):
+        """Hand staged single samples to the collector as one chunk"""
+        if self._staging:
+            self.metrics_queue.put_nowait(self._staging)
+            self._staging = []
+    
+    def _take_staging(self) -> List[tuple]:
+        staged, self._staging = self._staging, []
+        return staged
+    
+    def _release(self, count: int):
+        """Account for samples handed to aggregation"""
+        self.pending -= count
+        if self._space_available is not None:
+            self._space_available.set()
     
     async def _collector_loop(self):
-        """Main collector loop"""
-        while self.running:
+        """
+        Main collector loop. Awaits only the first chunk of a batch, then
+        drains what is already queued with get_nowait; flushes when the batch
+        reaches batch_size or flush_interval elapses.
+        """
+        queue = self.metrics_queue
+        batch: List[tuple] = []
+        next_flush = time.monotonic() + self.flush_interval
+        stopping = False
+        
+        while not stopping:
             try:
-                # Collect metrics in batches
-                batch = []
-                timeout = self.flush_interval
-                
-                # Collect up to batch_size metrics or timeout
-                start_time = time.time()
-                while len(batch) < self.batch_size and (time.time() - start_time) < timeout:
+                timeout = next_flush - time.monotonic()
+                if timeout > 0 and len(batch) < self.batch_size:
                     try:
-                        metric = await asyncio.wait_for(
-                            self.metrics_queue.get(), 
-                            timeout=0.1
-                        )
-                        batch.append(metric)
+                        chunk = await asyncio.wait_for(queue.get(), timeout)
                     except asyncio.TimeoutError:
-                        break
+                        chunk = ()
+                    
+                    # Drain without awaiting; None is stop()'s wake-up
+                    while chunk is not None:
+                        batch.extend(chunk)
+                        if len(batch) >= self.batch_size or queue.empty():
+                            break
+                        chunk = queue.get_nowait()
+                    stopping = chunk is None
+                    
+                    if not stopping and len(batch) < self.batch_size and time.monotonic() < next_flush:
+                        continue
                 
+                # Flush on size, interval or stop. Samples staged by record_nowait are
+                # newer than any queued chunk, so take them only once the queue is drained
+                if queue.empty():
+                    batch.extend(self._take_staging())
                 if batch:
+                    self._release(len(batch))
                     await self._process_batch(batch)
+                    batch = []
+                elif self.wal is not None:
+                    # Idle interval: make records buffered by group commit durable
+                    self.wal.commit()
+                next_flush = time.monotonic() + self.flush_interval
                 
-                # Update queue size metric
-                self.queue_size.set(self.metrics_queue.qsize())
+                # Update queue size and backpressure metrics
+                self.queue_size.set(self.pending)
+                self.backpressure.set(min(1.0, self.pending / self.max_pending))
                 
             except Exception as e:
                 logging.error(f"Metrics collector error: {e}")
+                batch = []
                 await asyncio.sleep(1)
     
-    async def _process_batch(self, batch: List[MetricData]):
+    async def _process_batch(self, batch: List[tuple]):
         """Process a batch of metrics"""
         start_time = time.time()
         
         try:
             # Aggregate metrics
-            for metric in batch:
-                self._aggregate_metric(metric)
+            if self.columnar and len(batch) >= self.columnar_min_batch:
+                self._aggregate_columnar(batch)
+            else:
+                for sample in batch:
+                    self._aggregate_metric(*sample)
+            
+            dirty, self._dirty = self._dirty, set()
+            dirty.discard(None)
+            if self.multiprocess_dir is not None:
+                self._publish_shared(dirty)
+            if self.rollup_tiers is not None:
+                self._update_rollups(dirty)
+            for renderer in self._renderers.values():
+                renderer.invalidate(dirty)
+            if self.wal is not None:
+                self._log_wal(dirty)
             
             # Update processed count
             self.metrics_processed.inc(len(batch))
+            self.series_active.set(len(self.series))
             
         finally:
             # Record processing time
             duration = time.time() - start_time
             self.collection_duration.observe(duration)
     
-    def _aggregate_metric(self, metric: MetricData):
+    def _aggregate_metric(self, name: str, value: float, labels: Optional[Dict[str, str]],
+                          metric_type: str, timestamp: float):
         """Aggregate metric data"""
-        key = f"{metric.name}:{json.dumps(metric.labels, sort_keys=True)}"
+        if metric_type not in _TYPE_CODES:
+            self._unsupported_type(name, metric_type, 1)
+            return
+        series_id = self.series.intern(name, labels)
+        if series_id is None:
+            series_id = self.series.overflow_series(metric_type)
+        data = self.aggregated_metrics.get(series_id)
+        if data is not None and data['type'] != metric_type:
+            self._type_conflict(series_id, data['type'], metric_type, 1)
+            return
+        self._dirty.add(series_id)
         
-        if metric.metric_type == 'counter':
-            if key not in self.aggregated_metrics:
-                self.aggregated_metrics[key] = {
+        if metric_type == 'counter':
+            if data is None:
+                data = self.aggregated_metrics[series_id] = {
+                    'type': 'counter',
                     'value': 0,
                     'count': 0,
-                    'last_update': metric.timestamp
+                    'last_update': timestamp
                 }
-            self.aggregated_metrics[key]['value'] += metric.value
-            self.aggregated_metrics[key]['count'] += 1
-            self.aggregated_metrics[key]['last_update'] = metric.timestamp
+            data['value'] += value
+            data['count'] += 1
+            data['last_update'] = timestamp
             
-        elif metric.metric_type == 'gauge':
-            self.aggregated_metrics[key] = {
-                'value': metric.value,
+        elif metric_type == 'gauge':
+            self.aggregated_metrics[series_id] = {
+                'type': 'gauge',
+                'value': value,
                 'count': 1,
-                'last_update': metric.timestamp
+                'last_update': timestamp
             }
             
-        elif metric.metric_type == 'histogram':
-            if key not in self.aggregated_metrics:
-                self.aggregated_metrics[key] = {
-                    'values': [],
-                    'count': 0,
-                    'sum': 0,
-                    'last_update': metric.timestamp
+        elif metric_type == 'histogram':
+            if data is None:
+                data = self.aggregated_metrics[series_id] = {
+                    'type': 'histogram',
+                    'histogram': self._new_histogram(),
+                    'last_update': timestamp
                 }
-            self.aggregated_metrics[key]['values'].append(metric.value)
-            self.aggregated_metrics[key]['count'] += 1
-            self.aggregated_metrics[key]['sum'] += metric.value
-            self.aggregated_metrics[key]['last_update'] = metric.timestamp
+            data['histogram'].observe(value)
+            data['last_update'] = timestamp
+    
+    def _aggregate_columnar(self, batch: List[tuple]):
+        """
+        Aggregate a batch with grouped NumPy reductions. Columns are pulled
+        out with itemgetter (no per-sample tuples), samples are grouped by
+        (series id, type) codes, and Python work is interning plus one dict
+        update per group. A labels dict shared by many samples is interned
+        once; labels built per call are interned per sample.
+        """
+        type_codes = np.fromiter(map(_TYPE_CODES.get, map(_SAMPLE_TYPE, batch), repeat(_UNKNOWN_TYPE)),
+                                 dtype=np.int64, count=len(batch))
+        unsupported = type_codes == _UNKNOWN_TYPE
+        if unsupported.any():
+            # Reject before interning so unsupported types take no series budget
+            for i in np.flatnonzero(unsupported).tolist():
+                self._unsupported_type(batch[i][0], batch[i][3], 1)
+            supported = ~unsupported
+            batch = [sample for sample, keep in zip(batch, supported.tolist()) if keep]
+            type_codes = type_codes[supported]
+            if not batch:
+                return
+        
+        size = len(batch)
+        columns = self._columns
+        columns.reserve(size)
+        
+        names = list(map(_SAMPLE_NAME, batch))
+        label_sets = list(map(_SAMPLE_LABELS, batch))
+        values = columns.values[:size]
+        values[:] = np.fromiter(map(_SAMPLE_VALUE, batch), dtype=np.float64, count=size)
+        timestamps = columns.timestamps[:size]
+        timestamps[:] = np.fromiter(map(_SAMPLE_TIMESTAMP, batch), dtype=np.float64, count=size)
+        
+        # Label dicts are kept alive by the batch, so id() identifies them within it
+        intern = self.series.intern
+        label_objects, label_codes = np.unique(np.fromiter(map(id, label_sets), dtype=np.int64, count=size),
+                                               return_inverse=True)
+        if len(label_objects) * 2 > size:
+            # Mostly per-call dicts: deduplicating by identity would not save interning
+            sample_series = list(map(intern, names, label_sets))
+        else:
+            # Intern each distinct (name, labels object) pair once
+            name_index = {name: i for i, name in enumerate(set(names))}
+            name_codes = np.fromiter(map(name_index.__getitem__, names), dtype=np.int64, count=size)
+            _, first, pair_codes = np.unique(name_codes * len(label_objects) + label_codes.reshape(-1),
+                                             return_index=True, return_inverse=True)
+            pair_samples = np.bincount(pair_codes.reshape(-1)).tolist()
+            # New series are admitted in arrival order, as on the scalar path
+            sample_series = [None] * len(first)
+            first = first.tolist()
+            for pair in sorted(range(len(first)), key=first.__getitem__):
+                i = first[pair]
+                sample_series[pair] = intern(names[i], label_sets[i], pair_samples[pair])
+        rejected = None in sample_series
+        if rejected:
+            sample_series = [-1 if series_id is None else series_id for series_id in sample_series]
+        series_codes = np.array(sample_series, dtype=np.int64)
+        if len(sample_series) != size:
+            series_codes = series_codes[pair_codes.reshape(-1)]
+        if rejected:
+            # Names rejected by the global series limit go to the overflow series of their type
+            missing = series_codes < 0
+            for type_code in np.unique(type_codes[missing]).tolist():
+                overflow_id = self.series.overflow_series(_TYPE_NAMES[type_code])
+                series_codes[missing & (type_codes == type_code)] = overflow_id
+        keys = columns.keys[:size]
+        keys[:] = (series_codes << 2) | type_codes
+        
+        groups, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        group_count = len(groups)
+        counts = np.bincount(inverse, minlength=group_count)
+        sums = np.bincount(inverse, weights=values, minlength=group_count)
+        last = np.zeros(group_count, dtype=np.int64)
+        np.maximum.at(last, inverse, np.arange(size))
+        
+        group_types = (groups & 3).tolist()
+        series_ids = (groups >> 2).tolist()
+        self._dirty.update(series_ids)
+        self._dirty.discard(-1)
+        last_values = values[last].tolist()
+        last_stamps = timestamps[last].tolist()
+        counts_list = counts.tolist()
+        sums_list = sums.tolist()
+        
+        aggregated = self.aggregated_metrics
+        histogram_groups = []
+        # Visiting groups by their first sample lets the earliest sample fix a
+        # new series' type, as on the scalar path
+        for group in np.argsort(first).tolist():
+            series_id = series_ids[group]
+            if series_id < 0:
+                continue
+            type_code = group_types[group]
+            stamp = last_stamps[group]
+            data = aggregated.get(series_id)
+            if data is not None and data['type'] != _TYPE_NAMES[type_code]:
+                self._type_conflict(series_id, data['type'], _TYPE_NAMES[type_code], counts_list[group])
+                continue
+            if type_code == 0:
+                if data is None:
+                    data = aggregated[series_id] = {'type': 'counter', 'value': 0, 'count': 0,
+                                                    'last_update': stamp}
+                data['value'] += sums_list[group]
+                data['count'] += counts_list[group]
+                data['last_update'] = stamp
+            elif type_code == 1:
+                aggregated[series_id] = {'type': 'gauge', 'value': last_values[group], 'count': 1,
+                                         'last_update': stamp}
+            elif type_code == 2:
+                if data is None:
+                    data = aggregated[series_id] = {'type': 'histogram', 'histogram': self._new_histogram(),
+                                                    'last_update': stamp}
+                data['last_update'] = stamp
+                histogram_groups.append((group, data['histogram']))
+        
+        if histogram_groups:
+            self._merge_histograms(histogram_groups, inverse, values, counts, sums_list)
+    
+    def _merge_histograms(self, histogram_groups: List[tuple], inverse, values, counts, sums: List[float]):
+        """Fold each histogram group's values into its series histogram"""
+        # Values ordered by group
+        order = np.argsort(inverse, kind='stable')
+        grouped = values[order]
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        starts_list = starts.tolist()
+        counts_list = counts.tolist()
+        
+        if self._histogram_bounds is None or self.histogram_sketch:
+            # Native buckets and sketches need every value
+            for group, histogram in histogram_groups:
+                start = starts_list[group]
+                for value in grouped[start:start + counts_list[group]].tolist():
+                    histogram.observe(value)
+            return
+        
+        slots = len(self._histogram_bounds) + 1
+        bucket_index = np.searchsorted(np.asarray(self._histogram_bounds), values, side='left')
+        bucket_counts = np.bincount(inverse * slots + bucket_index,
+                                    minlength=len(counts) * slots).reshape(-1, slots)
+        mins = np.minimum.reduceat(grouped, starts).tolist()
+        maxs = np.maximum.reduceat(grouped, starts).tolist()
+        for group, histogram in histogram_groups:
+            histogram.merge_counts(bucket_counts[group].tolist(), counts_list[group],
+                                   sums[group], mins[group], maxs[group])
+    
+    def _type_conflict(self, series_id: int, series_type: str, metric_type: str, samples: int):
+        """Reject samples whose type differs from the type that created the series"""
+        self.type_conflicts += samples
+        self.metrics_type_conflicts.labels(type=metric_type).inc(samples)
+        name = self.series.names[series_id]
+        if name not in self._conflicting_names:
+            self._conflicting_names.add(name)
+            logging.warning(f"Metric {name} is a {series_type}; rejecting {metric_type} samples")
+    
+    def _unsupported_type(self, name: str, metric_type: str, samples: int):
+        """Reject samples whose type the collector cannot aggregate"""
+        self.unsupported_types += samples
+        self.metrics_unsupported_types.inc(samples)
+        # Rejected names are not bounded by the series limits, so warn once per type
+        if metric_type not in self._unsupported_seen:
+            self._unsupported_seen.add(metric_type)
+            logging.warning(f"Metric {name} has unsupported type {metric_type!r}; rejecting its samples")
+    
+    def _reset_after_fork(self):
+        """Drop aggregates, buffered samples and the WAL inherited from the parent process"""
+        self.aggregated_metrics = {}
+        self.rollups = {}
+        self._rollup_baselines = {}
+        self._dirty = set()
+        self._renderers = {}
+        self.metrics_queue = asyncio.Queue()
+        self._staging = []
+        self.pending = 0
+        self._space_available = None
+        self.running = False
+        self.collector_task = None
+        self._shared = None
+        self._shared_keys = {}
+        self._shared_buckets = {}
+        # The log and its file handle belong to the parent
+        self.wal = None
+    
+    def _publish_shared(self, dirty: set):
+        """Write series changed in this batch to this process's shared table"""
+        if self._shared is None or self._shared.pid != os.getpid():
+            # First publish, or first in a forked worker: start a table of our own
+            self._shared = SharedSeriesWriter(self.multiprocess_dir)
+            self._shared_keys = {}
+            self._shared_buckets = {}
+        writer = self._shared
+        write = writer.write
+        key = self._shared_key
+        
+        writer.begin()
+        try:
+            for series_id in dirty:
+                data = self.aggregated_metrics.get(series_id)
+                if data is None:
+                    continue
+                write(key(series_id, 'ts'), data['last_update'])
+                histogram = data.get('histogram')
+                if histogram is None:
+                    write(key(series_id, 'value'), data['value'])
+                    write(key(series_id, 'count'), data['count'])
+                    continue
+                
+                write(key(series_id, 'count'), histogram.count)
+                write(key(series_id, 'sum'), histogram.sum)
+                write(key(series_id, 'min'), histogram.min)
+                write(key(series_id, 'max'), histogram.max)
+                written = set()
+                for _, upper, count in histogram.bucket_ranges():
+                    field = 'le:' + _format_le(upper)
+                    write(key(series_id, field), count)
+                    written.add(field)
+                # Zero buckets that disappeared (native histogram schema reduction)
+                for field in self._shared_buckets.get(series_id, set()) - written:
+                    write(key(series_id, field), 0.0)
+                self._shared_buckets[series_id] = written
+        finally:
+            writer.commit()
+    
+    def _shared_key(self, series_id: int, field: str) -> str:
+        key = self._shared_keys.get((series_id, field))
+        if key is None:
+            data = self.aggregated_metrics[series_id]
+            metric_type = 'histogram' if 'histogram' in data else data['type']
+            key = self._shared_keys[(series_id, field)] = json.dumps([
+                self.series.names[series_id], self.series.label_keys[series_id], metric_type, field
+            ])
+        return key
+    
+    def _update_rollups(self, dirty: set):
+        """Downsample each changed series' delta since the last flush into its rings"""
+        for series_id in dirty:
+            data = self.aggregated_metrics.get(series_id)
+            if data is None:
+                continue
+            rollups = self.rollups.get(series_id)
+            if rollups is None:
+                rollups = self.rollups[series_id] = SeriesRollups(self.rollup_tiers)
+                baseline = self._rollup_baselines.pop(series_id, None)
+                if baseline is not None:
+                    rollups.previous_count, rollups.previous_total = baseline
+            timestamp = data['last_update']
+            
+            histogram = data.get('histogram')
+            if histogram is not None:
+                # Observations since the last flush; last = their mean
+                count = histogram.count - rollups.previous_count
+                total = histogram.sum - rollups.previous_total
+                rollups.add(timestamp, total, count, total / count if count else math.nan)
+                rollups.previous_count, rollups.previous_total = histogram.count, histogram.sum
+            elif data['type'] == 'counter':
+                # Increase since the last flush; last = running total
+                increase = data['value'] - rollups.previous_total
+                rollups.add(timestamp, increase, data['count'] - rollups.previous_count,
+                            data['value'], increase, increase)
+                rollups.previous_count, rollups.previous_total = data['count'], data['value']
+            else:
+                value = data['value']
+                rollups.add(timestamp, value, 1, value, value, value)
+    
+    def _series_rollups(self, name: str, labels: Optional[Dict[str, str]]) -> Optional[SeriesRollups]:
+        if self.rollup_tiers is None:
+            raise ValueError("Rollups are not enabled for this collector")
+        series_id = self.series.get(name, labels)
+        return self.rollups.get(series_id) if series_id is not None else None
+    
+    def query_range(self, name: str, labels: Optional[Dict[str, str]] = None,
+                    start: Optional[float] = None, end: Optional[float] = None,
+                    resolution: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Rollup points for one series between start and end (unix seconds,
+        default the last 10 minutes). Uses the finest tier that still covers
+        start unless resolution is given.
+        """
+        end = time.time() if end is None else end
+        start = end - 600 if start is None else start
+        rollups = self._series_rollups(name, labels)
+        if rollups is None:
+            return []
+        return rollups.ring_for(start, time.time(), resolution).query(start, end)
+    
+    def get_window_stats(self, name: str, labels: Optional[Dict[str, str]] = None,
+                         window: float = 300.0) -> Dict[str, Any]:
+        """
+        Aggregate over the last window seconds. For counters sum is the
+        increase and rate the increase per second; for gauges avg is the
+        mean of flushed values; for histograms count_rate is observations
+        per second and avg their mean.
+        """
+        now = time.time()
+        points = self.query_range(name, labels, now - window, now)
+        total = sum(point['sum'] for point in points)
+        count = sum(point['count'] for point in points)
+        minimums = [point['min'] for point in points if point['min'] is not None]
+        maximums = [point['max'] for point in points if point['max'] is not None]
+        return {
+            'window': window,
+            'points': len(points),
+            'sum': total,
+            'count': count,
+            'min': min(minimums) if minimums else None,
+            'max': max(maximums) if maximums else None,
+            'avg': total / count if count else None,
+            'rate': total / window,
+            'count_rate': count / window
+        }
+    
+    def _new_histogram(self) -> _HistogramAggregate:
+        sketch = DDSketch() if self.histogram_sketch else None
+        if self._histogram_bounds is None:
+            return NativeHistogram(self.histogram_schema, self.histogram_max_buckets, sketch=sketch)
+        return BucketHistogram(self._histogram_bounds, sketch)
     
     def get_aggregated_metrics(self) -> Dict[str, Any]:
         """Get current aggregated metrics"""
         result = {}
         
-        for key, data in self.aggregated_metrics.items():
-            name, labels_str = key.split(':', 1)
-            labels = json.loads(labels_str)
+        series = self.series
+        for series_id, data in self.aggregated_metrics.items():
+            name = series.names[series_id]
+            labels_str = series.label_keys[series_id]
+            labels = dict(series.labels[series_id])
             
             if name not in result:
                 result[name] = {}
             
-            if data['count'] == 1:
+            if 'histogram' in data:
+                # Histogram data
+                histogram = data['histogram']
+                result[name][labels_str] = {
+                    'type': 'histogram',
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'min': histogram.min,
+                    'max': histogram.max,
+                    'avg': histogram.sum / histogram.count,
+                    'p50': histogram.quantile(0.5),
+                    'p99': histogram.quantile(0.99),
+                    'buckets': histogram.cumulative_buckets(),
+                    'labels': labels,
+                    'last_update': datetime.fromtimestamp(data['last_update']).isoformat()
+                }
+            elif data['count'] == 1:
                 # Single value
                 result[name][labels_str] = {
+                    'type': data['type'],
                     'value': data['value'],
                     'labels': labels,
-                    'last_update': data['last_update'].isoformat()
+                    'last_update': datetime.fromtimestamp(data['last_update']).isoformat()
                 }
             else:
-                # Multiple values - calculate statistics
-                if 'values' in data:
-                    # Histogram data
-                    values = data['values']
-                    result[name][labels_str] = {
-                        'count': data['count'],
-                        'sum': data['sum'],
-                        'min': min(values),
-                        'max': max(values),
-                        'avg': data['sum'] / data['count'],
-                        'labels': labels,
-                        'last_update': data['last_update'].isoformat()
-                    }
-                else:
-                    # Counter data
-                    result[name][labels_str] = {
-                        'value': data['value'],
-                        'count': data['count'],
-                        'labels': labels,
-                        'last_update': data['last_update'].isoformat()
-                    }
+                # Counter data
+                result[name][labels_str] = {
+                    'type': data['type'],
+                    'value': data['value'],
+                    'count': data['count'],
+                    'labels': labels,
+                    'last_update': datetime.fromtimestamp(data['last_update']).isoformat()
+                }
         
         return result
     
@@ -604,6 +4464,8 @@ class AsyncMetricsCollector:
         """Export metrics in specified format"""
         if format_type == 'prometheus':
             return self._export_prometheus()
+        elif format_type == 'openmetrics':
+            return self.renderer(openmetrics=True).render()
         elif format_type == 'json':
             return json.dumps(self.get_aggregated_metrics(), indent=2)
         else:
@@ -611,21 +4473,440 @@ class AsyncMetricsCollector:
     
     def _export_prometheus(self) -> str:
         """Export metrics in Prometheus format"""
-        lines = []
+        return self.renderer().render()
+    
+    def _log_wal(self, dirty: set):
+        wal = self.wal
+        wal.append(wal.encode(self.series, self.aggregated_metrics, dirty, wal.defined))
+        now = time.time()
+        if wal.snapshot_due(now):
+            self.snapshot()
+        elif wal.commit_due(now):
+            wal.commit()
+    
+    def snapshot(self):
+        """Write a compact snapshot of all series and discard the logs it supersedes"""
+        if self.wal is None:
+            raise ValueError("No wal_dir configured for this collector")
+        self.wal.rotate()
+        self.wal.write_snapshot(MetricsWAL.encode(self.series, self.aggregated_metrics,
+                                                  list(self.aggregated_metrics), set()))
+    
+    def _recover(self) -> int:
+        """
+        Rebuild aggregated state from the WAL directory; returns series restored.
+        Cost is linear in series: each needs an aggregate dict, a label dict
+        and an interning key, a few microseconds per series in CPython.
+        """
+        start_time = time.perf_counter()
+        aggregated = self.aggregated_metrics
         
-        for name, metric_data in self.get_aggregated_metrics().items():
-            for labels_str, data in metric_data.items():
-                labels = data['labels']
-                label_str = ','.join(f'{k}="{v}"' for k, v in labels.items())
-                
-                if label_str:
-                    metric_line = f'{name}{{{label_str}}} {data["value"]}'
-                else:
-                    metric_line = f'{name} {data["value"]}'
-                
-                lines.append(metric_line)
+        # Restoring allocates a few containers per series; collections would only rescan them
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for records in self.wal.replay():
+                # Series ids are per file
+                id_map: Dict[int, Optional[int]] = {}
+                for payload in records:
+                    (file_ids, names, labels, label_keys), columns, histograms = MetricsWAL.decode(payload)
+                    if file_ids:
+                        id_map.update(zip(file_ids, self.series.intern_many(names, labels, label_keys)))
+                    
+                    file_ids, type_codes, values, counts, stamps = columns
+                    aggregated.update({
+                        series_id: {'type': _TYPE_NAMES[type_code], 'value': value,
+                                    'count': count, 'last_update': stamp}
+                        for series_id, type_code, value, count, stamp
+                        in zip(map(id_map.__getitem__, file_ids), type_codes, values, counts, stamps)
+                        if series_id is not None
+                    })
+                    
+                    for file_id, stamp, state in histograms:
+                        series_id = id_map[file_id]
+                        if series_id is None:
+                            continue
+                        histogram = self._new_histogram()
+                        try:
+                            histogram.load_state(state)
+                        except ValueError as e:
+                            logging.warning(f"Metrics WAL: skipping histogram {self.series.names[series_id]}: {e}")
+                            continue
+                        aggregated[series_id] = {'type': 'histogram', 'histogram': histogram,
+                                                 'last_update': stamp}
+            
+            if self.rollup_tiers is not None:
+                # Rollups start from the recovered totals, so the first flush after a
+                # restart records only new increases rather than the whole total
+                for series_id, data in aggregated.items():
+                    histogram = data.get('histogram')
+                    if histogram is not None:
+                        self._rollup_baselines[series_id] = (histogram.count, histogram.sum)
+                    elif data['type'] == 'counter':
+                        self._rollup_baselines[series_id] = (data['count'], data['value'])
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        
+        logging.info(f"Metrics WAL: restored {len(aggregated)} series in "
+                     f"{(time.perf_counter() - start_time) * 1000:.1f} ms")
+        return len(aggregated)
+    
+    def _series_rejected(self, name: str, limit: str, samples: int):
+        self.series_rejected.labels(limit=limit).inc(samples)
+    
+    def get_cardinality_report(self, top: int = 10) -> Dict[str, Any]:
+        """Series counts, limits, rejections and the labels driving cardinality"""
+        series = self.series
+        return {
+            'series': len(series),
+            'max_series': series.max_series,
+            'max_series_per_metric': series.max_series_per_metric,
+            'rejected_samples': dict(series.rejected),
+            'rejected_new_metrics': series.rejected_new_metrics,
+            'top_offenders': series.top_offenders(top)
+        }
+    
+    def describe(self, name: str, documentation: str):
+        """Set the # HELP text exposed for a metric name"""
+        self.descriptions[name] = documentation
+        for renderer in self._renderers.values():
+            renderer.invalidate_family(name)
+    
+    def renderer(self, openmetrics: bool = False) -> 'ExpositionRenderer':
+        """Cached exposition renderer, created on first scrape"""
+        renderer = self._renderers.get(openmetrics)
+        if renderer is None:
+            renderer = self._renderers[openmetrics] = ExpositionRenderer(self, openmetrics)
+        return renderer
+    
+    def scrape(self, accept: str = '', accept_encoding: str = '') -> Tuple[bytes, Dict[str, str]]:
+        """Body and headers for an HTTP scrape, negotiated from Accept / Accept-Encoding"""
+        renderer = self.renderer(_accepts(accept, 'application/openmetrics-text'))
+        compress = _accepts(accept_encoding, 'gzip')
+        headers = {'Content-Type': renderer.content_type}
+        if compress:
+            headers['Content-Encoding'] = 'gzip'
+        return renderer.render_bytes(compress), headers
+
+# ----------------------------------------------------------------------------
+# Text exposition (Prometheus 0.0.4 / OpenMetrics 1.0)
+# ----------------------------------------------------------------------------
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+_INVALID_METRIC_CHARS = re.compile(r'[^a-zA-Z0-9_:]')
+_INVALID_LABEL_CHARS = re.compile(r'[^a-zA-Z0-9_]')
+_EXPOSITION_TYPES = ('counter', 'gauge', 'histogram')
+
+def _sanitize_name(name: str, invalid=_INVALID_METRIC_CHARS) -> str:
+    name = invalid.sub('_', str(name))
+    return '_' + name if not name or name[0].isdigit() else name
+
+def _escape_label_value(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value: Union[int, float]) -> str:
+    if isinstance(value, int):
+        return str(value)
+    value = float(value)
+    if value != value:
+        return 'NaN'
+    if value in (math.inf, -math.inf):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+def _label_pairs(labels: Dict[str, Any]) -> str:
+    """Escaped name="value" pairs sorted by label name, without braces"""
+    return ','.join(f'{_sanitize_name(k, _INVALID_LABEL_CHARS)}="{_escape_label_value(v)}"'
+                    for k, v in sorted(labels.items()))
+
+def _accepts(header: str, token: str) -> bool:
+    """Whether an Accept / Accept-Encoding header lists token without q=0"""
+    for entry in header.lower().split(','):
+        value, _, params = entry.partition(';')
+        if value.strip() != token:
+            continue
+        for param in params.split(';'):
+            key, _, quality = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    return float(quality) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+def _family_names(name: str, metric_type: str, openmetrics: bool) -> Tuple[str, str]:
+    """(family name, sample name); OpenMetrics counters expose name_total under family name"""
+    name = _sanitize_name(name)
+    if openmetrics and metric_type == 'counter':
+        family = name[:-6] if name.endswith('_total') else name
+        return family, family + '_total'
+    return name, name
+
+def _family_header(family: str, metric_type: str, documentation: Optional[str],
+                   openmetrics: bool) -> str:
+    header = ''
+    if documentation:
+        help_text = documentation.replace('\\', '\\\\').replace('\n', '\\n')
+        if openmetrics:
+            help_text = help_text.replace('"', '\\"')
+        header = f'# HELP {family} {help_text}\n'
+    if metric_type not in _EXPOSITION_TYPES:
+        metric_type = 'unknown' if openmetrics else 'untyped'
+    return f'{header}# TYPE {family} {metric_type}\n'
+
+def _scalar_lines(sample: str, pairs: str, value: Union[int, float]) -> str:
+    if pairs:
+        return f'{sample}{{{pairs}}} {_format_value(value)}\n'
+    return f'{sample} {_format_value(value)}\n'
+
+def _histogram_lines(sample: str, pairs: str, buckets: Dict[str, int],
+                     total: float, count: int) -> str:
+    prefix = f'{sample}_bucket{{{pairs},le="' if pairs else f'{sample}_bucket{{le="'
+    lines = [f'{prefix}{le}"}} {cumulative}\n' for le, cumulative in buckets.items()]
+    suffix = f'{{{pairs}}}' if pairs else ''
+    lines.append(f'{sample}_sum{suffix} {_format_value(total)}\n')
+    lines.append(f'{sample}_count{suffix} {count}\n')
+    return ''.join(lines)
+
+def _render_prometheus(aggregated: Dict[str, Any], descriptions: Optional[Dict[str, str]] = None,
+                       openmetrics: bool = False) -> str:
+    """Render get_aggregated_metrics()-shaped data as Prometheus or OpenMetrics text"""
+    descriptions = descriptions or {}
+    parts = []
+    
+    for name, metric_data in aggregated.items():
+        if not metric_data:
+            continue
+        metric_type = next(iter(metric_data.values())).get('type', 'untyped')
+        family, sample = _family_names(name, metric_type, openmetrics)
+        parts.append(_family_header(family, metric_type, descriptions.get(name), openmetrics))
+        
+        for data in metric_data.values():
+            pairs = _label_pairs(data['labels'])
+            if 'buckets' in data:
+                # Cumulative buckets plus _sum and _count
+                parts.append(_histogram_lines(sample, pairs, data['buckets'], data['sum'], data['count']))
+            else:
+                parts.append(_scalar_lines(sample, pairs, data['value']))
+    
+    if openmetrics:
+        parts.append('# EOF\n')
+    return ''.join(parts)
+
+class ExpositionRenderer:
+    """
+    Incremental text exposition for an AsyncMetricsCollector
+    
+    Features:
+    - Rendered lines cached per series; a scrape re-renders only series
+      the collector aggregated into since the previous scrape
+    - Per-family text cached and re-joined only when a member changed
+    - # HELP / # TYPE headers, name sanitizing and label value escaping
+    - Prometheus 0.0.4 or OpenMetrics 1.0 text, optionally gzipped
+      (the compressed body is reused until something changes)
+    """
+    
+    def __init__(self, collector: AsyncMetricsCollector, openmetrics: bool = False):
+        self.collector = collector
+        self.openmetrics = openmetrics
+        self.content_type = OPENMETRICS_CONTENT_TYPE if openmetrics else PROMETHEUS_CONTENT_TYPE
+        # series id -> (family, sample name, escaped label pairs)
+        self._series_meta: Dict[int, tuple] = {}
+        # family -> {'metric', 'type', 'series': {series id: text}, 'text'}
+        self._families: Dict[str, Dict[str, Any]] = {}
+        self._stale: set = set(collector.aggregated_metrics)
+        self._text: Optional[str] = None
+        self._compressed: Optional[bytes] = None
+    
+    def invalidate(self, series_ids: Iterable[int]):
+        """Mark series for re-rendering at the next scrape"""
+        self._stale.update(series_ids)
+    
+    def invalidate_family(self, name: str):
+        """Rebuild a family's header (e.g. after its HELP text changed)"""
+        for family in self._families.values():
+            if family['metric'] == name:
+                family['text'] = None
+                self._text = None
+    
+    def render(self) -> str:
+        """Full exposition text, re-rendering only stale series"""
+        if self._stale:
+            stale, self._stale = self._stale, set()
+            for series_id in stale:
+                self._render_series(series_id)
+        
+        if self._text is None:
+            parts = []
+            descriptions = self.collector.descriptions
+            for name, family in self._families.items():
+                if family['text'] is None:
+                    header = _family_header(name, family['type'],
+                                            descriptions.get(family['metric']), self.openmetrics)
+                    family['text'] = header + ''.join(family['series'].values())
+                parts.append(family['text'])
+            if self.openmetrics:
+                parts.append('# EOF\n')
+            self._text = ''.join(parts)
+            self._compressed = None
+        return self._text
+    
+    def render_bytes(self, compress: bool = False) -> bytes:
+        """Encoded exposition, gzipped if requested"""
+        text = self.render()
+        if not compress:
+            return text.encode('utf-8')
+        if self._compressed is None:
+            self._compressed = gzip.compress(text.encode('utf-8'), compresslevel=6)
+        return self._compressed
+    
+    def _render_series(self, series_id: int):
+        data = self.collector.aggregated_metrics.get(series_id)
+        meta = self._series_meta.get(series_id)
+        self._text = None
+        
+        if data is None:
+            # Series no longer aggregated; drop it (and its family once empty)
+            if meta is not None:
+                del self._series_meta[series_id]
+                family = self._families[meta[0]]
+                del family['series'][series_id]
+                family['text'] = None
+                if not family['series']:
+                    del self._families[meta[0]]
+            return
+        
+        histogram = data.get('histogram')
+        if meta is None:
+            series = self.collector.series
+            metric_type = 'histogram' if histogram is not None else data['type']
+            name = series.names[series_id]
+            family_name, sample = _family_names(name, metric_type, self.openmetrics)
+            if family_name not in self._families:
+                self._families[family_name] = {'metric': name, 'type': metric_type, 'series': {}, 'text': None}
+            meta = self._series_meta[series_id] = (family_name, sample,
+                                                   _label_pairs(dict(series.labels[series_id])))
+        
+        family_name, sample, pairs = meta
+        if histogram is not None:
+            text = _histogram_lines(sample, pairs, histogram.cumulative_buckets(),
+                                    histogram.sum, histogram.count)
+        else:
+            text = _scalar_lines(sample, pairs, data['value'])
+        family = self._families[family_name]
+        family['series'][series_id] = text
+        family['text'] = None
+
+class MultiprocessMetricsView:
+    """
+    Merged, read-only view over the series tables of all worker processes
+    
+    Features:
+    - Reads every worker file in the directory; no IPC with workers
+    - Counters, histogram counts, sums and buckets are summed
+    - Histogram min/max are combined; quantiles come from the merged buckets
+    - Gauges merged by gauge_mode: 'latest', 'sum', 'max' or 'min'
+    
+    Files of exited workers keep contributing (counters must not go
+    backwards); call remove_worker() to drop a worker's series.
+    Native histograms from workers at different schemas are merged by
+    bucket upper bound, which is approximate.
+    """
+    
+    GAUGE_MODES = ('latest', 'sum', 'max', 'min')
+    
+    def __init__(self, directory: str, gauge_mode: str = 'latest'):
+        if gauge_mode not in self.GAUGE_MODES:
+            raise ValueError(f"Unsupported gauge mode: {gauge_mode}")
+        self.directory = directory
+        self.gauge_mode = gauge_mode
+    
+    def worker_files(self) -> List[str]:
+        prefix, suffix = SharedSeriesWriter.FILE_PREFIX, SharedSeriesWriter.FILE_SUFFIX
+        return sorted(
+            os.path.join(self.directory, name) for name in os.listdir(self.directory)
+            if name.startswith(prefix) and name.endswith(suffix)
+        )
+    
+    def remove_worker(self, pid: int) -> bool:
+        """Delete an exited worker's file"""
+        path = os.path.join(self.directory, f'{SharedSeriesWriter.FILE_PREFIX}{pid}{SharedSeriesWriter.FILE_SUFFIX}')
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+    
+    def collect(self) -> Dict[str, Any]:
+        """Merged metrics in the same shape as AsyncMetricsCollector.get_aggregated_metrics"""
+        # (name, label_key, type) -> field -> per-worker values
+        series: Dict[tuple, Dict[str, List[float]]] = defaultdict(lambda: defaultdict(list))
+        for path in self.worker_files():
+            for key, value in SharedSeriesWriter.read_file(path).items():
+                name, label_key, metric_type, field = json.loads(key)
+                series[(name, label_key, metric_type)][field].append(value)
+        
+        result: Dict[str, Any] = {}
+        for (name, label_key, metric_type), fields in series.items():
+            entry = self._merge(metric_type, fields)
+            if entry is None:
+                continue
+            entry['type'] = metric_type
+            entry['labels'] = json.loads(label_key)
+            entry['last_update'] = datetime.fromtimestamp(max(fields['ts'])).isoformat()
+            result.setdefault(name, {})[label_key] = entry
+        return result
+    
+    def _merge(self, metric_type: str, fields: Dict[str, List[float]]) -> Optional[Dict[str, Any]]:
+        if metric_type == 'counter':
+            return {'value': sum(fields['value']), 'count': int(sum(fields['count']))}
+        
+        if metric_type == 'gauge':
+            values = fields['value']
+            if self.gauge_mode == 'latest':
+                value = max(zip(fields['ts'], values))[1]
+            elif self.gauge_mode == 'sum':
+                value = sum(values)
+            else:
+                value = max(values) if self.gauge_mode == 'max' else min(values)
+            return {'value': value}
         
-        return '\n'.join(lines)
+        if metric_type == 'histogram':
+            count = int(sum(fields['count']))
+            if count == 0:
+                return None
+            bounds = sorted((float(field[3:]), sum(values))
+                            for field, values in fields.items() if field.startswith('le:'))
+            finite = tuple(bound for bound, _ in bounds if bound != math.inf)
+            histogram = BucketHistogram(finite)
+            bucket_counts = [int(total) for bound, total in bounds if bound != math.inf]
+            bucket_counts.append(int(sum(total for bound, total in bounds if bound == math.inf)))
+            histogram.merge_counts(bucket_counts, count, sum(fields['sum']),
+                                   min(fields['min']), max(fields['max']))
+            return {
+                'count': count,
+                'sum': histogram.sum,
+                'min': histogram.min,
+                'max': histogram.max,
+                'avg': histogram.sum / count,
+                'p50': histogram.quantile(0.5),
+                'p99': histogram.quantile(0.99),
+                'buckets': histogram.cumulative_buckets()
+            }
+        return None
+    
+    def export_metrics(self, format_type: str = 'prometheus') -> str:
+        """Export the merged view in the specified format"""
+        if format_type in ('prometheus', 'openmetrics'):
+            return _render_prometheus(self.collect(), openmetrics=format_type == 'openmetrics')
+        elif format_type == 'json':
+            return json.dumps(self.collect(), indent=2)
+        else:
+            raise ValueError(f"Unsupported format: {format_type}")
 
 
 # ============================================================================
@@ -672,17 +4953,20 @@ class IntelligentAlertingSystem:
         self.notification_channels: Dict[str, Callable] = {}
         
         # Alert metrics
-        self.alerts_total = Counter(
+        self.alerts_total = shared_metric(
+            Counter,
             'alerts_total',
             'Total alerts generated',
             ['rule', 'severity', 'status']
         )
-        self.alert_duration = Histogram(
+        self.alert_duration = shared_metric(
+            Histogram,
             'alert_duration_seconds',
             'Alert duration in seconds',
             ['rule', 'severity']
         )
-        self.active_alerts_gauge = Gauge(
+        self.active_alerts_gauge = shared_metric(
+            Gauge,
             'active_alerts',
             'Number of active alerts',
             ['severity']
@@ -883,17 +5167,20 @@ class PerformanceMonitor:
     
     def __init__(self, name: str = None):
         self.name = name
-        self.execution_time = Histogram(
+        self.execution_time = shared_metric(
+            Histogram,
             'function_execution_time_seconds',
             'Function execution time',
             ['function', 'status']
         )
-        self.function_calls = Counter(
+        self.function_calls = shared_metric(
+            Counter,
             'function_calls_total',
             'Total function calls',
             ['function', 'status']
         )
-        self.memory_usage = Histogram(
+        self.memory_usage = shared_metric(
+            Histogram,
             'function_memory_usage_bytes',
             'Function memory usage',
             ['function']
@@ -979,6 +5266,400 @@ class PerformanceMonitor:
             self.memory_usage.labels(function=function_name).observe(memory_used)
 
 
+# ============================================================================
+# BENCHMARKS
+# ============================================================================
+
+@dataclass
+class _DataclassSpan:
+    """Previous dataclass span layout, kept as the benchmark baseline"""
+    trace_id: str
+    span_id: str
+    parent_span_id: Optional[str]
+    operation_name: str
+    start_time: datetime
+    end_time: Optional[datetime]
+    tags: Dict[str, Any]
+    logs: List[Dict[str, Any]]
+    status: str = 'started'
+
+def _span_lifecycle_dataclass(i: int) -> _DataclassSpan:
+    span = _DataclassSpan('trace', str(i), None, 'operation', datetime.now(), None,
+                          {'service': 'bench'}, [])
+    span.logs.append({'timestamp': datetime.now().isoformat(), 'event': 'event', 'fields': {}})
+    span.end_time = datetime.now()
+    span.status = 'success'
+    return span
+
+def _span_lifecycle_slots(i: int) -> Span:
+    # Integer ids from the same generators DistributedTracer uses
+    span = Span(generate_trace_id(), generate_span_id(), None, 'operation', 'bench')
+    span.add_log('event', {})
+    span.end_ns = time.monotonic_ns()
+    span.status = 'success'
+    return span
+
+def benchmark_span_representation(iterations: int = 100000) -> Dict[str, Dict[str, float]]:
+    """Compare spans/sec and bytes/span of the dataclass and slot-based spans"""
+    import tracemalloc
+
+    results = {}
+    for label, lifecycle in (('dataclass', _span_lifecycle_dataclass),
+                             ('slots', _span_lifecycle_slots)):
+        # Throughput
+        start = time.perf_counter()
+        for i in range(iterations):
+            lifecycle(i)
+        elapsed = time.perf_counter() - start
+
+        # Retained memory per span
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        retained = [lifecycle(i) for i in range(iterations)]
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del retained
+
+        results[label] = {
+            'spans_per_sec': iterations / elapsed,
+            'bytes_per_span': (after - before) / iterations
+        }
+
+    return results
+
+def _time_calls(run: Callable[[int], None], iterations: int, repeats: int = 3) -> float:
+    """Best-of-N wall time per call in nanoseconds"""
+    best = math.inf
+    for _ in range(repeats):
+        start = time.perf_counter_ns()
+        run(iterations)
+        best = min(best, time.perf_counter_ns() - start)
+    return best / iterations
+
+def _allocations_per_call(run: Callable[[int], None], iterations: int) -> Dict[str, float]:
+    """
+    Net memory blocks and bytes left allocated per call. CPython does not
+    expose a cumulative allocation count, so this measures what a call
+    retains (tracemalloc) plus the peak transient footprint.
+    """
+    import tracemalloc
+    
+    # Start from a collected heap so garbage left by earlier benchmarks isn't counted
+    gc.collect()
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    tracemalloc.start()
+    try:
+        # Traced warm-up, so evicting objects from bounded stores is seen as a free
+        run(iterations)
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        run(iterations)
+        current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+        if gc_was_enabled:
+            gc.enable()
+    
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return {
+        'alloc_blocks_per_call': blocks / iterations,
+        'alloc_bytes_per_call': (current_bytes - start_bytes) / iterations,
+        'peak_bytes_per_call': (peak_bytes - start_bytes) / iterations
+    }
+
+def _thread_scaling(run: Callable[[int], None], iterations: int,
+                    thread_counts: Iterable[int] = (1, 2, 4, 8)) -> Dict[str, Dict[str, float]]:
+    """Aggregate calls/sec with the same total work split across N threads"""
+    scaling = {}
+    single = None
+    for threads in thread_counts:
+        per_thread = max(1, iterations // threads)
+        barrier = threading.Barrier(threads + 1)
+        
+        def worker():
+            barrier.wait()
+            run(per_thread)
+        
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in workers:
+            thread.join()
+        calls_per_sec = per_thread * threads / (time.perf_counter() - start)
+        single = single or calls_per_sec
+        scaling[str(threads)] = {
+            'calls_per_sec': calls_per_sec,
+            'efficiency': calls_per_sec / single
+        }
+    return scaling
+
+def _bench_breaker_call() -> Callable[[int], None]:
+    breaker = IntelligentCircuitBreaker('bench')
+    call = breaker.call
+    noop = lambda: None
+    
+    def run(n: int):
+        for _ in range(n):
+            call(noop)
+    return run
+
+def _bench_monitor_sync() -> Callable[[int], None]:
+    @PerformanceMonitor('bench_sync')
+    def noop():
+        return None
+    
+    def run(n: int):
+        for _ in range(n):
+            noop()
+    return run
+
+def _bench_monitor_async() -> Callable[[int], None]:
+    @PerformanceMonitor('bench_async')
+    async def noop():
+        return None
+    
+    async def loop(n: int):
+        for _ in range(n):
+            await noop()
+    
+    return lambda n: asyncio.run(loop(n))
+
+def _bench_tracer_span() -> Callable[[int], None]:
+    # Small store so the benchmark measures steady-state eviction, not growth
+    tracer = DistributedTracer('bench', max_spans=1000)
+    start_trace = tracer.start_trace
+    finish_span = tracer.finish_span
+    
+    def run(n: int):
+        for _ in range(n):
+            finish_span(start_trace('operation'))
+    return run
+
+def _drain_collector(collector: 'AsyncMetricsCollector'):
+    """Stand in for the collector task so benchmarks never hit the overflow policy"""
+    while not collector.metrics_queue.empty():
+        collector.metrics_queue.get_nowait()
+    collector._take_staging()
+    collector.pending = 0
+
+def _bench_record_metric() -> Callable[[int], None]:
+    labels = {'endpoint': '/api/users', 'method': 'GET'}
+    
+    async def loop(n: int):
+        collector = AsyncMetricsCollector(max_pending=100000)
+        record = collector.record_metric
+        for i in range(n):
+            await record('bench_metric', float(i), labels)
+            if collector.pending >= 50000:
+                _drain_collector(collector)
+    
+    return lambda n: asyncio.run(loop(n))
+
+def _bench_record_nowait() -> Callable[[int], None]:
+    labels = {'endpoint': '/api/users', 'method': 'GET'}
+    collector = AsyncMetricsCollector(max_pending=100000)
+    record = collector.record_nowait
+    
+    def run(n: int):
+        for i in range(n):
+            record('bench_metric', float(i), labels)
+            if collector.pending >= 50000:
+                _drain_collector(collector)
+    return run
+
+def _bench_record_many() -> Callable[[int], None]:
+    labels = {'endpoint': '/api/users', 'method': 'GET'}
+    collector = AsyncMetricsCollector(max_pending=100000)
+    samples = [('bench_metric', float(i), labels) for i in range(1000)]
+    
+    def run(n: int):
+        # n counts samples, ingested 1000 per call
+        for _ in range(max(1, n // 1000)):
+            collector.record_many(samples)
+            if collector.pending >= 50000:
+                _drain_collector(collector)
+    return run
+
+def _bench_aggregate(columnar: bool) -> Callable[[], Callable[[int], None]]:
+    def factory() -> Callable[[int], None]:
+        collector = AsyncMetricsCollector(columnar=columnar, columnar_min_batch=1)
+        now = time.time()
+        # A fresh labels dict per sample, as callers usually pass them
+        batch = [('bench_requests_total', 1.0, {'endpoint': f'/api/{i % 50}', 'method': 'GET'},
+                  'counter', now) for i in range(1000)]
+        
+        async def loop(n: int):
+            # n counts samples, aggregated 1000 per batch
+            for _ in range(max(1, n // 1000)):
+                await collector._process_batch(batch)
+        
+        return lambda n: asyncio.run(loop(n))
+    return factory
+
+# name -> (factory, supports thread scaling, relative cost: iterations divisor)
+MICRO_BENCHMARKS: Dict[str, tuple] = {
+    'circuit_breaker.call': (_bench_breaker_call, True, 1),
+    'performance_monitor.sync': (_bench_monitor_sync, True, 20),
+    'performance_monitor.async': (_bench_monitor_async, False, 20),
+    'tracer.start_trace+finish_span': (_bench_tracer_span, True, 1),
+    'metrics_collector.record_metric': (_bench_record_metric, False, 1),
+    'metrics_collector.record_nowait': (_bench_record_nowait, False, 1),
+    'metrics_collector.record_many': (_bench_record_many, False, 1),
+    'metrics_collector.aggregate_scalar': (_bench_aggregate(False), False, 1),
+}
+if np is not None:
+    MICRO_BENCHMARKS['metrics_collector.aggregate_columnar'] = (_bench_aggregate(True), False, 1)
+
+def _run_isolated(name: str, iterations: int, thread_counts: Iterable[int]) -> Dict[str, Any]:
+    """Run one wrapper benchmark in a fresh interpreter and return its result"""
+    import subprocess
+    
+    command = [sys.executable, os.path.abspath(__file__), 'benchmark', '--worker', name,
+               '--iterations', str(iterations), '--threads', ','.join(map(str, thread_counts))]
+    output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+    return json.loads(output)[name]
+
+def benchmark_wrappers(iterations: int = 50000, names: Optional[Iterable[str]] = None,
+                       thread_counts: Iterable[int] = (1, 2, 4, 8),
+                       isolated: bool = False) -> Dict[str, Dict[str, Any]]:
+    """
+    Per-call cost, allocations and thread scaling of each instrumentation
+    wrapper. With isolated=True each benchmark runs in its own process, so
+    its allocation counts don't depend on what ran before it.
+    """
+    results = {}
+    for name in (names or MICRO_BENCHMARKS):
+        if name not in MICRO_BENCHMARKS:
+            raise ValueError(f"Unknown benchmark: {name}")
+        if isolated:
+            results[name] = _run_isolated(name, iterations, thread_counts)
+            continue
+        factory, threaded, cost = MICRO_BENCHMARKS[name]
+        count = max(100, iterations // cost)
+        run = factory()
+        
+        # Warm up caches, labeled children and bounded stores
+        run(min(count, 1000))
+        
+        result = {'iterations': count, 'ns_per_call': _time_calls(run, count)}
+        result.update(_allocations_per_call(run, max(100, count // 10)))
+        if threaded:
+            result['thread_scaling'] = _thread_scaling(run, count, thread_counts)
+        results[name] = result
+    return results
+
+def compare_to_baseline(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]],
+                        tolerance: float = 0.25) -> List[Dict[str, Any]]:
+    """List per-call time and allocation regressions beyond tolerance"""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for key in ('ns_per_call', 'alloc_blocks_per_call'):
+            old, new = previous.get(key), result.get(key)
+            if old is None or new is None:
+                continue
+            # Allow a little absolute slack so near-zero allocation counts don't flap
+            limit = old * (1 + tolerance) + (0.5 if key == 'alloc_blocks_per_call' else 0)
+            if new > limit:
+                regressions.append({
+                    'benchmark': name,
+                    'metric': key,
+                    'baseline': old,
+                    'current': new,
+                    'change': (new - old) / old if old else math.inf
+                })
+    return regressions
+
+def run_benchmarks(argv: Optional[List[str]] = None) -> int:
+    """Run benchmarks, print a summary and optionally write JSON or check a baseline"""
+    import argparse
+    import platform
+    
+    parser = argparse.ArgumentParser(prog='observability-monitoring-patterns.py benchmark')
+    parser.add_argument('--iterations', type=int, default=50000,
+                        help='calls per wrapper benchmark (expensive wrappers run fewer)')
+    parser.add_argument('--only', action='append', choices=list(MICRO_BENCHMARKS),
+                        help='run only this wrapper benchmark (repeatable)')
+    parser.add_argument('--threads', default='1,2,4,8', help='thread counts for scaling runs')
+    parser.add_argument('--json', dest='json_path', help='write results as JSON ("-" for stdout)')
+    parser.add_argument('--baseline', help='JSON file from a previous --json run to compare against; '
+                        'observability-monitoring-baseline.json is the committed reference run, '
+                        'refresh it with --json when hardware or Python changes')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative slowdown before a regression is reported')
+    parser.add_argument('--skip-spans', action='store_true',
+                        help='skip the span representation benchmark')
+    parser.add_argument('--in-process', action='store_true',
+                        help='run wrapper benchmarks in this process instead of one process each')
+    parser.add_argument('--worker', choices=list(MICRO_BENCHMARKS), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    out = sys.stderr if args.json_path == '-' else sys.stdout
+    thread_counts = [int(n) for n in args.threads.split(',')]
+    
+    if args.worker:
+        # Child of an isolated run: one benchmark, JSON on stdout
+        json.dump(benchmark_wrappers(args.iterations, [args.worker], thread_counts), sys.stdout)
+        return 0
+    
+    report: Dict[str, Any] = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count()
+        }
+    }
+    
+    if not args.skip_spans:
+        print("⏱️  Span Representation Benchmark", file=out)
+        print("=" * 50, file=out)
+        report['span_representation'] = benchmark_span_representation()
+        for label, result in report['span_representation'].items():
+            print(f"  {label:<10} {result['spans_per_sec']:>12,.0f} spans/sec "
+                  f"{result['bytes_per_span']:>8.0f} bytes/span", file=out)
+    
+    print("\n⏱️  Wrapper Overhead Benchmark", file=out)
+    print("=" * 50, file=out)
+    report['wrappers'] = benchmark_wrappers(args.iterations, args.only, thread_counts,
+                                            isolated=not args.in_process)
+    for name, result in report['wrappers'].items():
+        line = (f"  {name:<34} {result['ns_per_call']:>10,.0f} ns/call "
+                f"{result['alloc_blocks_per_call']:>6.2f} blocks/call")
+        if 'thread_scaling' in result:
+            line += '  scaling ' + ' '.join(
+                f"{threads}t={stats['efficiency']:.2f}" for threads, stats in result['thread_scaling'].items()
+            )
+        print(line, file=out)
+    
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(report['wrappers'], baseline.get('wrappers', {}), args.tolerance)
+        report['baseline'] = {'path': args.baseline, 'tolerance': args.tolerance, 'regressions': regressions}
+        print(f"\nBaseline {args.baseline}: {len(regressions)} regression(s)", file=out)
+        for regression in regressions:
+            print(f"  ❌ {regression['benchmark']} {regression['metric']}: "
+                  f"{regression['baseline']:.2f} -> {regression['current']:.2f} "
+                  f"({regression['change']:+.0%})", file=out)
+    
+    if args.json_path == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    
+    return 1 if regressions else 0
+
 # ============================================================================
 # DEMO AND INTEGRATION EXAMPLES
 # ============================================================================
@@ -1190,6 +5871,9 @@ async def main():
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        sys.exit(run_benchmarks(sys.argv[2:]))
+    
     # Start Prometheus metrics server
     prometheus_client.start_http_server(8000)
     print("📊 Prometheus metrics available at http://localhost:8000/metrics")
@@ -0,0 +1,1205 @@
+"""Regression tests for observability-monitoring-patterns.py"""
+
+import asyncio
+import gzip
+import importlib.util
+import os
+import random
+import time
+from datetime import datetime
+
+import pytest
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'observability-monitoring-patterns.py')
+
+
+@pytest.fixture(scope='session')
+def omp():
+    # The script's file name is not importable, and it registers Prometheus
+    # metrics on import, so load it once per session
+    spec = importlib.util.spec_from_file_location('observability_monitoring_patterns', MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_gradient_limit_stays_bounded_when_app_limited(omp):
+    limiter = omp.AdaptiveConcurrencyLimiter('test_app_limited', initial_limit=4, max_limit=1000)
+    for _ in range(1000):
+        assert limiter.acquire(timeout=0)
+        limiter.release(0.01)
+    assert limiter.limit <= 4
+
+
+def test_gradient_limit_grows_when_saturated(omp):
+    limiter = omp.AdaptiveConcurrencyLimiter('test_saturated', initial_limit=4, max_limit=1000)
+    for _ in range(20):
+        held = int(limiter.limit)
+        for _ in range(held):
+            assert limiter.acquire(timeout=0)
+        for _ in range(held):
+            limiter.release(0.01)
+    assert limiter.limit > 4
+
+
+def _raise(error):
+    raise error
+
+
+def test_limiter_backs_off_only_on_overload_errors(omp):
+    limiter = omp.AdaptiveConcurrencyLimiter('test_drop_kinds', initial_limit=10, algorithm='aimd')
+    # Fast application errors are ordinary latency samples
+    for error in (ValueError('bad input'), KeyError('missing')):
+        with pytest.raises(type(error)):
+            limiter.call(_raise, error)
+    assert limiter.limit == 10 and limiter.in_flight == 0
+    
+    for error in (TimeoutError(), omp.ConcurrencyLimitExceeded(), omp.requests.exceptions.ReadTimeout()):
+        with pytest.raises(type(error)):
+            limiter.call(_raise, error)
+    assert limiter.limit == pytest.approx(10 * 0.9 ** 3)
+    
+    async def timed_out():
+        await asyncio.wait_for(asyncio.sleep(1), 0.001)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(limiter.call_async(timed_out))
+    assert limiter.limit == pytest.approx(10 * 0.9 ** 4) and limiter.in_flight == 0
+
+
+def test_limiter_drop_exceptions_are_configurable(omp):
+    limiter = omp.AdaptiveConcurrencyLimiter('test_drop_custom', initial_limit=10, algorithm='aimd',
+                                             drop_exceptions=(ConnectionError,))
+    with pytest.raises(TimeoutError):
+        limiter.call(_raise, TimeoutError())
+    assert limiter.limit == 10
+    with pytest.raises(ConnectionResetError):
+        with limiter.limit_scope():
+            raise ConnectionResetError()
+    assert limiter.limit == 9
+
+
+def _trip(breaker):
+    def fail():
+        raise RuntimeError('down')
+    while breaker.state == 'closed':
+        try:
+            breaker.call(fail)
+        except Exception:
+            pass
+
+
+def test_registry_capacity_eviction_keeps_tripped_breakers(omp):
+    registry = omp.CircuitBreakerRegistry(max_breakers=2, failure_threshold=1)
+    _trip(registry.get('test-down-1'))
+    _trip(registry.get('test-down-2'))
+    registry.get('test-healthy')
+    
+    # Over the cap rather than dropping protection for failing hosts
+    states = registry.get_states()
+    assert len(registry) == 3
+    assert states['test-down-1']['state'] != omp.CircuitBreakerState.CLOSED
+    
+    # A CLOSED breaker is evicted first once one exists
+    registry.get('test-new')
+    assert 'test-healthy' not in registry.get_states()
+    assert 'test-down-1' in registry.get_states()
+
+
+def test_collector_keeps_gauge_last_write_wins_across_staging(omp):
+    async def scenario():
+        collector = omp.AsyncMetricsCollector(batch_size=100, chunk_size=64, flush_interval=0.05,
+                                              max_pending=100000)
+        for i in range(3000):
+            collector.record_nowait('test_gauge', i, {'k': 'v'})
+        await collector.start()
+        await asyncio.sleep(0.2)
+        await collector.stop()
+        return collector.get_aggregated_metrics()['test_gauge']['{"k": "v"}']['value']
+    
+    assert asyncio.run(scenario()) == 2999
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+def test_forked_workers_publish_only_their_own_samples(omp, tmp_path):
+    collector = omp.AsyncMetricsCollector(multiprocess_dir=str(tmp_path))
+    
+    def record(value):
+        asyncio.run(collector._process_batch([('test_forked_total', value, None, 'counter', 1.0)]))
+    
+    record(100)
+    children = []
+    for _ in range(2):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                record(10)
+                code = 0
+            finally:
+                os._exit(code)
+        children.append(pid)
+    for pid in children:
+        _, status = os.waitpid(pid, 0)
+        assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    
+    merged = omp.MultiprocessMetricsView(str(tmp_path)).collect()
+    assert merged['test_forked_total']['{}']['value'] == 120
+
+
+def test_wal_restart_keeps_rollup_baselines(omp, tmp_path):
+    async def record(collector, counter, observation):
+        now = time.time()
+        await collector._process_batch([('test_wal_total', counter, None, 'counter', now),
+                                        ('test_wal_seconds', observation, None, 'histogram', now)])
+        await collector.stop()
+    
+    options = dict(wal_dir=str(tmp_path), rollups=True, wal_fsync=False)
+    first = omp.AsyncMetricsCollector(**options)
+    asyncio.run(record(first, 1000, 0.5))
+    
+    restarted = omp.AsyncMetricsCollector(**options)
+    assert restarted.get_aggregated_metrics()['test_wal_total']['{}']['value'] == 1000
+    asyncio.run(record(restarted, 5, 0.25))
+    
+    # Only the increase since the restart, not the recovered total
+    assert restarted.get_window_stats('test_wal_total')['sum'] == 5
+    assert restarted.get_window_stats('test_wal_seconds')['count'] == 1
+
+
+def _aggregate(collector, samples, columnar=False):
+    """Run samples of (name, value, labels, metric_type) through one batch"""
+    batch = [(name, value, labels, metric_type, 1.0) for name, value, labels, metric_type in samples]
+    if columnar:
+        collector._aggregate_columnar(batch)
+    else:
+        for sample in batch:
+            collector._aggregate_metric(*sample)
+
+
+@pytest.mark.parametrize('columnar', [False, True])
+def test_per_metric_limit_folds_only_high_cardinality_labels(omp, columnar):
+    if columnar and omp.np is None:
+        pytest.skip('requires numpy')
+    collector = omp.AsyncMetricsCollector(max_series_per_metric=20, columnar=columnar)
+    samples = [('test_requests_total', 1, {'method': method, 'user': f'u{i}'}, 'counter')
+               for i in range(100) for method in ('GET', 'POST')]
+    _aggregate(collector, samples, columnar)
+    
+    series = collector.get_aggregated_metrics()['test_requests_total']
+    overflow = {key: data['value'] for key, data in series.items() if '__overflow__' in key}
+    assert overflow == {'{"method": "GET", "user": "__overflow__"}': 90,
+                        '{"method": "POST", "user": "__overflow__"}': 90}
+    assert sum(data['value'] for data in series.values()) == 200
+    
+    top = collector.series.top_offenders(1)[0]
+    assert (top['metric'], top['label'], top['rejected_samples']) == ('test_requests_total', 'user', 180)
+
+
+def test_per_metric_overflow_series_are_bounded(omp):
+    table = omp.SeriesTable(max_series_per_metric=5)
+    for i in range(1000):
+        table.intern('test_exploding', {'a': f'a{i}', 'b': f'b{i % 50}', 'c': f'c{i}'})
+    assert len(table) <= 5 + table.OVERFLOW_SERIES_PER_METRIC + 1
+    assert table.rejected['test_exploding'] == 995
+
+
+@pytest.mark.parametrize('columnar', [False, True])
+def test_global_limit_sends_new_names_to_overflow_series(omp, columnar):
+    if columnar and omp.np is None:
+        pytest.skip('requires numpy')
+    collector = omp.AsyncMetricsCollector(max_series=50, columnar=columnar)
+    samples = [(f'test_metric_{i}_total', 1, None, 'counter') for i in range(100)]
+    samples += [('test_noisy_total', 1, None, 'counter')] * 30
+    _aggregate(collector, samples, columnar)
+    
+    aggregated = collector.get_aggregated_metrics()
+    overflow = aggregated['metrics_overflow_counter']['{}']['value']
+    assert overflow == collector.series.rejected_new_metrics == 80
+    assert sum(next(iter(series.values()))['value'] for series in aggregated.values()) == 130
+    
+    worst = collector.get_cardinality_report()['top_offenders'][0]
+    assert worst == {'metric': 'test_noisy_total', 'label': None, 'distinct_values': 0,
+                     'rejected_samples': 30}
+
+
+def test_rejected_name_tracking_is_bounded(omp):
+    table = omp.SeriesTable(max_series=1)
+    table.intern('test_admitted', None)
+    for i in range(10000):
+        table.intern(f'test_rejected_{i}', None)
+        table.intern('test_heavy', None)
+    assert len(table.rejected_names) == table.TRACKED_REJECTED_NAMES
+    assert table.top_offenders(1)[0]['metric'] == 'test_heavy'
+
+
+def _store_span(omp, trace_id, span_id):
+    return omp.Span(trace_id, span_id, None, f'op{span_id}', 'svc', start_ns=0, end_ns=1, status='ok')
+
+
+def test_span_store_evicts_least_recently_updated_traces(omp):
+    store = omp.SpanStore(max_spans=6, max_trace_age=None)
+    for trace_id in (1, 2, 3):
+        store.add(_store_span(omp, trace_id, trace_id * 10))
+        store.add(_store_span(omp, trace_id, trace_id * 10 + 1))
+    # Touching trace 1 makes trace 2 the least recently updated
+    store.add(_store_span(omp, 1, 12))
+    
+    assert store.get_trace(2) == [] and len(store) == 5
+    assert [span.span_id for span in store.get_trace(1)] == [10, 11, 12]
+    for span_id in range(40, 46):
+        store.add(_store_span(omp, 4, span_id))
+    
+    stats = store.get_stats()
+    assert len(store) <= store.max_spans
+    assert [span.span_id for span in store] == list(range(40, 46))
+    assert stats['evicted_traces'] == 3 and stats['evicted_spans'] == 7
+    
+    # A single trace larger than the cap is evicted whole
+    for span_id in range(50, 57):
+        store.add(_store_span(omp, 5, span_id))
+    assert len(store) == 0 and store.get_trace(5) == []
+
+
+def test_span_store_expires_traces_past_max_age(omp, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(omp.time, 'monotonic', lambda: clock[0])
+    store = omp.SpanStore(max_spans=100, max_trace_age=10.0)
+    store.add(_store_span(omp, 1, 1))
+    clock[0] += 6
+    store.add(_store_span(omp, 2, 2))
+    clock[0] += 4
+    # Exactly max_trace_age old is kept
+    store.add(_store_span(omp, 3, 3))
+    assert len(store) == 3
+    
+    clock[0] += 0.5
+    store.add(_store_span(omp, 2, 4))
+    assert store.get_trace(1) == [] and store.get_stats()['evicted_traces'] == 1
+    # Trace 3 expires; trace 2 is older but was updated since
+    clock[0] += 9.75
+    store.add(_store_span(omp, 4, 5))
+    assert [trace[0].trace_id for trace in store.iter_traces()] == [2, 4]
+    assert len(store) == 3
+
+
+def _archived_spans(omp, count, traces=4):
+    """Finished spans 1ms apart, spread round-robin over a few traces"""
+    base = time.monotonic_ns()
+    return [omp.Span(1000 + i % traces, i + 1, None, f'op{i}', 'svc', start_ns=base + i * 1_000_000 - 500,
+                     end_ns=base + i * 1_000_000, tags={'i': i}, status='ok')
+            for i in range(count)]
+
+
+def _wall_time(omp, monotonic_ns):
+    return datetime.fromtimestamp((monotonic_ns + omp._WALL_CLOCK_OFFSET_NS) / 1e9)
+
+
+def test_span_archive_reopen_rebuilds_indexes(omp, tmp_path):
+    spans = _archived_spans(omp, 40)
+    archive = omp.SpanArchive(str(tmp_path), segment_size=1024, index_interval=4)
+    archive.write_batch(spans)
+    stats = archive.get_stats()
+    archive.close()
+    assert stats['segments'] > 2
+    
+    reopened = omp.SpanArchive(str(tmp_path), segment_size=1024, index_interval=4)
+    assert reopened.get_stats() == stats
+    restored = reopened.get_trace(1001)
+    assert [span.span_id for span in restored] == list(range(2, 41, 4))
+    original = spans[1]
+    assert (restored[0].operation_name, restored[0].tags, restored[0].status,
+            restored[0].start_ns, restored[0].end_ns) == (original.operation_name, original.tags, original.status,
+                                                          original.start_ns, original.end_ns)
+    
+    # New writes go to a fresh segment and join the rebuilt trace index
+    reopened.write_batch([omp.Span(1001, 99, None, 'late', 'svc', end_ns=time.monotonic_ns())])
+    assert [span.span_id for span in reopened.get_trace(1001)][-1] == 99
+    assert reopened.get_trace(424242) == []
+    reopened.close()
+
+
+def test_span_archive_time_scan_crosses_segment_boundaries(omp, tmp_path):
+    spans = _archived_spans(omp, 40)
+    archive = omp.SpanArchive(str(tmp_path), segment_size=1024, index_interval=4)
+    archive.write_batch(spans)
+    assert len(archive.segments) > 2
+    
+    start = _wall_time(omp, spans[5].end_ns - 500_000)
+    end = _wall_time(omp, spans[25].end_ns + 500_000)
+    found = archive.scan_time_range(start, end)
+    assert sorted(span.span_id for span in found) == list(range(6, 27))
+    
+    first_segment = next(iter(archive.segments.values()))
+    assert len(first_segment.index_times) == -(-first_segment.records // 4)
+    archive.close()
+
+
+@pytest.mark.parametrize('damage', ['truncated', 'garbage'])
+def test_span_archive_drops_damaged_tail_record(omp, tmp_path, damage):
+    spans = _archived_spans(omp, 10, traces=1)
+    archive = omp.SpanArchive(str(tmp_path))
+    archive.write_batch(spans)
+    archive.close()
+    
+    path = next(iter(archive.segments.values())).path
+    intact = os.path.getsize(path)
+    with open(path, 'r+b') as f:
+        if damage == 'truncated':
+            f.truncate(intact - 7)
+        else:
+            f.seek(0, os.SEEK_END)
+            f.write(omp.SpanArchive.RECORD_HEADER.pack(1 << 30, 0, 1000, 1, 0, 0, 0) + b'{"partial')
+    
+    reopened = omp.SpanArchive(str(tmp_path))
+    expected = 9 if damage == 'truncated' else 10
+    assert [span.span_id for span in reopened.get_trace(1000)] == list(range(1, expected + 1))
+    assert os.path.getsize(path) == reopened.get_stats()['bytes']
+    
+    reopened.write_batch([omp.Span(1000, 77, None, 'after', 'svc', end_ns=time.monotonic_ns())])
+    assert reopened.get_trace(1000)[-1].span_id == 77
+    reopened.close()
+
+
+def test_wal_records_after_close_define_their_series(omp, tmp_path):
+    async def scenario():
+        collector = omp.AsyncMetricsCollector(wal_dir=str(tmp_path), wal_fsync=False)
+        for _ in range(2):
+            await collector._process_batch([('test_closed_total', 1, {'k': 'v'}, 'counter', 1.0)])
+            collector.wal.commit()
+        collector.wal.close()
+        # The next commit opens a new log generation
+        await collector._process_batch([('test_closed_total', 1, {'k': 'v'}, 'counter', 1.0)])
+        collector.wal.commit()
+        return collector.wal.generation
+    
+    assert asyncio.run(scenario()) == 1
+    restarted = omp.AsyncMetricsCollector(wal_dir=str(tmp_path), wal_fsync=False)
+    assert restarted.get_aggregated_metrics()['test_closed_total']['{"k": "v"}']['value'] == 3
+
+
+def _exposition_collector(omp, **options):
+    collector = omp.AsyncMetricsCollector(columnar=False, **options)
+    _aggregate(collector, [('http.requests_total', 3, {'path': 'a"b\\c\nd', 'status-code': '200'}, 'counter'),
+                           ('1st_gauge', 2.5, None, 'gauge'),
+                           ('latency_seconds', 0.05, {'op': 'x'}, 'histogram'),
+                           ('latency_seconds', 0.5, {'op': 'x'}, 'histogram'),
+                           ('latency_seconds', 5, {'op': 'x'}, 'histogram')])
+    collector._dirty.clear()
+    collector.describe('http.requests_total', 'Requests "served"\nby path \\ status')
+    collector.describe('latency_seconds', 'Latency')
+    return collector
+
+
+def test_prometheus_exposition_golden(omp):
+    from prometheus_client.parser import text_string_to_metric_families
+    
+    text = _exposition_collector(omp, histogram_buckets=(0.1, 1.0)).renderer().render()
+    assert text == (
+        '# HELP http_requests_total Requests "served"\\nby path \\\\ status\n'
+        '# TYPE http_requests_total counter\n'
+        'http_requests_total{path="a\\"b\\\\c\\nd",status_code="200"} 3\n'
+        '# TYPE _1st_gauge gauge\n'
+        '_1st_gauge 2.5\n'
+        '# HELP latency_seconds Latency\n'
+        '# TYPE latency_seconds histogram\n'
+        'latency_seconds_bucket{op="x",le="0.1"} 1\n'
+        'latency_seconds_bucket{op="x",le="1.0"} 2\n'
+        'latency_seconds_bucket{op="x",le="+Inf"} 3\n'
+        'latency_seconds_sum{op="x"} 5.55\n'
+        'latency_seconds_count{op="x"} 3\n'
+    )
+    
+    families = {family.name: family for family in text_string_to_metric_families(text)}
+    requests = families['http_requests']
+    assert requests.type == 'counter'
+    assert requests.documentation == 'Requests "served"\nby path \\ status'
+    assert requests.samples[0].labels == {'path': 'a"b\\c\nd', 'status_code': '200'}
+    assert families['_1st_gauge'].samples[0].value == 2.5
+    assert [sample.value for sample in families['latency_seconds'].samples] == [1, 2, 3, 5.55, 3]
+
+
+def test_openmetrics_exposition_golden(omp):
+    from prometheus_client.openmetrics.parser import text_string_to_metric_families
+    
+    text = _exposition_collector(omp, histogram_buckets=(0.1, 1.0)).renderer(openmetrics=True).render()
+    lines = text.splitlines()
+    assert lines[:3] == ['# HELP http_requests Requests \\"served\\"\\nby path \\\\ status',
+                         '# TYPE http_requests counter',
+                         'http_requests_total{path="a\\"b\\\\c\\nd",status_code="200"} 3']
+    assert text.endswith('latency_seconds_count{op="x"} 3\n# EOF\n')
+    assert text.count('# EOF') == 1
+    
+    # The strict OpenMetrics parser rejects a missing # EOF or misordered headers
+    families = {family.name: family for family in text_string_to_metric_families(text)}
+    assert families['http_requests'].documentation == 'Requests "served"\nby path \\ status'
+    assert families['http_requests'].samples[0].name == 'http_requests_total'
+    assert families['latency_seconds'].type == 'histogram'
+
+
+def test_native_histogram_exposition_buckets(omp):
+    from prometheus_client.openmetrics.parser import text_string_to_metric_families
+    
+    collector = omp.AsyncMetricsCollector(columnar=False, histogram_buckets='native', histogram_schema=1)
+    _aggregate(collector, [('test_native', value, None, 'histogram') for value in (0, 0.3, 1.0, 1.5, 3.0, 3.0)])
+    family, = text_string_to_metric_families(collector.renderer(openmetrics=True).render())
+    
+    buckets = [(sample.labels['le'], sample.value) for sample in family.samples if sample.name.endswith('_bucket')]
+    # Zero bucket, then (base**(i-1), base**i] with base sqrt(2), cumulative
+    assert buckets == [('1e-09', 1), (repr(2 ** -1.5), 2), ('1.0', 3), ('2.0', 4), ('4.0', 6), ('+Inf', 6)]
+
+
+def test_renderer_rerenders_only_changed_series(omp):
+    collector = _exposition_collector(omp)
+    renderer = collector.renderer()
+    first = renderer.render()
+    assert renderer.render() is first
+    
+    asyncio.run(collector._process_batch([('1st_gauge', 7, None, 'gauge', 2.0)]))
+    assert '_1st_gauge 7\n' in renderer.render()
+    collector.describe('1st_gauge', 'Now documented')
+    assert '# HELP _1st_gauge Now documented\n# TYPE _1st_gauge gauge\n' in renderer.render()
+
+
+@pytest.mark.parametrize('accept, accept_encoding, openmetrics, gzipped', [
+    ('', '', False, False),
+    ('application/openmetrics-text; version=1.0.0,text/plain;q=0.5', 'gzip, deflate', True, True),
+    ('application/openmetrics-text;q=0,text/plain', 'gzip;q=0, identity', False, False),
+    ('text/plain', 'br;q=1.0, GZIP;q=0.5', False, True),
+])
+def test_scrape_negotiates_format_and_gzip(omp, accept, accept_encoding, openmetrics, gzipped):
+    collector = _exposition_collector(omp)
+    body, headers = collector.scrape(accept, accept_encoding)
+    assert headers['Content-Type'] == (omp.OPENMETRICS_CONTENT_TYPE if openmetrics else omp.PROMETHEUS_CONTENT_TYPE)
+    assert ('Content-Encoding' in headers) == gzipped
+    text = gzip.decompress(body) if gzipped else body
+    assert text.decode('utf-8') == collector.renderer(openmetrics).render()
+
+
+def test_head_dropped_trace_records_no_spans(omp):
+    tracer = omp.DistributedTracer('test-head-dropped', sampling_rate=0.0)
+    with tracer.span('root') as root:
+        with tracer.span('child') as child:
+            headers = tracer.inject_headers()
+    
+    assert isinstance(root, omp.NonRecordingSpan) and isinstance(child, omp.NonRecordingSpan)
+    assert child.trace_id == root.trace_id
+    assert headers['traceparent'].endswith('-00')
+    assert tracer.completed_spans == [] and tracer.latency_sketches == {}
+    # One decision per trace; the child inherits it
+    assert tracer.get_sampling_stats() == {'head_dropped': 1}
+    
+    span_id = tracer.start_trace('manual')
+    assert span_id not in tracer.active_spans
+    assert tracer.finish_span(span_id) is None
+    assert tracer.completed_spans == []
+
+
+def test_remote_sampling_decision_overrides_head_rate(omp):
+    tracer = omp.DistributedTracer('test-remote-decision', sampling_rate=0.0)
+    sampled = tracer.extract_context({'traceparent': f'00-{"ab" * 16}-{"cd" * 8}-01'})
+    with tracer.span('sampled-upstream', parent_context=sampled) as span:
+        assert span.sampled and span.parent_span_id == int('cd' * 8, 16)
+    
+    tracer = omp.DistributedTracer('test-remote-decision', sampling_rate=1.0)
+    dropped = tracer.extract_context({'traceparent': f'00-{"ab" * 16}-{"cd" * 8}-00'})
+    with tracer.span('dropped-upstream', parent_context=dropped) as span:
+        assert not span.sampled
+    assert tracer.completed_spans == []
+
+
+def test_tail_sampling_keeps_error_and_slow_traces(omp):
+    tracer = omp.DistributedTracer('test-tail', sampling_mode='tail', tail_latency_threshold=0.05,
+                                   tail_baseline_rate=0.0)
+    
+    def run(fail=False, delay=0.0):
+        with tracer.span('root') as root:
+            with tracer.span('child'):
+                time.sleep(delay)
+            try:
+                with tracer.span('call'):
+                    if fail:
+                        raise RuntimeError('boom')
+            except RuntimeError:
+                pass
+        return root.trace_id
+    
+    fast = run()
+    errored = run(fail=True)
+    slow = run(delay=0.06)
+    
+    assert tracer.span_store.get_trace(fast) == []
+    assert {span.operation_name for span in tracer.span_store.get_trace(errored)} == {'root', 'child', 'call'}
+    assert len(tracer.span_store.get_trace(slow)) == 3
+    stats = tracer.get_sampling_stats()
+    assert (stats['tail_kept'], stats['tail_dropped']) == (2, 1)
+    assert not tracer._pending_traces
+
+
+def test_tail_sampling_applies_decision_to_late_spans(omp):
+    tracer = omp.DistributedTracer('test-tail-late', sampling_mode='tail', tail_latency_threshold=60.0)
+    root_id = tracer.start_trace('root')
+    root = tracer.active_spans[root_id]
+    late_id = tracer.start_trace('late', parent_context={'trace_id': root.trace_id, 'span_id': root_id,
+                                                         'sampled': True})
+    tracer.finish_span(root_id, status='error')
+    assert [span.span_id for span in tracer.span_store.get_trace(root.trace_id)] == [root_id]
+    
+    tracer.finish_span(late_id)
+    assert len(tracer.span_store.get_trace(root.trace_id)) == 2
+
+
+TRACE_HEX = '4bf92f3577b34da6a3ce929d0e0e4736'
+SPAN_HEX = '00f067aa0ba902b7'
+
+
+@pytest.mark.parametrize('traceparent', [
+    f'ff-{TRACE_HEX}-{SPAN_HEX}-01',             # forbidden version
+    f'zz-{TRACE_HEX}-{SPAN_HEX}-01',             # non-hex version
+    f'00-{"0" * 32}-{SPAN_HEX}-01',              # all-zero trace id
+    f'00-{TRACE_HEX}-{"0" * 16}-01',             # all-zero parent id
+    f'00-{TRACE_HEX[:-1]}-{SPAN_HEX}-01',        # short trace id
+    f'00-{TRACE_HEX}0-{SPAN_HEX}-01',            # long trace id
+    f'00-{TRACE_HEX}-{SPAN_HEX[:-1]}-01',        # short parent id
+    f'00-{TRACE_HEX}-{SPAN_HEX}-1',              # short flags
+    f'00-{TRACE_HEX}-{SPAN_HEX}-01-extra',       # version 00 has no extra fields
+    f'01-{TRACE_HEX}-{SPAN_HEX}-01extra',        # extra fields need a separator
+    f'00-{TRACE_HEX.upper()}-{SPAN_HEX}-01',     # uppercase hex
+    f'00-{TRACE_HEX}-{SPAN_HEX.upper()}-01',
+    f'00-{TRACE_HEX}-{SPAN_HEX}-0A',
+    f'00-{TRACE_HEX[:-2]}_1-{SPAN_HEX}-01',      # int() would accept underscores
+    f'00- {TRACE_HEX[1:]}-{SPAN_HEX}-01',
+    '',
+])
+def test_extract_context_rejects_invalid_traceparent(omp, traceparent):
+    tracer = omp.DistributedTracer('test-traceparent')
+    assert tracer.extract_context({'traceparent': traceparent}) == {}
+
+
+def test_extract_context_accepts_valid_traceparent(omp):
+    tracer = omp.DistributedTracer('test-traceparent')
+    context = tracer.extract_context({'traceparent': f'00-{TRACE_HEX}-{SPAN_HEX}-03', 'tracestate': 'vendor=1'})
+    assert context == {'trace_id': int(TRACE_HEX, 16), 'span_id': int(SPAN_HEX, 16), 'sampled': True,
+                       'tracestate': 'vendor=1'}
+    # A later version with extra fields is read as far as this version understands it
+    future = tracer.extract_context({'traceparent': f'cc-{TRACE_HEX}-{SPAN_HEX}-00-what-the-future'})
+    assert future == {'trace_id': int(TRACE_HEX, 16), 'span_id': int(SPAN_HEX, 16), 'sampled': False}
+
+
+@pytest.mark.parametrize('sampling_rate', [1.0, 0.0])
+def test_traceparent_round_trip(omp, sampling_rate):
+    upstream = omp.DistributedTracer('test-upstream', sampling_rate=sampling_rate)
+    downstream = omp.DistributedTracer('test-downstream')
+    with upstream.span('client') as client:
+        headers = upstream.inject_headers()
+    headers['tracestate'] = 'congo=t61rcWkgMzE'
+    
+    context = downstream.extract_context(headers)
+    assert headers['traceparent'] == f'00-{client.trace_id:032x}-{client.span_id:016x}-0{int(client.sampled)}'
+    with downstream.span('server', parent_context=context) as server:
+        assert (server.trace_id, server.sampled, server.trace_state) == (
+            client.trace_id, client.sampled, 'congo=t61rcWkgMzE')
+        assert downstream.inject_headers()['traceparent'][:36] == headers['traceparent'][:36]
+
+
+def _lognormal(seed, count):
+    rng = random.Random(seed)
+    return [rng.lognormvariate(-3, 1.5) for _ in range(count)]
+
+
+def _true_quantile(values, q):
+    # Same rank convention as DDSketch.quantile: lower value at q * (n - 1)
+    return sorted(values)[int(q * (len(values) - 1))]
+
+
+@pytest.mark.parametrize('accuracy', [0.01, 0.05])
+def test_ddsketch_quantiles_within_relative_accuracy(omp, accuracy):
+    values = _lognormal(1, 20000) + [0.0] * 50
+    sketch = omp.DDSketch(relative_accuracy=accuracy)
+    for value in values:
+        sketch.add(value)
+    
+    for q in (0.0, 0.001, 0.1, 0.5, 0.9, 0.99, 0.999, 1.0):
+        expected = _true_quantile(values, q)
+        assert abs(sketch.quantile(q) - expected) <= accuracy * expected + 1e-12, q
+    assert (sketch.count, sketch.min, sketch.max) == (len(values), min(values), max(values))
+    assert sketch.sum == pytest.approx(sum(values))
+
+
+def test_ddsketch_collapse_keeps_upper_quantiles_accurate(omp):
+    values = _lognormal(2, 20000)
+    sketch = omp.DDSketch(relative_accuracy=0.01, max_bins=400)
+    for value in values:
+        sketch.add(value)
+    # The lowest values were folded together, the upper ~2800x range is intact
+    assert len(sketch.bins) == 400
+    for q in (0.5, 0.9, 0.99, 0.999):
+        expected = _true_quantile(values, q)
+        assert abs(sketch.quantile(q) - expected) <= 0.01 * expected
+
+
+def test_ddsketch_merge_matches_single_sketch(omp):
+    left_values, right_values = _lognormal(3, 5000), _lognormal(4, 7000)
+    left, right, combined = (omp.DDSketch(0.02) for _ in range(3))
+    for value in left_values:
+        left.add(value)
+        combined.add(value)
+    for value in right_values:
+        right.add(value)
+        combined.add(value)
+    
+    # As shipped between processes
+    left.merge(omp.DDSketch.from_dict(right.to_dict()))
+    assert left.bins == combined.bins
+    assert (left.count, left.min, left.max) == (combined.count, combined.min, combined.max)
+    assert left.sum == pytest.approx(combined.sum)
+    assert left.quantiles() == combined.quantiles()
+    
+    left.merge(omp.DDSketch(0.02))
+    assert left.count == combined.count
+    with pytest.raises(ValueError):
+        left.merge(omp.DDSketch(0.01))
+
+
+def _outcomes(breaker, pattern):
+    """Run calls through the breaker: 'f' fails, anything else succeeds"""
+    def call(fail):
+        if fail:
+            raise RuntimeError('down')
+    for outcome in pattern:
+        try:
+            breaker.call(call, outcome == 'f')
+        except RuntimeError:
+            pass
+
+
+@pytest.mark.parametrize('window_type', ['count', 'time'])
+def test_window_trips_at_failure_rate_threshold(omp, window_type):
+    closed = omp.CircuitBreakerState.CLOSED
+    breaker = omp.IntelligentCircuitBreaker(f'test-window-{window_type}', window_type=window_type,
+                                            window_size=10, minimum_calls=10, failure_rate_threshold=0.5)
+    _outcomes(breaker, 'sssssffff')
+    assert breaker.state == closed  # 4/9 failed, below minimum_calls
+    _outcomes(breaker, 'f')
+    assert breaker.state == omp.CircuitBreakerState.OPEN  # 5/10 failed, exactly the threshold
+    assert breaker.get_state()['window'] == {'type': window_type, 'calls': 10, 'failure_rate': 0.5,
+                                             'slow_call_rate': 0.0}
+    
+    below = omp.IntelligentCircuitBreaker(f'test-window-below-{window_type}', window_type=window_type,
+                                          window_size=10, minimum_calls=10, failure_rate_threshold=0.5)
+    _outcomes(below, 'ssssssffff' + 'ssssssssff' * 3)  # never more than 4 of the last 10 failed
+    assert below.state == closed
+
+
+def test_window_trips_on_slow_call_rate(omp):
+    breaker = omp.IntelligentCircuitBreaker('test-window-slow', window_type='count', window_size=10,
+                                            minimum_calls=5, slow_call_threshold=0.0, slow_call_rate_threshold=1.0)
+    _outcomes(breaker, 'ssss')
+    assert breaker.state == omp.CircuitBreakerState.CLOSED
+    _outcomes(breaker, 's')
+    assert breaker.state == omp.CircuitBreakerState.OPEN
+
+
+def test_count_window_forgets_old_outcomes(omp):
+    window = omp._CountWindow(4)
+    for outcome in (1, 1, 0, 2, 0, 0):
+        window.record(outcome)
+    assert window.totals() == (4, 0, 1)
+
+
+def test_time_window_expires_old_seconds(omp, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(omp.time, 'monotonic', lambda: now[0])
+    window = omp._TimeWindow(3)
+    window.record(1)
+    now[0] += 1
+    window.record(2)
+    window.record(0)
+    assert window.totals() == (3, 1, 1)
+    now[0] += 2
+    assert window.totals() == (2, 0, 1)  # the first second has expired
+    now[0] += 100
+    assert window.totals() == (0, 0, 0)
+
+
+def _half_open(breaker):
+    _trip(breaker)
+    # Past the recovery timeout, so the next call moves the breaker to HALF_OPEN
+    breaker.last_failure_time = time.time() - 3600
+
+
+def test_half_open_admits_at_most_max_probes(omp):
+    breaker = omp.IntelligentCircuitBreaker('test-probes', failure_threshold=1, half_open_max_calls=2)
+    _half_open(breaker)
+    
+    async def scenario():
+        release = asyncio.Event()
+        
+        async def probe():
+            await release.wait()
+            return 'ok'
+        
+        probes = [asyncio.create_task(breaker.call_async(probe)) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert breaker.state == omp.CircuitBreakerState.HALF_OPEN
+        with pytest.raises(omp.CircuitBreakerOpenError, match='HALF_OPEN'):
+            await breaker.call_async(probe)
+        
+        release.set()
+        assert await asyncio.gather(*probes) == ['ok', 'ok']
+        assert breaker._half_open_in_flight == 0
+        assert await breaker.call_async(probe) == 'ok'
+    
+    asyncio.run(scenario())
+    assert breaker.state == omp.CircuitBreakerState.CLOSED
+
+
+def test_failed_half_open_probe_reopens_and_releases_its_slot(omp):
+    breaker = omp.IntelligentCircuitBreaker('test-probe-fails', window_type='count', window_size=10,
+                                            minimum_calls=1, half_open_max_calls=1)
+    _half_open(breaker)
+    
+    async def fail():
+        raise RuntimeError('still down')
+    
+    with pytest.raises(RuntimeError):
+        asyncio.run(breaker.call_async(fail))
+    assert breaker.state == omp.CircuitBreakerState.OPEN
+    assert breaker._half_open_in_flight == 0
+
+
+def test_call_async_decorator_counts_only_expected_exceptions(omp):
+    breaker = omp.IntelligentCircuitBreaker('test-async-decorator', failure_threshold=2,
+                                            expected_exception=ConnectionError)
+    
+    @breaker
+    async def fetch(error=None):
+        if error is not None:
+            raise error
+        return 'payload'
+    
+    assert asyncio.run(fetch()) == 'payload'
+    with pytest.raises(ValueError):
+        asyncio.run(fetch(ValueError('bad input')))
+    assert breaker.failure_count == 0
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            asyncio.run(fetch(ConnectionError('refused')))
+    assert breaker.state == omp.CircuitBreakerState.OPEN
+    with pytest.raises(omp.CircuitBreakerOpenError):
+        asyncio.run(fetch())
+
+
+def _policy(omp, name, budget, **options):
+    breaker = omp.IntelligentCircuitBreaker(name, failure_threshold=1000)
+    return omp.ResiliencePolicy(breaker, base_delay=0.0, max_delay=0.0, retry_budget=budget, **options)
+
+
+def test_retries_stop_when_budget_is_spent(omp):
+    budget = omp.RetryBudget(token_ratio=0.0, max_tokens=2.0, min_per_second=0.0)
+    policy = _policy(omp, 'test-retry-budget', budget, max_attempts=10)
+    service = omp.FakeService(latency=lambda: 0.0, failure_rate=1.0, seed=1)
+    
+    with pytest.raises(ConnectionError):
+        policy.call(service.call)
+    assert service.calls == 3  # first attempt plus the two budgeted retries
+    with pytest.raises(ConnectionError):
+        policy.call(service.call)
+    assert service.calls == 4
+    stats = policy.get_stats()
+    assert (stats['first_attempts'], stats['retries'], stats['budget_exhausted']) == (2, 2, 2)
+
+
+def test_retry_budget_earns_tokens_from_requests(omp):
+    budget = omp.RetryBudget(token_ratio=0.5, max_tokens=1.0, min_per_second=0.0)
+    assert budget.try_withdraw() and not budget.try_withdraw()
+    budget.deposit()
+    assert not budget.try_withdraw()
+    budget.deposit()
+    assert budget.try_withdraw()
+
+
+def test_open_breaker_rejections_are_not_retried(omp):
+    budget = omp.RetryBudget()
+    policy = _policy(omp, 'test-retry-open', budget)
+    _trip(policy.breaker)
+    service = omp.FakeService(latency=lambda: 0.0)
+    with pytest.raises(omp.CircuitBreakerOpenError):
+        policy.call(service.call)
+    assert service.calls == 0 and policy.stats['retry'] == 0
+
+
+def test_hedge_wins_and_losing_attempt_is_cancelled(omp):
+    latencies = iter([0.001] * 5 + [5.0, 0.001])
+    service = omp.FakeService(latency=lambda: next(latencies))
+    policy = _policy(omp, 'test-hedge', omp.RetryBudget(), hedge_min_samples=5, hedge_quantile=0.5)
+    
+    async def scenario():
+        for _ in range(5):
+            await policy.call_async(service.call_async, 'warm', idempotent=True)
+        started = time.perf_counter()
+        result = await policy.call_async(service.call_async, 'hedged', idempotent=True)
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(0)  # let the cancelled primary unwind
+        return result, elapsed
+    
+    result, elapsed = asyncio.run(scenario())
+    assert result == 'hedged' and elapsed < 1.0
+    assert (service.calls, service.cancelled, service.in_flight) == (7, 1, 0)
+    stats = policy.get_stats()
+    assert (stats['hedges'], stats['hedge_wins']) == (1, 1)
+
+
+def test_hedge_is_skipped_without_budget(omp):
+    latencies = iter([0.001] * 5 + [0.05])
+    service = omp.FakeService(latency=lambda: next(latencies))
+    budget = omp.RetryBudget(token_ratio=0.0, max_tokens=0.0, min_per_second=0.0)
+    policy = _policy(omp, 'test-hedge-budget', budget, hedge_min_samples=5, hedge_quantile=0.5)
+    
+    async def scenario():
+        for _ in range(6):
+            await policy.call_async(service.call_async, idempotent=True)
+    
+    asyncio.run(scenario())
+    assert (service.calls, service.cancelled) == (6, 0)
+    assert policy.get_stats()['hedges'] == 0 and policy.stats['budget_exhausted'] == 1
+
+
+def _buffered_values(collector):
+    """Values of the samples still waiting for aggregation, oldest first"""
+    chunks = list(collector.metrics_queue._queue) + [collector._staging]
+    return [sample[1] for chunk in chunks if chunk for sample in chunk]
+
+
+def test_drop_oldest_keeps_newest_samples(omp):
+    collector = omp.AsyncMetricsCollector(max_pending=10, chunk_size=4, overflow='drop_oldest')
+    assert all(collector.record_nowait('test_gauge', i) for i in range(15))
+    
+    values = _buffered_values(collector)
+    assert collector.pending == len(values) <= 10
+    assert values == list(range(15 - len(values), 15))
+    assert collector.dropped == 15 - len(values)
+    
+    # A bulk chunk larger than the buffer keeps only its newest max_pending samples
+    assert collector.record_many([('test_gauge', i) for i in range(100, 125)]) == 10
+    assert _buffered_values(collector) == list(range(115, 125))
+
+
+def test_drop_newest_rejects_incoming_samples(omp):
+    collector = omp.AsyncMetricsCollector(max_pending=10, chunk_size=4, overflow='drop_newest')
+    accepted = [collector.record_nowait('test_gauge', i) for i in range(15)]
+    assert accepted == [True] * 10 + [False] * 5
+    assert collector.record_many([('test_gauge', 99)]) == 0
+    assert _buffered_values(collector) == list(range(10))
+    assert collector.dropped == 6
+
+
+def test_sample_policy_thins_above_watermark(omp, monkeypatch):
+    collector = omp.AsyncMetricsCollector(max_pending=100, chunk_size=8, overflow='sample', sample_watermark=0.5)
+    accepted = sum(collector.record_nowait('test_gauge', i) for i in range(1000))
+    assert collector.pending == accepted <= 100
+    assert collector.dropped == 1000 - accepted
+    
+    # Everything below the watermark is admitted; above it samples are thinned, not cut off
+    values = _buffered_values(collector)
+    assert values[:50] == list(range(50))
+    assert values[-1] - values[50] > len(values) - 50
+    
+    # Bulk chunks are thinned too but never overfill the buffer
+    monkeypatch.setattr(omp.random, 'random', lambda: 0.0)
+    bulk = omp.AsyncMetricsCollector(max_pending=100, overflow='sample', sample_watermark=0.5)
+    assert bulk.record_many([('test_gauge', i) for i in range(500)]) == 100
+    assert bulk.pending == 100
+
+
+def test_block_policy_waits_for_space(omp):
+    async def scenario():
+        collector = omp.AsyncMetricsCollector(max_pending=10, chunk_size=4, batch_size=5, flush_interval=0.01,
+                                              overflow='block')
+        await collector.start()
+        for i in range(200):
+            await collector.record_metric('test_blocked_total', 1, metric_type='counter')
+            assert collector.pending <= 10
+        await collector.stop()
+        
+        # The synchronous paths cannot wait, so they drop the newest samples
+        for _ in range(10):
+            collector.record_nowait('test_blocked_total', 1, metric_type='counter')
+        assert not collector.record_nowait('test_blocked_total', 1, metric_type='counter')
+        return collector
+    
+    collector = asyncio.run(scenario())
+    assert collector.get_aggregated_metrics()['test_blocked_total']['{}']['value'] == 200
+    assert collector.dropped == 1
+
+
+def _mixed_batch(seed, size=3000):
+    """Counters, gauges and histograms over shared and per-call label dicts"""
+    rng = random.Random(seed)
+    shared = [{'route': f'/r{i}'} for i in range(5)]
+    samples = []
+    for i in range(size):
+        labels = rng.choice(shared) if i % 2 else {'route': f'/r{rng.randrange(5)}'}
+        kind = rng.randrange(4)
+        if kind == 0:
+            samples.append(('test_mixed_total', rng.randrange(1, 5), labels, 'counter'))
+        elif kind == 1:
+            samples.append(('test_mixed_inflight', rng.randrange(100) * 0.25, labels, 'gauge'))
+        elif kind == 2:
+            samples.append(('test_mixed_seconds', rng.randrange(1, 4000) / 1024, labels, 'histogram'))
+        else:
+            samples.append(('test_mixed_unlabeled_total', 1, None, 'counter'))
+    return samples
+
+
+@pytest.mark.parametrize('histogram_options', [{}, {'histogram_buckets': 'native', 'histogram_sketch': True}])
+def test_columnar_aggregation_matches_scalar(omp, histogram_options):
+    if omp.np is None:
+        pytest.skip('requires numpy')
+    results = []
+    for columnar in (False, True):
+        collector = omp.AsyncMetricsCollector(columnar=columnar, columnar_min_batch=1, **histogram_options)
+        for seed in range(3):
+            batch = [(*sample, 1000.0 + seed) for sample in _mixed_batch(seed)]
+            asyncio.run(collector._process_batch(batch))
+        results.append(collector.get_aggregated_metrics())
+    
+    scalar, columnar = results
+    assert scalar == columnar
+    assert set(scalar) == {'test_mixed_total', 'test_mixed_inflight', 'test_mixed_seconds',
+                           'test_mixed_unlabeled_total'}
+
+
+def test_bucket_histogram_upper_bounds_are_inclusive(omp):
+    histogram = omp.BucketHistogram((0.1, 1.0, 5.0))
+    for value in (-1.0, 0.1, 0.1000001, 1.0, 5.0, 5.0000001, 1e9):
+        histogram.observe(value)
+    assert histogram.cumulative_buckets() == {'0.1': 2, '1.0': 4, '5.0': 5, '+Inf': 7}
+    assert histogram.bucket_ranges()[0] == (-omp.math.inf, 0.1, 2)
+
+
+@pytest.mark.parametrize('schema', [-4, -1, 0, 1, 3, 8])
+def test_native_histogram_boundaries_are_upper_inclusive(omp, schema):
+    histogram = omp.NativeHistogram(schema=schema, max_buckets=10 ** 6, zero_threshold=0.0)
+    for index in range(-40, 41):
+        bound = histogram.upper_bound(index)
+        histogram.buckets = {}
+        histogram.observe(bound)
+        assert list(histogram.buckets) == [index], bound
+        histogram.buckets = {}
+        histogram.observe(omp.math.nextafter(bound, omp.math.inf))
+        assert list(histogram.buckets) == [index + 1], bound
+
+
+def test_native_histogram_lowers_schema_to_fit_max_buckets(omp):
+    values = _lognormal(5, 5000)
+    histogram = omp.NativeHistogram(schema=8, max_buckets=20)
+    for value in values:
+        histogram.observe(value)
+    
+    assert len(histogram.buckets) <= 20 and histogram.schema < 8
+    assert sum(histogram.buckets.values()) + histogram.zero_count == histogram.count == len(values)
+    # Base is 2 ** (2 ** -schema): each bucket at the final schema holds exactly its values
+    base = 2 ** (2.0 ** -histogram.schema)
+    for index, count in histogram.buckets.items():
+        lower, upper = histogram.upper_bound(index - 1), histogram.upper_bound(index)
+        assert upper == pytest.approx(lower * base)
+        assert count == sum(1 for value in values if lower < value <= upper)
+    
+    tiny = omp.NativeHistogram(schema=0, max_buckets=1)
+    for value in (1e-6, 1.0, 1e6):
+        tiny.observe(value)
+    assert tiny.schema == omp.NativeHistogram.MIN_SCHEMA
+
+
+@pytest.mark.parametrize('columnar', [False, True])
+def test_type_conflicts_reject_only_the_conflicting_samples(omp, columnar):
+    if columnar and omp.np is None:
+        pytest.skip('requires numpy')
+    collector = omp.AsyncMetricsCollector(columnar=columnar, columnar_min_batch=1)
+    _aggregate(collector, [('test_conflict', 1, None, 'counter'),
+                           ('test_conflict', 0.5, None, 'histogram'),
+                           ('test_conflict', 9, None, 'gauge'),
+                           ('test_conflict', 2, None, 'counter'),
+                           ('test_conflict_new', 0.25, None, 'histogram'),
+                           ('test_conflict_new', 3, None, 'counter')], columnar)
+    
+    aggregated = collector.get_aggregated_metrics()
+    assert aggregated['test_conflict']['{}']['value'] == 3
+    assert aggregated['test_conflict_new']['{}']['count'] == 1
+    assert collector.type_conflicts == 3
+
+
+def test_type_conflict_does_not_drop_the_batch(omp):
+    async def scenario():
+        collector = omp.AsyncMetricsCollector(flush_interval=0.01)
+        await collector.start()
+        collector.record_many([('test_conflict_loop_total', 1, None, 'counter'),
+                               ('test_conflict_loop_total', 0.5, None, 'histogram'),
+                               ('test_conflict_loop_gauge', 4, None, 'gauge')])
+        await asyncio.sleep(0.05)
+        await collector.stop()
+        return collector.get_aggregated_metrics()
+    
+    aggregated = asyncio.run(scenario())
+    assert aggregated['test_conflict_loop_total']['{}']['value'] == 1
+    assert aggregated['test_conflict_loop_gauge']['{}']['value'] == 4
+
+
+@pytest.mark.parametrize('columnar', [False, True])
+def test_unsupported_types_take_no_series_budget(omp, columnar):
+    if columnar and omp.np is None:
+        pytest.skip('requires numpy')
+    collector = omp.AsyncMetricsCollector(max_series=4, columnar=columnar, columnar_min_batch=1)
+    samples = [(f'test_summary_{i}', 1, {'shard': str(i)}, 'summary') for i in range(10)]
+    samples += [(f'test_supported_{i}', 1, None, 'counter') for i in range(4)]
+    _aggregate(collector, samples, columnar)
+    
+    assert collector.unsupported_types == 10
+    assert len(collector.series) == 4
+    assert collector.series.top_offenders() == []
+    assert sorted(collector.get_aggregated_metrics()) == [f'test_supported_{i}' for i in range(4)]
+    
+    _aggregate(collector, [('test_summary_only', 1, None, 'summary')], columnar)
+    assert collector.unsupported_types == 11 and len(collector.series) == 4
+
+
+def test_span_scopes_nest_independently_across_tasks(omp):
+    tracer = omp.DistributedTracer('test-scopes')
+    
+    async def worker(root, name, delay):
+        async with tracer.span(f'{name}-outer') as outer:
+            await asyncio.sleep(delay)
+            async with tracer.span(f'{name}-inner') as inner:
+                assert tracer.get_current_span() is inner
+                await asyncio.sleep(delay)
+            assert tracer.get_current_span() is outer
+        assert tracer.get_current_span() is root
+        return outer, inner
+    
+    async def scenario():
+        with tracer.span('root') as root:
+            # Interleaving sleeps make each task resume inside the others' scopes
+            results = await asyncio.gather(*(worker(root, name, delay)
+                                             for name, delay in (('a', 0.002), ('b', 0.001), ('c', 0.0))))
+        return root, results
+    
+    root, results = asyncio.run(scenario())
+    
+    assert tracer.get_current_span() is None
+    for outer, inner in results:
+        assert outer.parent_span_id == root.span_id and outer.trace_id == root.trace_id
+        assert inner.parent_span_id == outer.span_id and inner.trace_id == root.trace_id
+        assert outer.start_ns <= inner.start_ns <= inner.end_ns <= outer.end_ns
+    stored = {span.operation_name: span for span in tracer.span_store.get_trace(root.trace_id)}
+    assert len(stored) == 7 and stored['root'].parent_span_id is None
+
+
+def test_span_scope_restores_parent_after_error(omp):
+    tracer = omp.DistributedTracer('test-scope-error')
+    with tracer.span('outer') as outer:
+        with pytest.raises(RuntimeError):
+            with tracer.span('inner'):
+                raise RuntimeError('boom')
+        assert tracer.get_current_span() is outer
+    
+    spans = {span.operation_name: span for span in tracer.span_store.get_trace(outer.trace_id)}
+    assert spans['inner'].status == 'error' and spans['outer'].status == 'success'
+
+
+def _span_tree(omp):
+    """root 0-100ms with overlapping children a/b, grandchildren, and c running past the root"""
+    layout = [(1, None, 'root', 0, 100), (2, 1, 'a', 10, 40), (3, 2, 'a1', 15, 35),
+              (4, 1, 'b', 30, 90), (5, 4, 'b1', 50, 80), (6, 1, 'c', 95, 120)]
+    spans = [omp.Span(77, span_id, parent, name, 'svc', start_ns=start * 1_000_000,
+                      end_ns=end * 1_000_000, status='success')
+             for span_id, parent, name, start, end in layout]
+    # Unfinished spans are ignored
+    spans.append(omp.Span(77, 7, 1, 'open', 'svc', start_ns=0))
+    return spans
+
+
+def test_trace_analyzer_self_time_and_critical_path(omp):
+    result = omp.TraceAnalyzer().analyze(_span_tree(omp))
+    
+    breakdown = {entry['operation_name']: entry for entry in result['spans']}
+    expected_self = {'root': 15, 'a': 10, 'a1': 20, 'b': 30, 'b1': 30, 'c': 25}
+    assert set(breakdown) == set(expected_self)
+    for name, self_ms in expected_self.items():
+        entry = breakdown[name]
+        assert entry['self_time'] == pytest.approx(self_ms / 1000)
+        assert entry['self_time'] + entry['child_time'] == pytest.approx(entry['duration'])
+    
+    path = [(entry['operation_name'], entry['critical_time']) for entry in result['critical_path']]
+    assert [name for name, _ in path] == ['root', 'a', 'a1', 'b', 'b1', 'c']
+    assert [critical for _, critical in path] == pytest.approx([0.015, 0.005, 0.015, 0.030, 0.030, 0.005])
+    assert sum(critical for _, critical in path) == pytest.approx(0.1)
+
+
+def test_trace_analyzer_treats_orphans_as_roots_and_aggregates(omp):
+    spans = [span for span in _span_tree(omp) if span.operation_name != 'b']
+    result = omp.TraceAnalyzer().analyze(spans)
+    # b1 lost its parent, so it is a root with its own critical path
+    critical = {entry['operation_name']: entry['critical_time'] for entry in result['critical_path']}
+    assert critical['b1'] == pytest.approx(0.030)
+    assert sum(critical.values()) == pytest.approx(0.130)
+    
+    totals = omp.TraceAnalyzer().aggregate([_span_tree(omp), _span_tree(omp)])
+    assert list(totals)[:2] == ['b', 'b1']
+    assert totals['b']['count'] == 2 and totals['b']['avg_self_time'] == pytest.approx(0.030)
+    assert totals['root']['critical_time_per_trace'] == pytest.approx(0.015)
+    assert sum(op['self_time_share'] for op in totals.values()) == pytest.approx(1.0)
+
+
+def test_rollup_ring_reuses_slots_and_drops_stale_intervals(omp):
+    ring = omp.RollupRing(10.0, 6)
+    for timestamp in range(0, 60, 5):
+        ring.add(timestamp, 1.0, 1, timestamp, timestamp, timestamp)
+    assert [point['count'] for point in ring.query(0, 59)] == [2] * 6
+    
+    # Interval 60-70 maps onto the slot of 0-10 and resets it
+    ring.add(61, 7.0, 1, 61, 61, 61)
+    points = ring.query(0, 69)
+    assert [point['start'] for point in points] == [10, 20, 30, 40, 50, 60]
+    assert points[-1] == {'start': 60, 'sum': 7.0, 'count': 1, 'min': 61, 'max': 61, 'last': 61}
+    # Past the horizon: a late sample for interval 0-10 is dropped
+    ring.add(3, 100.0, 1, 3, 3, 3)
+    assert ring.query(0, 9) == [] and ring.query(60, 69)[0]['sum'] == 7.0
+    assert ring.span == 60
+
+
+def test_rollup_tiers_agree_after_downsampling(omp):
+    rng = random.Random(22)
+    collector = omp.AsyncMetricsCollector(rollups=((1.0, 120), (10.0, 60)), columnar=False)
+    base = (int(time.time()) // 10) * 10 - 300
+    
+    async def feed():
+        for second in range(300):
+            batch = [('test_rollup_total', rng.randint(0, 5), None, 'counter', base + second),
+                     ('test_rollup_gauge', rng.uniform(-1, 1), None, 'gauge', base + second)]
+            batch += [('test_rollup_seconds', rng.expovariate(10), None, 'histogram', base + second)
+                      for _ in range(rng.randint(1, 3))]
+            await collector._process_batch(batch)
+    asyncio.run(feed())
+    
+    end = base + 299
+    for name in ('test_rollup_total', 'test_rollup_gauge', 'test_rollup_seconds'):
+        fine = collector.query_range(name, start=end - 119, end=end, resolution=1.0)
+        coarse = collector.query_range(name, start=end - 119, end=end, resolution=10.0)
+        assert len(fine) == 120 and len(coarse) == 12
+        for point in coarse:
+            inside = [p for p in fine if point['start'] <= p['start'] < point['start'] + 10]
+            assert len(inside) == 10
+            assert point['sum'] == pytest.approx(sum(p['sum'] for p in inside))
+            assert point['count'] == sum(p['count'] for p in inside)
+            assert point['last'] == inside[-1]['last']
+            if name != 'test_rollup_seconds':
+                assert point['min'] == min(p['min'] for p in inside)
+                assert point['max'] == max(p['max'] for p in inside)
+    
+    # Older than the fine tier's 120s: the coarse tier is picked and still covers all of it
+    history = collector.query_range('test_rollup_total', start=base, end=end)
+    assert len(history) == 30 and history[0]['start'] == base
+    total = collector.get_aggregated_metrics()['test_rollup_total']['{}']['value']
+    assert sum(point['sum'] for point in history) == total
+    assert collector.query_range('test_rollup_total', start=base, end=end, resolution=1.0)[0]['start'] == end - 119